@@ -1,3 +1,10 @@
+import io
+import os
+import glob
+import json
+import bisect
+import collections
+
 
 CONTROL_CODES = {
     "Pregnancy": 168629,
@@ -56,3 +63,126 @@ CONTROL_CODES = {
     "Translation": 26820,
     "multilingual": 128406,
 }
+
+
+def control_code_prompt(code):
+    # the prompt of an entry of a generation_data/control_codes.jsonl file, e.g. `nuclear energy CON waste`
+    return ' '.join([code['topic'].replace('_', ' '), code['stance'], code['aspect']])
+
+
+def read_control_codes(path):
+    # the entries of a control_codes.jsonl file, in file order
+    with io.open(path, encoding='utf-8') as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+# the generation_data/control_codes.jsonl files of all sources and topics
+CONTROL_CODE_FILES = 'training_data/*/*/generation_data/control_codes.jsonl'
+
+# an entry of the catalog: the prompt, its token ids and where it comes from; sources, topic, stance and aspect
+# are only set for the argument codes of the control_codes.jsonl files, not for the CTRL domain codes
+ControlCode = collections.namedtuple('ControlCode', ['prompt', 'tokens', 'sources', 'topic', 'stance', 'aspect'])
+
+
+class ControlCodeCatalog(object):
+    # all control codes the model was trained with, tokenised once, so that a prompt is checked and
+    # (as far as it is a known code) tokenised by dict lookups before any model compute:
+    # the argument codes of control_codes.jsonl files, indexed by source -> topic -> stance -> aspect,
+    # and the domain codes of CONTROL_CODES (a prompt starting with one is known as well)
+    # tokenize maps a prompt to its token ids and raises KeyError for pieces that are not in the vocabulary
+    def __init__(self, tokenize, files=()):
+        self.tokenize_text = tokenize
+        self.index = {}
+        self.codes = {}
+        for path in files:
+            # training_data/<source>/<topic>/generation_data/control_codes.jsonl
+            source = os.path.basename(os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(path)))))
+            for entry in read_control_codes(path):
+                prompt = control_code_prompt(entry)
+                code = self.codes.get(prompt)
+                if code is None:
+                    try:
+                        tokens = tokenize(prompt)
+                    except KeyError:
+                        # not tokenisable with this vocabulary: still known, but encode fails like for any prompt
+                        tokens = None
+                    code = ControlCode(prompt, tokens, (source,), entry['topic'], entry['stance'], entry['aspect'])
+                elif source not in code.sources:
+                    code = code._replace(sources=code.sources + (source,))
+                self.codes[prompt] = code
+                self.index.setdefault(source, {}).setdefault(entry['topic'], {}).setdefault(
+                    entry['stance'], {})[entry['aspect']] = code
+        for domain, token in CONTROL_CODES.items():
+            self.codes.setdefault(domain, ControlCode(domain, [token], (), None, None, None))
+        # the longest code in words bounds the prefixes a lookup tries
+        self.max_words = max(len(prompt.split(' ')) for prompt in self.codes)
+        self.sorted_prompts = sorted(self.codes)
+
+    def __len__(self):
+        return len(self.codes)
+
+    def __contains__(self, prompt):
+        return prompt in self.codes
+
+    def lookup(self, prompt):
+        # the known code the prompt starts with (the longest one) and the text after it, or None and the prompt
+        # a code ended with a period or colon is known as well, but its last word tokenises differently,
+        # so then the text after it is None
+        words = prompt.split(' ')
+        for n in range(min(len(words), self.max_words), 0, -1):
+            head = ' '.join(words[:n])
+            code = self.codes.get(head)
+            if code is not None:
+                return code, ' '.join(words[n:])
+            code = self.codes.get(head.rstrip('.:'))
+            if code is not None:
+                return code, None
+        return None, prompt
+
+    def complete(self, prefix, limit=10):
+        # the known codes starting with prefix, in alphabetical order
+        start = bisect.bisect_left(self.sorted_prompts, prefix)
+        matches = []
+        for prompt in self.sorted_prompts[start:]:
+            if not prompt.startswith(prefix) or len(matches) == limit:
+                break
+            matches.append(prompt)
+        return matches
+
+    def suggest(self, prompt, limit=5):
+        # the known codes sharing the longest prefix with prompt, e.g. for a misspelt aspect
+        text = ' '.join(prompt.split(' ')[:self.max_words])
+        for end in range(len(text), 0, -1):
+            matches = self.complete(text[:end], limit)
+            if matches:
+                return matches
+        return []
+
+    def encode(self, prompt):
+        # the known code the prompt starts with (or None) and the token ids of the prompt, where the ids of the
+        # code come from the catalog and only the text after it is tokenised
+        # raises ValueError for a prompt with pieces that are not in the vocabulary
+        code, rest = self.lookup(prompt)
+        try:
+            if code is None or rest is None or code.tokens is None:
+                return code, self.tokenize_text(prompt)
+            return code, list(code.tokens) + (self.tokenize_text(rest) if rest else [])
+        except KeyError as e:
+            raise ValueError('unknown token %s in "%s"' % (e, prompt))
+
+    def tokenize(self, prompt):
+        return self.encode(prompt)[1]
+
+    def validate(self, prompt):
+        # the known code the prompt starts with, raises ValueError naming the closest known codes if there is none
+        code = self.lookup(prompt)[0]
+        if code is None:
+            suggestions = self.suggest(prompt)
+            raise ValueError('"%s" does not start with a control code the model was trained with%s' % (
+                prompt, '; closest known codes: ' + ', '.join(suggestions) if suggestions else ''))
+        return code
+
+
+def load_catalog(tokenize, patterns=(CONTROL_CODE_FILES,)):
+    # the catalog of the control code files matching the glob patterns (by default all files in training_data)
+    return ControlCodeCatalog(tokenize, sorted(set(path for pattern in patterns for path in glob.glob(pattern))))
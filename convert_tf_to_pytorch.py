@@ -0,0 +1,31 @@
+from __future__ import print_function
+import os
+import sys
+import argparse
+import pytorch_checkpoint
+from tensorflow.python import pywrap_tensorflow
+
+parser = argparse.ArgumentParser(description='Code for converting a TF checkpoint to the flat checkpoint of the PyTorch engine')
+parser.add_argument('--tf_checkpoint', type=str, required=True,
+                    help='location of the .data file of the TensorFlow checkpoint. This is NOT the model folder. This could be <path>/seqlen256_v1.ckpt/model.ckpt-413000.data-00000-of-00001')
+parser.add_argument('--pytorch_checkpoint', type=str, required=True,
+                    help='location of where to write the flat PyTorch checkpoint')
+parser.add_argument('--num_heads', type=int, default=16,
+                    help='number of attention heads of the model being converted (the only value not stored in the checkpoint)')
+
+args = parser.parse_args()
+
+if not os.path.isfile(args.tf_checkpoint):
+    print('INFO :: TensorFlow checkpoint not found. Please verify location of the .data file.')
+    sys.exit(1)
+
+if os.path.isfile(args.pytorch_checkpoint):
+    print('PyTorch model already exists. Will not over-write. Please delete old checkpoint or specify different file name')
+    sys.exit(1)
+
+chkpt_for_reader = '.'.join(args.tf_checkpoint.split('.')[:-1])
+reader = pywrap_tensorflow.NewCheckpointReader(chkpt_for_reader)
+
+# the tensors are streamed one at a time, the number of layers and all shapes come from the checkpoint
+config = pytorch_checkpoint.convert_tf_checkpoint(reader, args.pytorch_checkpoint, args.num_heads)
+print('INFO :: Saved PyTorch model with config', config, 'to', args.pytorch_checkpoint)
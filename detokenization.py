@@ -0,0 +1,52 @@
+from __future__ import print_function
+
+# incremental detokenisation of BPE token ids: words split by BPE carry a continuation marker (`@@`) on every
+# piece but the last; the text of the decoded tokens is the same as joining their words with spaces and removing
+# the markers with the spaces behind them, but it is built piece by piece instead of re-joining every prefix
+
+
+class IncrementalDetokenizer(object):
+  # turns token ids into text as they come in; a word is only emitted once its last piece arrived,
+  # so every emitted piece is final and the emitted pieces add up to the text of all tokens
+  # previous is the token in front of the stream (e.g. the last token of the prompt), if any
+  def __init__(self, idx2word, previous=None):
+    self.idx2word = idx2word
+    # the pieces of the unfinished word and whether it goes without a space in front,
+    # at the start of the text or when the stream continues a word
+    self.pending = []
+    self.joined = previous is None or idx2word[previous].endswith('@@')
+
+  def push(self, token):
+    # the newly finalised text, empty while a word is incomplete
+    word = self.idx2word[token]
+    if word.endswith('@@'):
+      self.pending.append(word[:-2])
+      return ''
+    return self.finish(word)
+
+  def flush(self):
+    # the unfinished word at the end of a stream, without its continuation marker
+    return self.finish('') if self.pending else ''
+
+  def finish(self, last):
+    text = ('' if self.joined else ' ') + ''.join(self.pending) + last
+    self.pending = []
+    self.joined = False
+    return str(text)
+
+
+def stream_text(tokens, idx2word, previous=None):
+  # generator over the finalised text pieces of an iterable of token ids (e.g. GenerationEngine.stream_tokens),
+  # yielded as soon as a token completes a word
+  detokenizer = IncrementalDetokenizer(idx2word, previous)
+  for token in tokens:
+    text = detokenizer.push(token)
+    if text:
+      yield text
+  text = detokenizer.flush()
+  if text:
+    yield text
+
+
+def detokenize(idx2word, tokens, previous=None):
+  return ''.join(stream_text(tokens, idx2word, previous))
@@ -0,0 +1,69 @@
+from __future__ import print_function
+import os
+import sys
+import json
+import time
+import argparse
+import torch
+import fastBPE
+import vocabulary
+import pytorch_engine
+import pytorch_export
+import pytorch_quantization
+from control_codes import control_code_prompt, read_control_codes
+
+parser = argparse.ArgumentParser(description='Code for exporting the encoder of a flat PyTorch checkpoint as a TorchScript module and checking it against the eager model')
+parser.add_argument('--pytorch_checkpoint', type=str, required=True,
+                    help='location of the flat PyTorch checkpoint, fp32 or int8 (see convert_tf_to_pytorch.py and quantize_pytorch.py)')
+parser.add_argument('--exported_encoder', type=str, required=True,
+                    help='location of the exported encoder, for --exported_encoder of the generation scripts')
+parser.add_argument('--freeze', action='store_true',
+                    help='freeze the scripted module: its weights become constants the graph passes can fold, but every process loading it keeps a private copy of them instead of sharing the memory-mapped checkpoint')
+parser.add_argument('--control_codes', type=str, default='training_data/common-crawl-en/abortion/generation_data/control_codes.jsonl',
+                    help='control_codes.jsonl with the control codes to compare the models on')
+parser.add_argument('--num_codes', type=int, default=8,
+                    help='number of control codes (the first ones of the file) to compare the models on')
+parser.add_argument('--generate_num', type=int, default=64,
+                    help='number of tokens both models generate greedily after every control code')
+parser.add_argument('--threads', type=int, default=0,
+                    help='number of intra-op threads; defaults to 0 which is one per physical core')
+
+args = parser.parse_args()
+device = pytorch_engine.setup_device('cpu', args.threads)
+
+if not os.path.isfile(args.pytorch_checkpoint):
+  print('INFO :: PyTorch checkpoint not found. Please verify location of the flat checkpoint.')
+  sys.exit(1)
+
+word2idx = vocabulary.load_vocabulary('vocab').ids
+bpe = fastBPE.fastBPE('codes', 'vocab')
+
+encoder, softmax = pytorch_quantization.load_any_model(args.pytorch_checkpoint, device)
+encoder.eval()
+softmax.eval()
+print('INFO :: Exporting the encoder of', args.pytorch_checkpoint, 'to', args.exported_encoder)
+with torch.no_grad():
+  pytorch_export.export_encoder(encoder, args.exported_encoder, freeze=args.freeze)
+# the saved module, as the generation scripts load it
+exported = pytorch_export.load_exported(args.exported_encoder, encoder, device)
+
+codes = read_control_codes(args.control_codes)[:args.num_codes]
+prompts = [control_code_prompt(code) for code in codes]
+prompts = [[word2idx[token] for token in ' \n '.join(bpe.apply([prompt])).split(' ')] for prompt in prompts]
+
+# decoding: prefill of the batched (left-padded) prompts and one cached step per token, timed for both models
+continuations, seconds = [], []
+for model in [encoder, exported]:
+  engine = pytorch_engine.GenerationEngine(model, softmax)
+  start = time.time()
+  continuations.append(engine.generate_batch(prompts, max_new_tokens=args.generate_num))
+  seconds.append(time.time() - start)
+
+# prefill: the next-token distributions of the exported model along the eager continuations
+sequences = [prompt + continuation for prompt, continuation in zip(prompts, continuations[0])]
+report = pytorch_quantization.perplexity_drift((encoder, softmax), (exported, softmax), sequences)
+report['identical_continuations'] = sum(a == b for a, b in zip(*continuations))
+report['eager_seconds'] = seconds[0]
+report['exported_seconds'] = seconds[1]
+report['exported_bytes'] = os.path.getsize(args.exported_encoder)
+print(json.dumps(report, indent=2))
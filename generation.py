@@ -5,6 +5,7 @@ import os
 import numpy as np
 tf.enable_eager_execution()
 import transformer
+import vocabulary
 import argparse
 import pdb
 import sys
@@ -15,7 +16,7 @@ from tensorflow.python.ops import math_ops
 from tensorflow.python.ops import embedding_ops
 import fastBPE
 import platform
-from control_codes import CONTROL_CODES
+from control_codes import load_catalog
 
 use_py3 = platform.python_version()[0] == '3'
 
@@ -50,18 +51,17 @@ os.environ['PYTHONHASHSEED'] = str(args.seed)
 np.random.seed(args.seed)
 
 # load the vocabulary from file
-vocab = open('vocab').read().decode(encoding='utf-8').split('\n') if not use_py3 else open('vocab', encoding='utf-8').read().split('\n')
-vocab = list(map(lambda x: x.split(' ')[0], vocab)) + ['<unk>'] + ['\n']
-print ('{} unique words'.format(len(vocab)))
+# it is compiled once into vocab.bin, which is memory-mapped (and shared with the other processes) from then on
+idx2word = vocabulary.load_vocabulary('vocab')
+print ('{} unique words'.format(len(idx2word)))
 
 # length of the vocabulary
-vocab_size = len(vocab)
+vocab_size = len(idx2word)
 
 # define the numericalization map
 # idx2word maps the numericalized ID to the word
 # word2idx maps the word to the numericalized ID
-word2idx = {u:i for i, u in enumerate(vocab)}
-idx2word = np.array(vocab)
+word2idx = idx2word.ids
 
 
 
@@ -166,6 +166,12 @@ predict_fn = tf.contrib.predictor.from_estimator(estimator_model, serving_input_
 # load BPE codes
 bpe = fastBPE.fastBPE('codes', 'vocab')
 
+def tokenize(prompt):
+    return [word2idx[i] for i in ' \n '.join(bpe.apply(prompt.split('\\n'))).split(' ')]
+
+# the control codes the model was trained with, tokenised once (see control_codes.ControlCodeCatalog)
+catalog = load_catalog(tokenize)
+
 temperature = args.temperature
 nucleusprob = args.nucleus
 penalty = args.penalty
@@ -173,16 +179,24 @@ topk = args.topk
 
 while True:
     prompt = raw_input('ENTER PROMPT: ') if not use_py3 else input('ENTER PROMPT: ')
-    prompt = prompt.split('\\n') # split on newlines if provided
+    if not prompt.strip():
+        continue
 
-    # tokenize provided prompt
-    split_prompt = ' \n '.join(bpe.apply(prompt))
-    split_prompt = split_prompt.split(' ')
-
-    #if not any(split_prompt[0] == x for x in CONTROL_CODES.keys()):
-    print('NOTE! You will only get good results if you are starting from a pre-defined control code, e.g. "nuclear energy CON waste". '
-          'Learned control codes can be found in the control_codes.jsonl in the training data.')
-    text = [word2idx[i] for i in split_prompt]
+    # tokenize provided prompt (newlines given as \\n are split on); a known control code comes with its
+    # token ids from the catalog, a prompt that cannot be tokenized is rejected before the model runs
+    try:
+        code, text = catalog.encode(prompt)
+    except ValueError as e:
+        print('ERROR ::', e)
+        continue
+    if len(text) >= args.generate_num:
+        print('ERROR :: the prompt has {} tokens, --generate_num allows less than {}'.format(len(text), args.generate_num))
+        continue
+    if code is None:
+        suggestions = catalog.suggest(prompt)
+        print('NOTE! You will only get good results if you are starting from a pre-defined control code, e.g. "{}". '
+              'Learned control codes can be found in the control_codes.jsonl in the training data.'.format(
+                '", "'.join(suggestions) if suggestions else 'nuclear energy CON waste'))
 
     # pad with 0s and create a mini-batch of 2 (arbitrary, for ease of code)
     padded_text = text + [0] * (args.generate_num - len(text))
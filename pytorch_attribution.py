@@ -0,0 +1,225 @@
+from __future__ import print_function
+import heapq
+import argparse
+import collections
+import numpy as np
+import torch
+import fastBPE
+import vocabulary
+import pytorch_engine
+import pytorch_scoring
+import pytorch_quantization
+import pytorch_prefix_cache
+import pytorch_transformer
+from control_codes import load_catalog
+
+# attribution of a sentence to the argument control code (topic, stance and aspect) it most likely follows,
+# i.e. the code behind which the sentence has the lowest negative log-likelihood (NLL)
+# instead of scoring the sentence behind each of the thousands of codes of generation_data/control_codes.jsonl,
+# the search goes down the hierarchy of the codes: the topics (`nuclear energy`) are scored first, then the stances
+# of the best topics (`nuclear energy CON`) and only then the aspects of the best stances;
+# the candidates of a parent are batched along their prefix trie and share the keys/values of their common prefix,
+# and the sentence is scored a chunk of tokens at a time: a candidate leaves the batch as soon as the NLL of the
+# part scored so far reaches the complete NLL of the worst candidate kept, since every further token only adds to it
+# (with top_topics and top_stances 0 every aspect is scored, which is exact and only saves by the pruning)
+
+Attribution = collections.namedtuple('Attribution', ['prompt', 'nll', 'ppl'])
+
+
+class BestScores(object):
+  # the k lowest complete scores so far; a candidate has to stay below bound() to get in
+  def __init__(self, k):
+    self.k = k
+    # max-heap of (-score, key)
+    self.heap = []
+
+  def bound(self):
+    return -self.heap[0][0] if len(self.heap) >= self.k else float('inf')
+
+  def add(self, score, key):
+    if len(self.heap) < self.k:
+      heapq.heappush(self.heap, (-score, key))
+    elif score < self.bound():
+      heapq.heapreplace(self.heap, (-score, key))
+
+  def sorted(self):
+    # (score, key) from best to worst
+    return sorted((-score, key) for score, key in self.heap)
+
+
+class CodeScorer(object):
+  # NLL of a sentence (token ids) behind candidate control codes, batch_size candidates per forward pass,
+  # chunk_size sentence tokens at a time (see pytorch_scoring.token_nll for vocab_chunk_size)
+  def __init__(self, engine, batch_size=16, chunk_size=8, vocab_chunk_size=16384):
+    self.engine = engine
+    self.batch_size = batch_size
+    self.chunk_size = chunk_size
+    self.vocab_chunk_size = vocab_chunk_size
+    # (candidate, position) pairs that went through the encoder, to compare with exhaustive scoring
+    self.positions = 0
+
+  def score(self, codes, sentence, best):
+    # scores the sentence behind every code (a (key, token ids) pair) and adds the complete NLLs to best
+    for batch in pytorch_prefix_cache.prefix_batches([tokens for _, tokens in codes], self.batch_size):
+      self.score_batch([codes[i] for i in batch], sentence, best)
+
+  def score_batch(self, codes, sentence, best):
+    engine = self.engine
+    device = engine.device()
+    prompts = [tokens for _, tokens in codes]
+    if max(len(prompt) for prompt in prompts) + len(sentence) > engine.seq_length:
+      raise ValueError('a control code and the sentence do not fit into a window of %i' % engine.seq_length)
+
+    # the tokens all codes of the batch share (but for their last one) are encoded once for all rows,
+    # the rest of every code is left-padded like the prompts of a generation batch
+    prefix = pytorch_prefix_cache.common_prefix(prompts)[:min(len(prompt) for prompt in prompts) - 1]
+    prompts = [prompt[len(prefix):] for prompt in prompts]
+    max_len = max(len(prompt) for prompt in prompts)
+    tokens = torch.tensor([[engine.pad_id] * (max_len - len(prompt)) + list(prompt) for prompt in prompts],
+                          dtype=torch.long, device=device)
+    padding_mask = torch.tensor([[True] * (max_len - len(prompt)) + [False] * len(prompt) for prompt in prompts],
+                                dtype=torch.bool, device=device)
+    past = pytorch_transformer.KVCache(engine.encoder.num_layers)
+    engine.seed_prefix(past, prefix, len(codes))
+
+    with pytorch_engine.inference_mode():
+      # the last code token predicts the first token of the sentence
+      hidden = engine.encoder(engine.softmax(tokens, embed=True), past, padding_mask)[:, -1]
+      nll = pytorch_scoring.token_nll(engine.softmax, hidden, torch.full((len(codes),), sentence[0], device=device),
+                                      self.vocab_chunk_size)
+      self.positions += len(prefix) + len(codes) * max_len
+      # the row of the batch behind every row still scored
+      rows = torch.arange(len(codes), device=device)
+      for start in range(0, len(sentence) - 1, self.chunk_size):
+        keep = (nll < best.bound()).nonzero().squeeze(1)
+        if len(keep) == 0:
+          return
+        if len(keep) < len(rows):
+          past.select(keep)
+          nll = nll.index_select(0, keep)
+          rows = rows.index_select(0, keep)
+        chunk = sentence[start:min(start + self.chunk_size, len(sentence) - 1)]
+        targets = torch.tensor(sentence[start + 1:start + 1 + len(chunk)], dtype=torch.long, device=device)
+        inputs = torch.tensor([chunk], dtype=torch.long, device=device).expand(len(rows), -1)
+        hidden = engine.encoder(engine.softmax(inputs, embed=True), past)
+        nll = nll + pytorch_scoring.token_nll(engine.softmax, hidden.reshape(-1, hidden.shape[-1]),
+                                              targets.repeat(len(rows)), self.vocab_chunk_size).view(len(rows), -1).sum(1)
+        self.positions += len(rows) * len(chunk)
+
+    for row, score in zip(rows.tolist(), nll.tolist()):
+      best.add(score, codes[row][0])
+
+
+def code_hierarchy(catalog, sources=None):
+  # topic -> stance -> aspect -> ControlCode over the given sources of the catalog (all by default)
+  hierarchy = {}
+  for source, topics in catalog.index.items():
+    if sources and source not in sources:
+      continue
+    for topic, stances in topics.items():
+      for stance, aspects in stances.items():
+        hierarchy.setdefault(topic, {}).setdefault(stance, {}).update(aspects)
+  return hierarchy
+
+
+def attribute(scorer, catalog, sentence, top=5, top_topics=3, top_stances=2, sources=None):
+  # the top control codes of the catalog for the sentence (text), best first, as Attribution tuples
+  # top_topics topics and top_stances stances are expanded, 0 expands all of them without scoring the level
+  # raises ValueError for a sentence with pieces that are not in the vocabulary
+  try:
+    tokens = catalog.tokenize_text(sentence)
+  except KeyError as e:
+    raise ValueError('unknown token %s in "%s"' % (e, sentence))
+  if not tokens:
+    raise ValueError('the sentence is empty')
+  hierarchy = code_hierarchy(catalog, sources)
+
+  def tokenize(prompt):
+    try:
+      return catalog.tokenize_text(prompt)
+    except KeyError:
+      return None
+
+  def search(groups, keep):
+    # groups of (key, prompt tokens) candidates, ordered from the most to the least promising parent,
+    # so that the bound is tight early; returns the keep best (score, key), or all of them unscored for keep 0
+    if keep <= 0:
+      return [(0., key) for group in groups for key, _ in group]
+    best = BestScores(keep)
+    for group in groups:
+      group = [(key, prompt) for key, prompt in group if prompt is not None]
+      if group:
+        scorer.score(group, tokens, best)
+    return best.sorted()
+
+  topics = search([[(topic, tokenize(topic.replace('_', ' '))) for topic in sorted(hierarchy)]], top_topics)
+  stances = search([[((topic, stance), tokenize(topic.replace('_', ' ') + ' ' + stance))
+                     for stance in sorted(hierarchy[topic])] for _, topic in topics], top_stances)
+  aspects = search([[(code.prompt, code.tokens) for _, code in sorted(hierarchy[topic][stance].items())]
+                    for _, (topic, stance) in stances], top)
+  return [Attribution(prompt, score, float(np.exp(score / len(tokens)))) for score, prompt in aspects]
+
+
+def main():
+  parser = argparse.ArgumentParser(description='Attributes sentences to the argument control codes they most likely follow')
+  parser.add_argument('--pytorch_checkpoint', type=str, required=True,
+                      help='location of the flat PyTorch checkpoint, fp32 or int8 (see convert_tf_to_pytorch.py and quantize_pytorch.py)')
+  parser.add_argument('--top', type=int, default=5,
+                      help='number of control codes to print per sentence')
+  parser.add_argument('--top_topics', type=int, default=3,
+                      help='number of topics whose stances are scored; 0 scores the stances of all topics')
+  parser.add_argument('--top_stances', type=int, default=2,
+                      help='number of stances whose aspects are scored; 0 scores the aspects of all stances')
+  parser.add_argument('--sources', type=str, nargs='+', default=None,
+                      help='only attribute to the control codes of these sources (the directories in training_data)')
+  parser.add_argument('--batch_size', type=int, default=16,
+                      help='number of candidate codes scored in one forward pass')
+  parser.add_argument('--chunk_size', type=int, default=8,
+                      help='number of sentence tokens scored per forward pass, between two pruning checks')
+  parser.add_argument('--seq_length', type=int, default=256,
+                      help='context of the model, a control code and the sentence have to fit into it')
+  parser.add_argument('--device', type=str, default=None,
+                      help='device to run the model on; defaults to cuda if available, else cpu')
+  parser.add_argument('--threads', type=int, default=0,
+                      help='number of intra-op threads on cpu; defaults to 0 which is one per physical core')
+  parser.add_argument('--prefix_cache_mb', type=int, default=1024,
+                      help='memory for the keys/values of already seen code prefixes; 0 disables the cache')
+  args = parser.parse_args()
+
+  device = pytorch_engine.setup_device(args.device, args.threads)
+  # the memory-mapped vocabulary (see vocabulary.py)
+  idx2word = vocabulary.load_vocabulary('vocab')
+  bpe = fastBPE.fastBPE('codes', 'vocab')
+
+  def tokenize(prompt):
+    return [idx2word.ids[token] for token in ' \n '.join(bpe.apply(prompt.split('\\n'))).split(' ')]
+
+  catalog = load_catalog(tokenize)
+  encoder, softmax = pytorch_quantization.load_any_model(args.pytorch_checkpoint, device)
+  encoder.eval()
+  softmax.eval()
+  prefix_cache = pytorch_prefix_cache.PrefixCache(args.prefix_cache_mb << 20) if args.prefix_cache_mb > 0 else None
+  engine = pytorch_engine.GenerationEngine(encoder, softmax, args.seq_length, prefix_cache=prefix_cache,
+                                           model_key=args.pytorch_checkpoint)
+  scorer = CodeScorer(engine, args.batch_size, args.chunk_size)
+  num_codes = sum(len(aspects) for stances in code_hierarchy(catalog, args.sources).values()
+                  for aspects in stances.values())
+
+  while True:
+    sentence = input('ENTER SENTENCE: ')
+    if not sentence.strip():
+      continue
+    scorer.positions = 0
+    try:
+      attributions = attribute(scorer, catalog, sentence, args.top, args.top_topics, args.top_stances, args.sources)
+    except ValueError as e:
+      print('ERROR ::', e)
+      continue
+    print('SENTENCE: {}'.format(sentence))
+    for attribution in attributions:
+      print(u'{} ppl = {}'.format(attribution.prompt, round(attribution.ppl, 6)))
+    print('({} of {} control codes, {} positions encoded)'.format(len(attributions), num_codes, scorer.positions))
+
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,171 @@
+from __future__ import print_function
+import collections
+import threading
+import torch
+import pytorch_transformer
+import pytorch_sampling
+import pytorch_stopping
+from pytorch_engine import inference_mode
+
+# continuous batching: a fixed number of sequence slots is decoded together, one token per slot and iteration
+# a sequence leaves its slot as soon as it is done and a waiting request is prefilled into the free slot
+# before the next iteration, so short arguments do not hold the batch back while long ones keep going
+
+
+class SequenceRequest(object):
+  # a prompt (token ids) to generate for, with its own sampling parameters (see pytorch_sampling.build_processors)
+  # it is done after one of stop_ids, after max_new_tokens tokens or, with repeat_ngram > 0, once its newest
+  # repeat_ngram-gram occurred max_ngram_repeats times (see pytorch_stopping)
+  # on_token is called with every generated token, on_done with the list of all of them, or with None if the
+  # request failed (error then holds the reason)
+  def __init__(self, tokens, max_new_tokens=256, temperature=0., nucleus=0., topk=0, penalty=1.2, stop_ids=(),
+               repeat_ngram=0, max_ngram_repeats=3, on_token=None, on_done=None):
+    self.tokens = list(tokens)
+    self.max_new_tokens = max_new_tokens
+    self.temperature = temperature
+    self.sampling = {'temperature': temperature, 'nucleus': nucleus, 'topk': topk, 'penalty': penalty}
+    self.stop_ids = set(stop_ids)
+    self.repetition = pytorch_stopping.NgramRepetition(repeat_ngram, max_ngram_repeats) if repeat_ngram > 0 else None
+    self.on_token = on_token
+    self.on_done = on_done
+    self.generated = []
+    self.error = None
+
+
+class ContinuousBatcher(object):
+  # iteration-level scheduler over a pytorch_engine.GenerationEngine with `slots` sequence slots
+  # requests can be submitted from any thread, the iterations run in the thread calling step/run
+  def __init__(self, engine, slots=8, banned_mask=None):
+    self.engine = engine
+    self.slots = slots
+    self.banned_mask = None if banned_mask is None else banned_mask.to(engine.device())
+    self.past = pytorch_transformer.SlotKVCache(engine.encoder.num_layers, slots, engine.seq_length)
+    self.waiting = collections.deque()
+    self.condition = threading.Condition()
+    # per active slot, in the row order of the cache: the request, its logits processors and its next input token
+    self.running = []
+    self.processors = []
+    self.inputs = []
+    # counters behind metrics()
+    self.steps = 0
+    self.busy = 0
+    self.generated_tokens = 0
+    self.finished = 0
+    self.failed = 0
+
+  def submit(self, request):
+    with self.condition:
+      self.waiting.append(request)
+      self.condition.notify()
+
+  def admit(self, request):
+    # prefill all of the prompt but its last token (from the engine's prefix cache where possible)
+    # into a free slot, the last token is the first input of the slot
+    vocab_size = self.engine.softmax.w.shape[0]
+    past = self.engine.seed_prefix(pytorch_transformer.KVCache(self.engine.encoder.num_layers), request.tokens[:-1])
+    processors = pytorch_sampling.build_processors(vocab_size, banned_mask=self.banned_mask, **request.sampling)
+    processors.reset(torch.tensor([request.tokens], dtype=torch.long, device=self.engine.device()))
+    self.past.admit(past.keys if past.seen else None, past.values if past.seen else None)
+    self.running.append(request)
+    self.processors.append(processors)
+    self.inputs.append(request.tokens[-1])
+
+  def evict(self, row):
+    last = len(self.running) - 1
+    self.past.evict(row)
+    for slots in (self.running, self.processors, self.inputs):
+      slots[row] = slots[last]
+      slots.pop()
+
+  def fail(self, request, error):
+    # a failing request is answered with None, the others keep going
+    print('ERROR :: request failed:', error)
+    request.error = str(error) or type(error).__name__
+    self.failed += 1
+    if request.on_done is not None:
+      request.on_done(None)
+
+  def step(self):
+    # one iteration: fill the free slots from the queue, decode one token for every slot and free the finished ones
+    # returns False if there was nothing to do
+    with self.condition:
+      admitted = []
+      while self.waiting and len(self.running) + len(admitted) < self.slots:
+        admitted.append(self.waiting.popleft())
+    for request in admitted:
+      try:
+        self.admit(request)
+      except Exception as e:
+        self.fail(request, e)
+    if not self.running:
+      return bool(admitted)
+
+    device = self.engine.device()
+    try:
+      logits = self.engine.forward(torch.tensor(self.inputs, dtype=torch.long, device=device).unsqueeze(1), self.past,
+                                   positions=-1)
+    except Exception as e:
+      # the cache of every slot may be half updated, so all of them fail
+      for row in reversed(range(len(self.running))):
+        request = self.running[row]
+        self.evict(row)
+        self.fail(request, e)
+      return True
+
+    done, failed = [], []
+    with inference_mode():
+      for row, (request, processors) in enumerate(zip(self.running, self.processors)):
+        try:
+          chosen = pytorch_sampling.choose(processors(logits[row:row + 1]), request.temperature)
+          processors.update(chosen)
+          token = int(chosen[0])
+          request.generated.append(token)
+          self.inputs[row] = token
+          if request.on_token is not None:
+            request.on_token(token)
+        except Exception as e:
+          failed.append((row, e))
+          continue
+        if token in request.stop_ids or len(request.generated) >= request.max_new_tokens or \
+            (request.repetition is not None and request.repetition.update(token)):
+          done.append((row, None))
+
+    self.steps += 1
+    self.busy += len(self.running)
+    self.generated_tokens += len(self.running) - len(failed)
+    # from the last row on, so that the rows moved into freed slots are the ones still running
+    for row, error in sorted(done + failed, key=lambda finished: finished[0], reverse=True):
+      request = self.running[row]
+      self.evict(row)
+      if error is not None:
+        self.fail(request, error)
+        continue
+      self.finished += 1
+      if request.on_done is not None:
+        request.on_done(request.generated)
+    return True
+
+  def run(self):
+    # iterates until every submitted request is done
+    while self.step():
+      pass
+
+  def serve_forever(self):
+    # iterates for good, sleeping while there is nothing to do (e.g. in a worker thread of a server)
+    while True:
+      if not self.step():
+        with self.condition:
+          while not self.waiting:
+            self.condition.wait()
+
+  def metrics(self):
+    return {
+      'slots': self.slots,
+      'active_slots': len(self.running),
+      'queue_depth': len(self.waiting),
+      'slot_utilisation': self.busy / float(max(self.steps * self.slots, 1)),
+      'steps': self.steps,
+      'generated_tokens': self.generated_tokens,
+      'finished_requests': self.finished,
+      'failed_requests': self.failed,
+    }
@@ -0,0 +1,80 @@
+from __future__ import print_function
+import io
+import os
+import glob
+import json
+import tqdm
+import pytorch_prefix_cache
+from control_codes import CONTROL_CODE_FILES, control_code_prompt, read_control_codes
+
+# non-interactive generation: k samples for every control code of one or more control_codes.jsonl files,
+# written to a JSONL file as soon as each batch is done, so that an interrupted run can be resumed
+
+# the generation_data/control_codes.jsonl files of all sources and topics
+DEFAULT_CONTROL_CODES = CONTROL_CODE_FILES
+
+
+def control_code_files(patterns):
+  # the files matching the given paths or glob patterns, in a stable order
+  files = []
+  for pattern in patterns:
+    matches = sorted(glob.glob(pattern))
+    if not matches:
+      raise ValueError('no control code file matches %s' % pattern)
+    files += [match for match in matches if match not in files]
+  return files
+
+
+def bulk_jobs(files, num_samples):
+  # one job per control code and sample: (source file, control code, sample index)
+  return [(path, code, sample) for path in files for code in read_control_codes(path) for sample in range(num_samples)]
+
+
+def job_key(path, prompt, sample):
+  return (path, prompt, sample)
+
+
+def finished_jobs(output):
+  # keys of the jobs already written to the output file
+  # a last line cut off by an interruption is dropped from the file, so the run can append behind it
+  done = set()
+  if not os.path.exists(output):
+    return done
+  with io.open(output, 'rb+') as f:
+    data = f.read()
+    end = data.rfind(b'\n') + 1
+    if end < len(data):
+      f.truncate(end)
+  for line in data[:end].decode('utf-8').splitlines():
+    if line.strip():
+      record = json.loads(line)
+      done.add(job_key(record['source'], record['prompt'], record['sample']))
+  return done
+
+
+def generate_bulk(engine, tokenize, detokenize, files, output, num_samples=1, batch_size=8, generate_num=256,
+                  **sampling):
+  # generates with the (resident) engine for every job not in the output file yet and appends the results
+  # tokenize maps a prompt to token ids (e.g. ControlCodeCatalog.tokenize, which looks the known codes up),
+  # detokenize token ids to text; sampling goes to engine.generate_batch
+  # the jobs are batched along the prefix trie of their prompts, so a batch mostly shares its topic and stance
+  jobs = bulk_jobs(files, num_samples)
+  done = finished_jobs(output)
+  jobs = [job for job in jobs if job_key(job[0], control_code_prompt(job[1]), job[2]) not in done]
+  print('{} jobs, {} already done'.format(len(jobs) + len(done), len(done)))
+
+  prompts = [tokenize(control_code_prompt(code)) for _, code, _ in jobs]
+  batches = pytorch_prefix_cache.prefix_batches(prompts, batch_size)
+  with io.open(output, 'a', encoding='utf-8') as f:
+    for batch in tqdm.tqdm(batches):
+      # generate_num counts the prompt as well, like in the interactive mode
+      max_new_tokens = [max(1, generate_num - len(prompts[i])) for i in batch]
+      generated = engine.generate_batch([prompts[i] for i in batch], max_new_tokens, **sampling)
+      for i, tokens in zip(batch, generated):
+        path, code, sample = jobs[i]
+        record = dict(code, source=path, prompt=control_code_prompt(code), sample=sample,
+                      text=detokenize(tokens), num_tokens=len(tokens))
+        f.write(json.dumps(record, ensure_ascii=False) + u'\n')
+      # written out batch by batch, an interruption loses at most the running batch
+      f.flush()
+  return len(jobs)
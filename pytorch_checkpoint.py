@@ -0,0 +1,199 @@
+from __future__ import print_function
+import json
+import re
+import struct
+import warnings
+import numpy as np
+import torch
+import tqdm
+import pytorch_transformer
+
+# flat checkpoint format of the PyTorch engine:
+# an 8-byte little-endian header size, a JSON header with the model config and the dtype, shape and offset
+# of every tensor, then the raw tensor data with every tensor aligned to 64 bytes
+# loading memory-maps the file instead of reading it, so startup does not copy the weights and
+# all worker processes on one host share the same physical pages through the page cache
+
+ALIGNMENT = 64
+
+
+def aligned(nbytes):
+  return (nbytes + ALIGNMENT - 1) // ALIGNMENT * ALIGNMENT
+
+
+def nbytes(dtype, shape):
+  return int(np.prod(shape, dtype=np.int64)) * torch.tensor([], dtype=dtype).element_size()
+
+
+class FlatWriter(object):
+  # writes the tensors one at a time, in the order of `specs` (a list of name, dtype, shape),
+  # so that only one tensor has to be in memory while writing
+  def __init__(self, path, specs, config):
+    self.specs = list(specs)
+    self.index = 0
+    header = {'config': config, 'tensors': {}}
+    offset = 0
+    for name, dtype, shape in self.specs:
+      header['tensors'][name] = {'dtype': str(dtype).replace('torch.', ''), 'shape': list(shape), 'offset': offset}
+      offset += aligned(nbytes(dtype, shape))
+    encoded = json.dumps(header).encode('utf-8')
+    encoded += b' ' * (aligned(8 + len(encoded)) - 8 - len(encoded))
+
+    self.file = open(path, 'wb')
+    self.file.write(struct.pack('<Q', len(encoded)))
+    self.file.write(encoded)
+
+  def write(self, name, tensor):
+    expected_name, dtype, shape = self.specs[self.index]
+    if name != expected_name or tensor.dtype != dtype or list(tensor.shape) != list(shape):
+      raise ValueError('expected %s %s %s, got %s %s %s' % (expected_name, dtype, list(shape),
+                                                             name, tensor.dtype, list(tensor.shape)))
+    data = tensor.detach().cpu().contiguous().reshape(-1).view(torch.uint8).numpy()
+    self.file.write(data.tobytes())
+    self.file.write(b'\0' * (aligned(data.nbytes) - data.nbytes))
+    self.index += 1
+
+  def close(self):
+    if self.index != len(self.specs):
+      raise ValueError('only %i of %i tensors were written' % (self.index, len(self.specs)))
+    self.file.close()
+
+
+def save_flat(path, tensors, config):
+  # tensors is an (ordered) dict of name -> tensor
+  writer = FlatWriter(path, [(name, tensor.dtype, tensor.shape) for name, tensor in tensors.items()], config)
+  for name, tensor in tensors.items():
+    writer.write(name, tensor)
+  writer.close()
+
+
+def read_header(path):
+  # the size and the content of the JSON header of a flat checkpoint
+  with open(path, 'rb') as f:
+    header_size = struct.unpack('<Q', f.read(8))[0]
+    return header_size, json.loads(f.read(header_size).decode('utf-8'))
+
+
+def load_flat(path):
+  # returns the config and a dict of name -> tensor, every tensor a read-only view into the memory-mapped file
+  header_size, header = read_header(path)
+
+  data = np.memmap(path, dtype=np.uint8, mode='r', offset=8 + header_size)
+  with warnings.catch_warnings():
+    # the weights are never written to, so a read-only buffer is fine
+    warnings.simplefilter('ignore')
+    data = torch.from_numpy(data)
+
+  tensors = {}
+  for name, spec in header['tensors'].items():
+    dtype = getattr(torch, spec['dtype'])
+    offset = spec['offset']
+    tensors[name] = data[offset:offset + nbytes(dtype, spec['shape'])].view(dtype).reshape(spec['shape'])
+  return header['config'], tensors
+
+
+def model_config(encoder, softmax):
+  return {
+    'num_layers': encoder.num_layers,
+    'd_model_size': encoder.d_model_size,
+    'num_heads': encoder.layer0.multi_head_attention.num_heads,
+    'dff': encoder.layer0.ffn[0].out_features,
+    'vocab_size': softmax.w.shape[0],
+  }
+
+
+def empty_model(config):
+  # encoder and tied softmax on the meta device: no memory is allocated and no parameter is initialised,
+  # the parameters are expected to be assigned afterwards (e.g. load_state_dict(..., assign=True))
+  with torch.device('meta'):
+    encoder = pytorch_transformer.Encoder(num_layers=config['num_layers'], d_model_size=config['d_model_size'],
+                                          num_heads=config['num_heads'], dff=config['dff'])
+    softmax = pytorch_transformer.TiedEmbeddingSoftmax(config['vocab_size'], config['d_model_size'])
+  return encoder, softmax
+
+
+def save_model(path, encoder, softmax):
+  tensors = [('softmax.' + name, tensor) for name, tensor in softmax.state_dict().items()]
+  tensors += [('encoder.' + name, tensor) for name, tensor in encoder.state_dict().items()]
+  save_flat(path, dict(tensors), model_config(encoder, softmax))
+
+
+def load_model(path, device='cpu'):
+  # returns the encoder and the tied softmax of a flat checkpoint
+  # on cpu the parameters stay memory-mapped, on other devices they are copied over once
+  config, tensors = load_flat(path)
+  if config.get('quantization'):
+    raise ValueError('%s is a %s checkpoint, load it with pytorch_quantization.load_quantized_model'
+                     % (path, config['quantization']))
+  encoder, softmax = empty_model(config)
+  softmax.load_state_dict({name[len('softmax.'):]: tensor for name, tensor in tensors.items()
+                           if name.startswith('softmax.')}, assign=True)
+  encoder.load_state_dict({name[len('encoder.'):]: tensor for name, tensor in tensors.items()
+                           if name.startswith('encoder.')}, assign=True)
+  return encoder.to(device), softmax.to(device)
+
+
+# parameters of an encoder layer in the alphabetical order of their TensorFlow variable names
+TF_LAYER_PARAMETERS = [
+  'layernorm1.bias', 'layernorm1.weight', 'layernorm2.bias', 'layernorm2.weight',
+  'multi_head_attention.Wq.bias', 'multi_head_attention.Wq.weight',
+  'multi_head_attention.Wk.bias', 'multi_head_attention.Wk.weight',
+  'multi_head_attention.Wv.bias', 'multi_head_attention.Wv.weight',
+  'multi_head_attention.dense.bias', 'multi_head_attention.dense.weight',
+  'ffn.0.bias', 'ffn.0.weight', 'ffn.2.bias', 'ffn.2.weight',
+]
+
+
+def tf_variable_names(shape_map):
+  # maps the parameter names of the PyTorch model to the TensorFlow variable names, in one pass over the variables
+  # the first layer is scoped `.../encoder_layer/...`, the others `.../encoder_layer_<i>/...`,
+  # so the number of layers follows from the checkpoint
+  layers = {}
+  final_layernorm = {}
+  for name in shape_map:
+    if 'Adagrad' in name:
+      continue
+    match = re.search(r'layer(?:_(\d+))?/', name)
+    if match:
+      layers.setdefault(int(match.group(1) or 0), []).append(name)
+    elif name.startswith('encoder/') and name.endswith('/gamma'):
+      final_layernorm['encoder.layernorm.weight'] = name
+    elif name.startswith('encoder/') and name.endswith('/beta'):
+      final_layernorm['encoder.layernorm.bias'] = name
+
+  if sorted(layers) != list(range(len(layers))):
+    raise ValueError('layers %s of the checkpoint are not numbered consecutively' % sorted(layers))
+  names = [('softmax.w', 'w'), ('softmax.b', 'b')]
+  for i in range(len(layers)):
+    variables = sorted(layers[i])
+    if len(variables) != len(TF_LAYER_PARAMETERS):
+      raise ValueError('expected %i variables in layer %i, found %i' % (len(TF_LAYER_PARAMETERS), i, len(variables)))
+    names += [('encoder.layer%i.%s' % (i, parameter), variable) for parameter, variable in zip(TF_LAYER_PARAMETERS, variables)]
+  names += sorted(final_layernorm.items())
+  return names, len(layers)
+
+
+def convert_tf_checkpoint(reader, path, num_heads=16):
+  # streams the weights of a TensorFlow checkpoint reader (pywrap_tensorflow.NewCheckpointReader)
+  # into a flat checkpoint, one tensor at a time: the memory peak is the largest tensor, not the model
+  # the shapes and the number of layers come from the checkpoint's variable map
+  shape_map = reader.get_variable_to_shape_map()
+  names, num_layers = tf_variable_names(shape_map)
+  # TensorFlow stores dense kernels as (in, out), PyTorch as (out, in)
+  shapes = [list(reversed(shape_map[variable])) if name != 'softmax.w' else list(shape_map[variable])
+            for name, variable in names]
+  config = {
+    'num_layers': num_layers,
+    'd_model_size': shape_map['w'][1],
+    'num_heads': num_heads,
+    'dff': shape_map[dict(names)['encoder.layer0.ffn.0.weight']][1],
+    'vocab_size': shape_map['w'][0],
+  }
+
+  writer = FlatWriter(path, [(name, torch.float32, shape) for (name, _), shape in zip(names, shapes)], config)
+  for name, variable in tqdm.tqdm(names):
+    tensor = torch.from_numpy(np.asarray(reader.get_tensor(variable), dtype=np.float32))
+    writer.write(name, tensor if name == 'softmax.w' else tensor.t())
+    del tensor
+  writer.close()
+  return config
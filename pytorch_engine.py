@@ -0,0 +1,300 @@
+from __future__ import print_function
+import copy
+import torch
+import pytorch_transformer
+import pytorch_sampling
+import pytorch_prefix_cache
+import pytorch_stopping
+
+# no autograd bookkeeping at all during generation (falls back to no_grad on older PyTorch versions)
+inference_mode = getattr(torch, 'inference_mode', torch.no_grad)
+
+
+def setup_device(device=None, threads=0, interop_threads=0):
+  # returns the device to run on, cuda if available unless one is given, and sets up inference-only execution
+  # on cpu, threads/interop_threads set the intra-/inter-op thread pools (0 keeps the PyTorch default of
+  # one intra-op thread per physical core); this has to happen before the model runs for the first time
+  device = torch.device(device if device else ('cuda' if torch.cuda.is_available() else 'cpu'))
+  torch.set_grad_enabled(False)
+  if device.type == 'cpu':
+    if threads > 0:
+      torch.set_num_threads(threads)
+    if interop_threads > 0:
+      torch.set_num_interop_threads(interop_threads)
+    # denormal floats are very slow on cpu and do not matter for the logits
+    torch.set_flush_denormal(True)
+  return device
+
+
+def draft_encoder(encoder, num_layers):
+  # a shallow draft model for speculative decoding: the first num_layers layers and the final layernorm
+  # of the encoder, sharing its weights (and its positional encoding), so it costs no extra memory
+  draft = copy.copy(encoder)
+  draft.num_layers = num_layers
+  return draft
+
+
+class GenerationEngine(object):
+  # batched generation on top of pytorch_transformer.Encoder and the tied embedding/softmax
+  # prompts of different lengths are left-padded, so the newest token of every row sits in the last column
+  # and a single forward pass per step serves the whole batch
+  # with a pytorch_prefix_cache.PrefixCache, prompt prefixes encoded once are reused across calls;
+  # model_key tells the models sharing the cache apart (e.g. the checkpoint path)
+  # past seq_length tokens, every new token re-encodes a window of the control code and the newest tokens like the
+  # original generation loop (see pytorch_transformer.ReencodedWindowKVCache); with sliding_window, a bounded cache
+  # slides over the generated tokens instead (see pytorch_transformer.SlidingWindowKVCache): constant cost per token,
+  # but the tokens past the window only approximate the re-encoded ones and can differ from them
+  def __init__(self, encoder, softmax, seq_length=256, pad_id=0, prefix_cache=None, model_key=None, sliding_window=False):
+    self.encoder = encoder
+    self.softmax = softmax
+    self.seq_length = seq_length
+    self.pad_id = pad_id
+    self.prefix_cache = prefix_cache
+    self.model_key = id(encoder) if model_key is None else model_key
+    self.sliding_window = sliding_window
+
+  def device(self):
+    return self.softmax.w.device
+
+  def window_cache(self, num_layers):
+    # the cache of a generation that can run past seq_length (see sliding_window)
+    if self.sliding_window:
+      return pytorch_transformer.SlidingWindowKVCache(num_layers, self.seq_length)
+    return pytorch_transformer.ReencodedWindowKVCache(num_layers, self.seq_length)
+
+  def fit_window(self, prompt):
+    # a prompt longer than the window is cut like the re-encoded window: its first token (the control code)
+    # and its seq_length - 1 newest tokens
+    if len(prompt) <= self.seq_length:
+      return list(prompt)
+    return list(prompt[:1]) + list(prompt[len(prompt) - self.seq_length + 1:])
+
+  def left_pad(self, prompts):
+    # the (batch, longest prompt) tokens of the left-padded prompts and their padding mask
+    max_len = max(len(prompt) for prompt in prompts)
+    tokens = torch.tensor([[self.pad_id] * (max_len - len(prompt)) + list(prompt) for prompt in prompts],
+                          dtype=torch.long, device=self.device())
+    padding_mask = torch.tensor([[True] * (max_len - len(prompt)) + [False] * len(prompt) for prompt in prompts],
+                                dtype=torch.bool, device=self.device())
+    return tokens, padding_mask
+
+  def forward(self, tokens, past=None, padding_mask=None, positions=None):
+    with inference_mode():
+      seq_len = tokens.shape[1]
+      if isinstance(past, pytorch_transformer.ReencodedWindowKVCache):
+        # past the window, the whole re-encoded window goes through the encoder
+        tokens, padding_mask = past.inputs(tokens, padding_mask)
+      embedded = self.softmax(tokens, embed=True)
+      # the hidden states of the new tokens
+      embedded = self.encoder(embedded, past, padding_mask)[:, -seq_len:]
+      return self.softmax(embedded, embed=False, positions=positions)
+
+  def seed_prefix(self, past, prefix, batch_size=1):
+    # fills an empty cache with the keys/values of the prefix tokens, shared by all batch_size rows
+    # whatever part of the prefix the prefix cache holds is not encoded again, the result goes into the cache
+    if not prefix:
+      return past
+    if len(prefix) >= self.seq_length:
+      raise ValueError('a prefix of %i tokens does not fit into a window of %i' % (len(prefix), self.seq_length))
+    length, keys, values = (0, None, None) if self.prefix_cache is None else \
+      self.prefix_cache.longest(self.model_key, prefix)
+    if length:
+      # the cached tensors are never written to: the cache appends by concatenation
+      past.keys, past.values, past.seen = list(keys), list(values), length
+    if length < len(prefix):
+      with inference_mode():
+        self.encoder(self.softmax(torch.tensor([prefix[length:]], device=self.device()), embed=True), past)
+      if self.prefix_cache is not None:
+        self.prefix_cache.put(self.model_key, prefix, past.keys, past.values)
+    if batch_size > 1:
+      past.keys = [k.expand(batch_size, -1, -1, -1) for k in past.keys]
+      past.values = [v.expand(batch_size, -1, -1, -1) for v in past.values]
+    if isinstance(past, pytorch_transformer.ReencodedWindowKVCache):
+      past.record(torch.tensor([prefix], dtype=torch.long, device=self.device()).expand(batch_size, -1))
+    return past
+
+  def generate_batch(self, prompts, max_new_tokens=256, temperature=0., nucleus=0., topk=0, penalty=1.2,
+                     banned_mask=None, stop_ids=(), repeat_ngram=0, max_ngram_repeats=3):
+    # prompts is a list of token id lists, returns the list of generated token ids of every prompt
+    # see stream_batch for the arguments
+    outputs = [[] for _ in prompts]
+    for next_tokens, active in self.stream_batch(prompts, max_new_tokens, temperature, nucleus, topk, penalty,
+                                                 banned_mask, stop_ids, repeat_ngram, max_ngram_repeats):
+      for output, token, running in zip(outputs, next_tokens.tolist(), active.tolist()):
+        if running:
+          output.append(token)
+    return outputs
+
+  def stream_tokens(self, prompt, max_new_tokens=256, **kwargs):
+    # generator over the token ids generated for a single prompt, yielded as they are decoded
+    # (see detokenization.stream_text for their text); kwargs as in stream_batch
+    for next_tokens, active in self.stream_batch([prompt], max_new_tokens, **kwargs):
+      if bool(active[0]):
+        yield int(next_tokens[0])
+
+  def stream_batch(self, prompts, max_new_tokens=256, temperature=0., nucleus=0., topk=0, penalty=1.2,
+                   banned_mask=None, stop_ids=(), repeat_ngram=0, max_ngram_repeats=3, inspect=None):
+    # generator over the decoding steps of a batch of prompts (token id lists): yields the (batch,) tensor of
+    # the tokens chosen at every step and the (batch,) mask of the rows that were still generating at that step
+    # sampling follows pytorch_sampling.build_processors, banned_mask is a precomputed vocab_mask
+    # a row stops after emitting one of stop_ids (which is kept, see pytorch_stopping.stop_token_ids) or after
+    # max_new_tokens tokens, which is either one limit for all rows or a list with one limit per row;
+    # with repeat_ngram > 0 a row also stops once its newest repeat_ngram-gram occurred max_ngram_repeats times
+    # finished rows are dropped from the batch (and its cache), the batch stops once every row did
+    # inspect, if given, is called with the processed logits of the running rows before every choice
+    # (e.g. to show the top candidates)
+    device = self.device()
+    batch_size = len(prompts)
+    # the repetition penalty counts every token of the prompts, also the ones cut off to fit the window
+    processors = pytorch_sampling.build_processors(self.softmax.w.shape[0], temperature, nucleus, topk, penalty,
+                                                   None if banned_mask is None else banned_mask.to(device))
+    processors.reset(*self.left_pad(prompts))
+    prompts = [self.fit_window(prompt) for prompt in prompts]
+    # with a prefix cache, the prefix all prompts share (but for their last token) is taken from it,
+    # only the rest of every prompt goes through the encoder
+    prefix = [] if self.prefix_cache is None else \
+      pytorch_prefix_cache.common_prefix(prompts)[:min(len(prompt) for prompt in prompts) - 1]
+    prompts = [prompt[len(prefix):] for prompt in prompts]
+    tokens, padding_mask = self.left_pad(prompts)
+
+    # a window that runs past seq_length keeps the first token of every row (the start of its control code)
+    past = self.window_cache(self.encoder.num_layers)
+    self.seed_prefix(past, prefix, batch_size)
+
+    stop = torch.tensor(list(stop_ids), dtype=torch.long, device=device)
+    limits = [max_new_tokens] * batch_size if isinstance(max_new_tokens, int) else list(max_new_tokens)
+    limits = torch.tensor(limits, dtype=torch.long, device=device)
+    repetition = [pytorch_stopping.NgramRepetition(repeat_ngram, max_ngram_repeats) for _ in range(batch_size)] \
+      if repeat_ngram > 0 else None
+
+    # the row of the original batch behind every row still generating
+    rows = torch.arange(batch_size, device=device)
+    for step in range(int(limits.max())):
+      logits = processors(self.forward(tokens, past, padding_mask, positions=-1))
+      if inspect is not None:
+        inspect(logits)
+      chosen = pytorch_sampling.choose(logits, temperature)
+      processors.update(chosen)
+      # the rows that are done only get padding
+      next_tokens = torch.full((batch_size,), self.pad_id, dtype=torch.long, device=device).index_copy(0, rows, chosen)
+      active = torch.zeros(batch_size, dtype=torch.bool, device=device).index_fill(0, rows, True) & (limits > step)
+      yield next_tokens, active
+
+      done = torch.isin(chosen, stop) | (limits.index_select(0, rows) <= step + 1)
+      if repetition is not None:
+        done |= torch.tensor([detector.update(token) for detector, token in zip(repetition, chosen.tolist())],
+                             dtype=torch.bool, device=device)
+      if done.all():
+        break
+      if done.any():
+        # finished rows stop costing compute: they leave the cache and the processors' state
+        keep = (~done).nonzero().squeeze(1)
+        past.select(keep)
+        processors.select(keep)
+        rows = rows.index_select(0, keep)
+        chosen = chosen.index_select(0, keep)
+        if repetition is not None:
+          repetition = [repetition[i] for i in keep.tolist()]
+      tokens = chosen.unsqueeze(1)
+      padding_mask = None
+
+  def generate_speculative(self, prompt, draft_encoder, draft_softmax=None, num_draft_tokens=4, max_new_tokens=256,
+                           temperature=0., nucleus=0., topk=0, penalty=1.2, banned_mask=None, stop_ids=(),
+                           repeat_ngram=0, max_ngram_repeats=3):
+    # speculative decoding of a single prompt (a list of token ids): the draft model proposes num_draft_tokens
+    # tokens one by one, the full model scores all of them in one forward pass and keeps the longest prefix
+    # that passes rejection sampling, plus one token of its own; the output follows the same distribution
+    # as generate_batch, and is the same when decoding greedily; stop_ids and the repetition abort as in stream_batch
+    # returns the generated token ids and the acceptance statistics
+    device = self.device()
+    draft_softmax = self.softmax if draft_softmax is None else draft_softmax
+    if banned_mask is not None:
+      banned_mask = banned_mask.to(device)
+    vocab_size = self.softmax.w.shape[0]
+    processors = pytorch_sampling.build_processors(vocab_size, temperature, nucleus, topk, penalty, banned_mask)
+    draft_processors = pytorch_sampling.build_processors(vocab_size, temperature, nucleus, topk, penalty, banned_mask)
+    processors.reset(torch.tensor([prompt], dtype=torch.long, device=device))
+    # a prompt longer than the window is encoded without its middle (see fit_window), the draft processors
+    # still count all of it
+    history = list(prompt)
+    prompt = self.fit_window(prompt)
+
+    # both caches hold every token of `sequence` but (at least) the last one
+    past = self.window_cache(self.encoder.num_layers)
+    draft_past = pytorch_transformer.KVCache(draft_encoder.num_layers)
+    sequence = list(prompt)
+    stop_ids = set(stop_ids)
+    repetition = pytorch_stopping.NgramRepetition(repeat_ngram, max_ngram_repeats) if repeat_ngram > 0 else None
+    looping = False
+    stats = {'steps': 0, 'proposed': 0, 'accepted': 0}
+
+    def probabilities(logits):
+      return torch.softmax(logits, dim=-1) if temperature > 0 else None
+
+    while len(sequence) - len(prompt) < max_new_tokens:
+      pending = sequence[past.seen:]
+      # speculation needs the draft tokens to fit into the window, past it the full model decodes alone
+      num_draft = min(num_draft_tokens, max_new_tokens - (len(sequence) - len(prompt)) - 1,
+                      self.seq_length - past.seen - len(pending))
+
+      drafted, draft_probs = [], []
+      if num_draft > 0:
+        draft_processors.reset(torch.tensor([history + sequence[len(prompt):]], dtype=torch.long, device=device))
+        draft_tokens = sequence[draft_past.seen:]
+        for _ in range(num_draft):
+          with inference_mode():
+            embedded = draft_encoder(draft_softmax(torch.tensor([draft_tokens], device=device), embed=True), draft_past)
+            logits = draft_processors(draft_softmax(embedded, embed=False, positions=-1))
+          token = pytorch_sampling.choose(logits, temperature)
+          draft_processors.update(token)
+          drafted.append(int(token[0]))
+          draft_probs.append(probabilities(logits))
+          draft_tokens = drafted[-1:]
+
+      # scores of the pending tokens' successor and of every draft token, in one pass
+      logits = self.forward(torch.tensor([pending + drafted], device=device), past,
+                            positions=slice(len(pending) - 1, None))
+      accepted = []
+      for i in range(len(drafted) + 1):
+        target = processors(logits[:, i])
+        rejected = False
+        if i == len(drafted):
+          # every draft token was accepted, the full model adds one more
+          token = int(pytorch_sampling.choose(target, temperature)[0])
+        elif temperature == 0:
+          token = int(target.argmax(dim=-1)[0])
+          rejected = token != drafted[i]
+        else:
+          p, q = probabilities(target)[0], draft_probs[i][0]
+          token = drafted[i]
+          if float(torch.rand(())) >= float(p[token] / q[token]):
+            # rejected: sample from the part of p that q does not cover
+            rejected = True
+            residual = torch.clamp(p - q, min=0)
+            token = int(torch.multinomial(residual if float(residual.sum()) > 0 else p, 1)[0])
+        accepted.append(token)
+        processors.update(torch.tensor([token], device=device))
+        if i < len(drafted) and not rejected:
+          stats['accepted'] += 1
+        if i == len(drafted) or rejected or token in stop_ids:
+          break
+
+      stats['steps'] += 1
+      stats['proposed'] += len(drafted)
+      accepted = accepted[:max_new_tokens - (len(sequence) - len(prompt))]
+      if repetition is not None:
+        end = next((i + 1 for i, token in enumerate(accepted) if repetition.update(token)), None)
+        looping = end is not None
+        accepted = accepted[:end]
+      sequence += accepted
+      # roll both caches back to the accepted tokens
+      past.truncate(min(past.seen, len(sequence) - 1))
+      draft_past.truncate(min(draft_past.seen, len(sequence) - 1))
+      if looping or any(token in stop_ids for token in accepted):
+        break
+
+    generated = sequence[len(prompt):]
+    end = next((i + 1 for i, token in enumerate(generated) if token in stop_ids), len(generated))
+    stats['acceptance_rate'] = stats['accepted'] / float(max(stats['proposed'], 1))
+    stats['tokens_per_step'] = len(generated[:end]) / float(max(stats['steps'], 1))
+    return generated[:end], stats
@@ -0,0 +1,215 @@
+from __future__ import print_function
+import json
+import math
+from typing import List, Optional, Tuple
+import torch
+import pytorch_transformer
+
+# export of the encoder as a TorchScript module for the prefill and decode steps of the generation engine
+# the eager pytorch_transformer.Encoder looks its 48 layers up by name, builds its masks from numpy scalars and
+# threads the cache objects through every layer; InferenceEncoder computes the same with the layers in a ModuleList,
+# Python float scales and the keys/values of the cache as plain per-layer tensor lists, so that it can be scripted
+# the saved module runs on the (memory-mapped) weights of the eager encoder, see load_exported; a frozen module
+# carries its weights as constants instead, which lets the graph passes fold and fuse the ops around them, but
+# they are a private copy of every process
+
+
+class InferenceLayer(torch.nn.Module):
+  # the weights of an EncoderLayer (shared, not copied), without its forward, which TorchScript could not compile
+  def __init__(self, layer):
+    super(InferenceLayer, self).__init__()
+    attention = layer.multi_head_attention
+    self.Wq = attention.Wq
+    self.Wk = attention.Wk
+    self.Wv = attention.Wv
+    self.dense = attention.dense
+    self.ffn = layer.ffn
+    self.layernorm1 = layer.layernorm1
+    self.layernorm2 = layer.layernorm2
+
+
+class InferenceEncoder(torch.nn.Module):
+  # pytorch_transformer.Encoder for inference, written for TorchScript; it shares the weights of the encoder
+  # forward takes the embedded new tokens, their positions, the padding of every key they attend to (or None)
+  # and the keys/values of the earlier positions (empty lists for a prefill), and returns the hidden states
+  # with the keys/values of all positions, the earlier ones followed by the new ones
+  # decode_columns is the decode step of the caches that write into preallocated buffers instead
+
+  def __init__(self, encoder):
+    super(InferenceEncoder, self).__init__()
+    self.layers = torch.nn.ModuleList([InferenceLayer(getattr(encoder, 'layer%i' % i)) for i in range(encoder.num_layers)])
+    self.layernorm = encoder.layernorm
+    self.register_buffer('pos_encoding', encoder.pos_encoding.clone())
+    attention = encoder.layer0.multi_head_attention
+    self.num_heads = attention.num_heads
+    self.depth = attention.depth
+    self.d_model_size = encoder.d_model_size
+    self.embedding_scale = math.sqrt(encoder.d_model_size)
+    self.attention_scale = math.sqrt(attention.depth)
+
+  def split_into_heads(self, x, batch_size: int):
+    return x.reshape(batch_size, -1, self.num_heads, self.depth).permute([0, 2, 1, 3])
+
+  def forward(self, x, positions, padding_mask: Optional[torch.Tensor], past_keys: List[torch.Tensor],
+              past_values: List[torch.Tensor]) -> Tuple[torch.Tensor, List[torch.Tensor], List[torch.Tensor]]:
+    batch_size = x.shape[0]
+    seq_len = x.shape[1]
+    past_len = past_keys[0].shape[2] if len(past_keys) > 0 else 0
+    # the same masks as the eager encoder, added to the attention logits one after the other
+    mask = torch.triu(torch.ones(seq_len, past_len + seq_len, device=x.device), past_len + 1) * -1e9
+    padding = None if padding_mask is None else padding_mask[:, None, None, :] * -1e9
+
+    x = x * self.embedding_scale + self.pos_encoding[0, positions]
+    keys: List[torch.Tensor] = []
+    values: List[torch.Tensor] = []
+    for i, layer in enumerate(self.layers):
+      normed = layer.layernorm1(x)
+      q = self.split_into_heads(layer.Wq(normed), batch_size)
+      k = self.split_into_heads(layer.Wk(normed), batch_size)
+      v = self.split_into_heads(layer.Wv(normed), batch_size)
+      if past_len > 0:
+        k = torch.cat((past_keys[i], k), dim=2)
+        v = torch.cat((past_values[i], v), dim=2)
+      keys.append(k)
+      values.append(v)
+
+      logits = torch.matmul(q, k.permute(0, 1, 3, 2)) / self.attention_scale + mask
+      if padding is not None:
+        logits = logits + padding
+      attended = torch.matmul(torch.softmax(logits, dim=-1), v).permute([0, 2, 1, 3])
+      x = x + layer.dense(attended.reshape(batch_size, -1, self.d_model_size))
+      x = x + layer.ffn(layer.layernorm2(x))
+    return self.layernorm(x), keys, values
+
+  @torch.jit.export
+  def decode_columns(self, x, positions, padding_mask: Optional[torch.Tensor], keys: List[torch.Tensor],
+                     values: List[torch.Tensor], columns, width: int) -> torch.Tensor:
+    # one new token per row: its keys/values are written into column `columns[row]` of the per-layer
+    # (rows or more, heads, window, depth) key/value buffers, in place, and it attends to their first `width`
+    # columns (as pytorch_transformer.SlotKVCache and a full SlidingWindowKVCache do); returns the hidden states
+    batch_size = x.shape[0]
+    rows = torch.arange(batch_size, device=x.device)
+    padding = None if padding_mask is None else padding_mask[:, None, None, :] * -1e9
+
+    x = x * self.embedding_scale + self.pos_encoding[0, positions]
+    for i, layer in enumerate(self.layers):
+      normed = layer.layernorm1(x)
+      q = self.split_into_heads(layer.Wq(normed), batch_size)
+      k = self.split_into_heads(layer.Wk(normed), batch_size)
+      v = self.split_into_heads(layer.Wv(normed), batch_size)
+      keys[i][rows, :, columns] = k[:, :, 0]
+      values[i][rows, :, columns] = v[:, :, 0]
+      k = keys[i][:batch_size, :, :width]
+      v = values[i][:batch_size, :, :width]
+
+      logits = torch.matmul(q, k.permute(0, 1, 3, 2)) / self.attention_scale
+      if padding is not None:
+        logits = logits + padding
+      attended = torch.matmul(torch.softmax(logits, dim=-1), v).permute([0, 2, 1, 3])
+      x = x + layer.dense(attended.reshape(batch_size, -1, self.d_model_size))
+      x = x + layer.ffn(layer.layernorm2(x))
+    return self.layernorm(x)
+
+
+def export_encoder(encoder, path, freeze=False):
+  # scripts (and with freeze, freezes) the encoder and saves it with its configuration; returns the module
+  module = torch.jit.script(InferenceEncoder(encoder).eval())
+  if freeze:
+    module = torch.jit.freeze(module, preserved_attrs=['decode_columns'])
+  attention = encoder.layer0.multi_head_attention
+  config = {'num_layers': encoder.num_layers, 'd_model_size': encoder.d_model_size,
+            'num_heads': attention.num_heads, 'max_position': int(encoder.pos_encoding.shape[1]), 'frozen': freeze}
+  torch.jit.save(module, path, _extra_files={'config.json': json.dumps(config)})
+  return module
+
+
+def share_weights(module, encoder):
+  # points the parameters and buffers (and packed int8 weights) of a loaded module that is not frozen at those
+  # of the encoder, so that it does not keep a copy of them next to the memory-mapped checkpoint
+  submodules = dict(module.named_modules())
+  for name, source in InferenceEncoder(encoder).named_modules():
+    target = submodules[name]
+    for attribute, tensor in list(source.named_parameters(recurse=False)) + list(source.named_buffers(recurse=False)):
+      setattr(target, attribute, tensor)
+    if getattr(source, 'packed', None) is not None:
+      target.packed = source.packed
+  return module
+
+
+class ExportedEncoder(object):
+  # runs an exported encoder in place of the eager one of a GenerationEngine, for every cache of pytorch_transformer:
+  # without a cache, with a KVCache, a ReencodedWindowKVCache and a SlidingWindowKVCache until its window is full,
+  # the keys/values only ever grow at the end, which is what the forward of the exported module computes; the
+  # slot cache of continuous batching and a full sliding window overwrite a column of them per token instead,
+  # which decode_columns computes; anything else (e.g. positions past those of the export) is left to the eager
+  # encoder, and so are draft models, which share its layers
+  def __init__(self, module, encoder, config):
+    self.module = module
+    self.encoder = encoder
+    self.num_layers = config['num_layers']
+    self.num_heads = config['num_heads']
+    self.depth = config['d_model_size'] // config['num_heads']
+    self.max_position = config['max_position']
+    if self.num_layers != encoder.num_layers or config['d_model_size'] != encoder.d_model_size:
+      raise ValueError('the exported encoder does not match the model')
+
+  def mode(self, past, seq_len):
+    # 'append' for the forward of the module, 'columns' for its decode_columns, None for the eager encoder
+    if past is None:
+      return 'append' if seq_len <= self.max_position else None
+    if past.max_positions(seq_len) > self.max_position:
+      return None
+    if type(past) in (pytorch_transformer.KVCache, pytorch_transformer.ReencodedWindowKVCache):
+      return 'append'
+    if type(past) is pytorch_transformer.SlidingWindowKVCache:
+      if past.seen + seq_len <= past.window:
+        return 'append'
+      if past.seen >= past.window and seq_len == 1:
+        return 'columns'
+    if type(past) is pytorch_transformer.SlotKVCache and seq_len == 1:
+      return 'columns'
+    return None
+
+  def __call__(self, x, past=None, padding_mask=None):
+    seq_len = x.shape[1]
+    mode = self.mode(past, seq_len)
+    if mode is None:
+      return self.encoder(x, past, padding_mask)
+    if mode == 'columns':
+      return self.decode_columns(x, past, padding_mask)
+    # the bookkeeping of the cache (positions and padding of the keys) stays in Python, it is cheap
+    if past is not None:
+      positions, padding_mask = past.begin(seq_len, padding_mask, x.device)
+    elif padding_mask is not None:
+      positions = pytorch_transformer.padded_positions(padding_mask, torch.zeros(x.shape[0], dtype=torch.long,
+                                                                                 device=x.device))
+    else:
+      positions = torch.arange(seq_len, device=x.device).unsqueeze(0)
+    keys = [] if past is None or past.keys[0] is None else list(past.keys)
+    values = [] if past is None or past.values[0] is None else list(past.values)
+    hidden, keys, values = self.module(x, positions, padding_mask, keys, values)
+    if past is not None:
+      past.keys, past.values = keys, values
+    return hidden
+
+  def decode_columns(self, x, past, padding_mask):
+    positions, padding_mask = past.begin(1, padding_mask, x.device)
+    if type(past) is pytorch_transformer.SlotKVCache:
+      # the buffers of all slots, allocated on the first token if no prompt had a prefix to admit
+      for layer in range(self.num_layers):
+        past.allocate(layer, x.new_empty(0, self.num_heads, 0, self.depth))
+      columns, width = past.columns, past.width
+    else:
+      columns, width = past.slot, past.window
+    return self.module.decode_columns(x, positions, padding_mask, list(past.keys), list(past.values), columns, width)
+
+
+def load_exported(path, encoder, device='cpu'):
+  # the exported encoder at path, falling back to the eager encoder of the same model (see ExportedEncoder)
+  # unless it is frozen, the module runs on the weights of the encoder, the ones loaded with it are dropped
+  extra_files = {'config.json': ''}
+  module = torch.jit.load(path, map_location=device, _extra_files=extra_files)
+  config = json.loads(extra_files['config.json'])
+  if not config['frozen']:
+    module = share_weights(module, encoder)
+  return ExportedEncoder(module, encoder, config)
@@ -1,18 +1,25 @@
 from __future__ import print_function
 import torch
 import os
-import tqdm
 import pdb
 import numpy as np
 import platform
 import hashlib
-import pytorch_transformer
-import re
+import pytorch_sampling
+import pytorch_engine
+import pytorch_checkpoint
+import pytorch_quantization
+import pytorch_prefix_cache
+import pytorch_bulk
+import pytorch_stopping
+import pytorch_restricted_head
+import pytorch_export
+import detokenization
+import vocabulary
+import sys
 import argparse
-import tensorflow as tf
 import fastBPE
-from tensorflow.python import pywrap_tensorflow
-from control_codes import CONTROL_CODES
+from control_codes import load_catalog
 
 use_py3 = platform.python_version()[0] == '3'
 
@@ -22,7 +29,9 @@ parser.add_argument('--model_path', type=str, required=True,
 parser.add_argument('--seed', type=int, default=1337,
                                         help='random seed for TensorFlow, numpy and PythonHash')
 parser.add_argument('--generate_num', type=int, default=256,
-                                        help='number of tokens to generate')
+                                        help='number of tokens to generate; past 256 tokens, every token re-encodes the control code and the newest tokens (see --sliding_window)')
+parser.add_argument('--sliding_window', action='store_true',
+                                        help='past 256 tokens, slide a bounded cache over the generated tokens instead of re-encoding the window for every token; much faster, but an approximation: the tokens past the window differ from the re-encoded ones')
 parser.add_argument('--temperature', type=float, default=0,
                                         help='temperature for sampling distribution; 0 means greedy')
 parser.add_argument('--nucleus', type=float, default=0.,
@@ -35,61 +44,69 @@ parser.add_argument('--print_once', action='store_true',
                                         help='the completion is printed only at the end; not every word')
 parser.add_argument('--topn', type=int, default=0,
                                         help='print top-n candidates during generations; defaults to 0 which is no printing')
+parser.add_argument('--device', type=str, default=None,
+                                        help='device to run the model on, e.g. cpu or cuda:0; defaults to cuda if available, else cpu')
+parser.add_argument('--threads', type=int, default=0,
+                                        help='number of intra-op threads on cpu; defaults to 0 which is one per physical core')
+parser.add_argument('--interop_threads', type=int, default=0,
+                                        help='number of inter-op threads on cpu; defaults to 0 which is the PyTorch default')
+parser.add_argument('--draft_layers', type=int, default=0,
+                                        help='speculative decoding with the first n layers of the model as the draft model; defaults to 0 which is no speculative decoding')
+parser.add_argument('--draft_tokens', type=int, default=4,
+                                        help='number of tokens the draft model proposes per step of speculative decoding')
+parser.add_argument('--prefix_cache_mb', type=int, default=1024,
+                                        help='memory for the keys/values of already seen prompt prefixes (e.g. a control code typed again); 0 disables the cache')
+parser.add_argument('--output', type=str, default=None,
+                                        help='bulk mode: instead of prompting, generate for every control code of --control_codes and append the results to this JSONL file; an existing file is resumed')
+parser.add_argument('--control_codes', type=str, nargs='+', default=[pytorch_bulk.DEFAULT_CONTROL_CODES],
+                                        help='bulk mode: control_codes.jsonl files or glob patterns; defaults to all files in training_data')
+parser.add_argument('--num_samples', type=int, default=1,
+                                        help='bulk mode: number of samples per control code')
+parser.add_argument('--batch_size', type=int, default=8,
+                                        help='bulk mode: number of prompts generated together')
+parser.add_argument('--stop_at_sentence_end', action='store_true',
+                                        help='stop a sequence after the first token ending a sentence (., ! or ?)')
+parser.add_argument('--stop_at_newline', action='store_true',
+                                        help='stop a sequence after the first newline')
+parser.add_argument('--repeat_ngram', type=int, default=0,
+                                        help='abort a sequence stuck in a loop: once its newest n-gram of this length occurred --max_ngram_repeats times; defaults to 0 which is no abort')
+parser.add_argument('--max_ngram_repeats', type=int, default=3,
+                                        help='number of occurrences of an n-gram that count as a loop, see --repeat_ngram')
+parser.add_argument('--restricted_head', type=str, default=None,
+                                        help='token ids (see pytorch_restricted_head.py) the softmax is restricted to; all other tokens are never generated')
+parser.add_argument('--exported_encoder', type=str, default=None,
+                                        help='run the encoder exported from the same checkpoint (see export_pytorch.py) instead of the eager one')
+parser.add_argument('--quantize', action='store_true',
+                                        help='run on cpu with int8 weights (see quantize_pytorch.py for the perplexity drift); the quantised checkpoint is stored next to the fp32 one')
 
 args = parser.parse_args()
+if args.quantize and args.device and torch.device(args.device).type != 'cpu':
+  parser.error('--quantize only runs on cpu')
+device = pytorch_engine.setup_device('cpu' if args.quantize else args.device, args.threads, args.interop_threads)
 torch.manual_seed(args.seed)
 torch.cuda.manual_seed_all(args.seed)
 os.environ['PYTHONHASHSEED'] = str(args.seed)
 np.random.seed(args.seed)
 
 # load the vocabulary from file
-vocab = open('vocab').read().decode(encoding='utf-8').split('\n') if not use_py3 else open('vocab', encoding='utf-8').read().split('\n')
-vocab = list(map(lambda x: x.split(' ')[0], vocab)) + ['<unk>'] + ['\n']
-print ('{} unique words'.format(len(vocab)))
+# it is compiled once into vocab.bin, which is memory-mapped (and shared with the other processes) from then on
+idx2word = vocabulary.load_vocabulary('vocab')
+print ('{} unique words'.format(len(idx2word)))
 
 # length of the vocabulary
-vocab_size = len(vocab)
+vocab_size = len(idx2word)
 
 # define the numericalization map
 # idx2word maps the numericalized ID to the word
 # word2idx maps the word to the numericalized ID
-word2idx = {u:i for i, u in enumerate(vocab)}
-idx2word = np.array(vocab)
+word2idx = idx2word.ids
 embedding_dim = 1280
 
-class TiedEmbeddingSoftmax(torch.nn.Module):
-
-  def __init__(self, vocab_size=vocab_size, embedding_size=embedding_dim, **kwargs):
-    super(TiedEmbeddingSoftmax, self).__init__()
-    self.w = torch.nn.Parameter(torch.zeros(vocab_size, embedding_size))
-    self.b = torch.nn.Parameter(torch.zeros(vocab_size))
-
-  def forward(self, inputs, embed=True):
-    if embed:
-      return torch.nn.functional.embedding(inputs, self.w)
-    else:
-      return torch.tensordot(inputs, self.w.t(), 1) + self.b
-
-
-test_softmax = TiedEmbeddingSoftmax()
-test_encoder = pytorch_transformer.Encoder()
-
-def predict_fn(inputs):
-  with torch.no_grad():
-    embedded = torch.tensor(inputs['input_1']).cuda()
-    embedded = test_softmax(embedded, embed=True)
-    embedded = test_encoder(embedded)
-    embedded = test_softmax(embedded, embed=False)
-  return embedded
-
-
-
-
-
-
 bpe = fastBPE.fastBPE('codes', 'vocab')
 seq_length = min(args.generate_num, 256)
 pytorch_model_hash = hashlib.md5(args.model_path.encode('utf-8')).hexdigest()
+# the converted weights are stored as a flat checkpoint, which is memory-mapped when loading
+flat_checkpoint = pytorch_model_hash + '.flat'
 temperature = args.temperature
 nucleusprob = args.nucleus
 penalty = args.penalty
@@ -97,194 +114,161 @@ topk = args.topk
 
 # try to load the model from a (cached) PyTorch checkpoint
 # if one is not available, then create it by converting the weights
-if os.path.exists(pytorch_model_hash):
-  print('Found PyTorch checkpoint @', pytorch_model_hash)
+if os.path.exists(flat_checkpoint):
+  print('Found PyTorch checkpoint @', flat_checkpoint)
   print('Loading instead of converting from TensorFlow')
-  checkpoint = torch.load(pytorch_model_hash)
-  test_softmax.load_state_dict(checkpoint['softmax'])
-  test_encoder.load_state_dict(checkpoint['encoder'])
 
-  test_softmax.to('cuda')
-  test_encoder.to('cuda')
+elif os.path.exists(pytorch_model_hash):
+  # checkpoint stored by earlier versions of this script
+  print('Found PyTorch checkpoint @', pytorch_model_hash)
+  print('Storing it as', flat_checkpoint)
+  test_encoder, test_softmax = pytorch_checkpoint.empty_model({'num_layers': 48, 'd_model_size': embedding_dim, 'num_heads': 16,
+                                                               'dff': 8192, 'vocab_size': vocab_size})
+  checkpoint = torch.load(pytorch_model_hash, map_location='cpu')
+  test_softmax.load_state_dict(checkpoint['softmax'], assign=True)
+  test_encoder.load_state_dict(checkpoint['encoder'], assign=True)
+  pytorch_checkpoint.save_model(flat_checkpoint, test_encoder, test_softmax)
+  del checkpoint, test_encoder, test_softmax
 
 else:
   print('Could not find PyTorch checkpoint')
-  print('Converting weights and will store the PyTorch checkpoint as ', pytorch_model_hash)
+  print('Converting weights and will store the PyTorch checkpoint as ', flat_checkpoint)
+  # TensorFlow is only needed for the conversion
+  from tensorflow.python import pywrap_tensorflow
   chkpt_for_reader = '.'.join(args.model_path.split('.')[:-1])
   reader = pywrap_tensorflow.NewCheckpointReader(chkpt_for_reader)
-  test_softmax.w = torch.nn.Parameter(torch.tensor(reader.get_tensor('w')).to('cuda'))
-  test_softmax.b = torch.nn.Parameter(torch.tensor(reader.get_tensor('b')).to('cuda'))
-
-  list_of_variables = list(filter(lambda x: 'Adagrad' not in x, reader.get_variable_to_shape_map().keys()))
-
-  str2parameter = lambda x: torch.nn.Parameter(torch.tensor(reader.get_tensor(x)).t().to('cuda'))
-
-  test_encoder.layernorm.weight = str2parameter('encoder/layer_normalization_96/gamma')
-  test_encoder.layernorm.bias = str2parameter('encoder/layer_normalization_96/beta')
-  for i in tqdm.tqdm(range(48)):
-    if i==0:
-      layer_variables = sorted(filter(lambda x: 'layer/' in x, list_of_variables))
-    else:
-      layer_variables = sorted(filter(lambda x: 'layer_'+str(i)+'/' in x, list_of_variables))
-
-    current_layer = getattr(test_encoder, 'layer'+str(i))
-
-    current_layer.layernorm1.bias = str2parameter(layer_variables[0])
-    current_layer.layernorm1.weight = str2parameter(layer_variables[1])
-
-    current_layer.layernorm2.bias = str2parameter(layer_variables[2])
-    current_layer.layernorm2.weight = str2parameter(layer_variables[3])
-
-
-    current_layer.multi_head_attention.Wq.bias = str2parameter(layer_variables[4])
-    current_layer.multi_head_attention.Wq.weight = str2parameter(layer_variables[5])
-    current_layer.multi_head_attention.Wk.bias = str2parameter(layer_variables[6])
-    current_layer.multi_head_attention.Wk.weight = str2parameter(layer_variables[7])
-    current_layer.multi_head_attention.Wv.bias = str2parameter(layer_variables[8])
-    current_layer.multi_head_attention.Wv.weight = str2parameter(layer_variables[9])
-    current_layer.multi_head_attention.dense.bias = str2parameter(layer_variables[10])
-    current_layer.multi_head_attention.dense.weight = str2parameter(layer_variables[11])
-    current_layer.ffn[0].bias = str2parameter(layer_variables[12])
-    current_layer.ffn[0].weight = str2parameter(layer_variables[13])
-    current_layer.ffn[2].bias = str2parameter(layer_variables[14])
-    current_layer.ffn[2].weight = str2parameter(layer_variables[15])
-  torch.save({
-    'softmax': test_softmax.state_dict(),
-    'encoder': test_encoder.state_dict(),
-  }, pytorch_model_hash)
-
+  pytorch_checkpoint.convert_tf_checkpoint(reader, flat_checkpoint)
+
+if args.quantize:
+  # quantised once from the fp32 checkpoint, then loaded like it
+  quantized_checkpoint = pytorch_model_hash + '.int8.flat'
+  if not os.path.exists(quantized_checkpoint):
+    print('Quantising the weights to int8 and storing them as', quantized_checkpoint)
+    test_encoder, test_softmax = pytorch_quantization.quantize_model(*pytorch_checkpoint.load_model(flat_checkpoint))
+    pytorch_quantization.save_quantized_model(quantized_checkpoint, test_encoder, test_softmax)
+    del test_encoder, test_softmax
+  test_encoder, test_softmax = pytorch_quantization.load_quantized_model(quantized_checkpoint)
+else:
+  test_encoder, test_softmax = pytorch_checkpoint.load_model(flat_checkpoint, device)
 test_softmax.eval()
 test_encoder.eval()
+for parameter in list(test_softmax.parameters()) + list(test_encoder.parameters()):
+  parameter.requires_grad_(False)
+if args.restricted_head:
+  # only the given ids are projected onto, the draft model (sharing the softmax) is restricted as well
+  test_softmax = pytorch_restricted_head.RestrictedSoftmax(test_softmax,
+                                                           pytorch_restricted_head.load_head_ids(args.restricted_head))
+  print('Softmax restricted to {} of {} tokens'.format(len(test_softmax.ids), vocab_size))
+
+# the draft model is always made of the first layers of the eager encoder
+draft = pytorch_engine.draft_encoder(test_encoder, args.draft_layers) if args.draft_layers > 0 else None
+if args.exported_encoder:
+  test_encoder = pytorch_export.load_exported(args.exported_encoder, test_encoder, test_softmax.w.device)
+
+prefix_cache = pytorch_prefix_cache.PrefixCache(args.prefix_cache_mb << 20) if args.prefix_cache_mb > 0 else None
+engine = pytorch_engine.GenerationEngine(test_encoder, test_softmax, seq_length, prefix_cache=prefix_cache,
+                                         model_key=quantized_checkpoint if args.quantize else flat_checkpoint,
+                                         sliding_window=args.sliding_window)
+
+# if penalty (for repetition) is non-zero, the logits of tokens already in the sequence are discounted
+# newlines are penalized as well; if it prints too many new lines instead of continuing generating text,
+# you might want to exclude them
+#
+# disallow some tokens: <unk>, and Sco@@ because sometimes, when generating from reddit,
+# it tries to generate the Score (reddit Karma) immediately after generating the Title:
+# anything with the phrase `http` is disallowed as well, for demonstration purpose
+# the mask over the vocabulary is computed once here instead of on every step
+banned_mask = pytorch_sampling.vocab_mask(idx2word, words=['<unk>', 'Sco@@'], substrings=['http']).to(device)
+# temperature, repetition penalty, disallowed tokens and nucleus/topk pruning are applied by the engine
+# (see pytorch_sampling.build_processors)
+sampling = {'temperature': temperature, 'nucleus': nucleusprob, 'topk': topk, 'penalty': penalty, 'banned_mask': banned_mask}
+# per-sequence stop conditions besides --generate_num: the stop tokens are looked up in the vocabulary once
+stop_ids = set(pytorch_stopping.stop_token_ids(idx2word, args.stop_at_sentence_end, args.stop_at_newline))
+stopping = {'stop_ids': stop_ids, 'repeat_ngram': args.repeat_ngram, 'max_ngram_repeats': args.max_ngram_repeats}
+
+def tokenize(prompt):
+  return [word2idx[i] for i in ' \n '.join(bpe.apply(prompt.split('\\n'))).split(' ')]
+
+def detokenize(tokens):
+  return detokenization.detokenize(idx2word, tokens)
+
+# the control codes the model was trained with, tokenised once: prompts starting with one are checked and
+# tokenised by lookups (see control_codes.ControlCodeCatalog)
+catalog = load_catalog(tokenize)
+
+# with --topn, the most probable candidates of every step and the chosen token are printed
+def show_topn(logits):
+  top_logits, top_idx = torch.topk(logits[0], args.topn)
+  print('TOPN :: top-n alternatives:', [idx2word[_] for _ in top_idx[top_logits > -float('inf')].tolist()])
+
+def show_chosen(tokens):
+  for idx in tokens:
+    print('TOPN :: chosen word:', idx2word[idx])
+    yield idx
+
+if args.output:
+  # the model stays loaded for the whole run, the prompts come from the control code files
+  pytorch_bulk.generate_bulk(engine, catalog.tokenize, detokenize, pytorch_bulk.control_code_files(args.control_codes),
+                             args.output, args.num_samples, args.batch_size, args.generate_num, **sampling, **stopping)
+  sys.exit(0)
 
 
 
 
 while True:
   prompt = raw_input('ENTER PROMPT: ') if not use_py3 else input('ENTER PROMPT: ')
-  prompt = prompt.split('\\n') # split on newlines if provided
-
-  # tokenize provided prompt
-  split_prompt = ' \n '.join(bpe.apply(prompt))
-  split_prompt = split_prompt.split(' ')
-
-  #if not any(split_prompt[0] == x for x in CONTROL_CODES.keys()):
-  print('NOTE! You will only get good results if you are starting from a pre-defined control code, e.g. "nuclear energy CON waste". '
-        'Learned control codes can be found in the control_codes.jsonl in the training data.')
-  text = [word2idx[i] for i in split_prompt]
+  if not prompt.strip():
+    continue
 
-
-  # pad with 0s and create a mini-batch of 2 (arbitrary, for ease of code)
-  padded_text = text + [0] * (args.generate_num - len(text))
-  tokens_generated = np.tile(padded_text, (1,1))
+  # tokenize provided prompt (newlines given as \\n are split on); a known control code comes with its
+  # token ids from the catalog, a prompt that cannot be tokenized is rejected before the model runs
   try:
-    for token in range(len(text)-1, args.generate_num-1):
-      # get the logits from the prediction function
-      # the logic here is a bit convoluted because we are allowing generation past 512 tokens
-      # this is done by sliding the window over (past 512 tokens) and continuing prediction
-      # I'm sure this can be simplified (TODO)
-      if token <= seq_length:
-        prompt_logits = predict_fn({'input_1':tokens_generated[:, :seq_length]}).squeeze() / (temperature if temperature>0 else 1.)
-        _token = token if token < seq_length else -1
-      else:
-        _token = -1
-        end = token + 1
-        start = token - seq_length + 2
-        prompt_logits = predict_fn({'input_1':np.hstack((tokens_generated[:,0:1], tokens_generated[:,start:end]))}).squeeze() / (temperature if temperature>0 else 1.)
-
-      prompt_logits = prompt_logits.cpu().detach().numpy()
-
-      # if penalty (for repetition) is non-zero,
-      # discount the logits from already generated tokens
-      if penalty>0:
-          penalized_so_far = set()
-          for _ in range(token+1):
-             generated_token = tokens_generated[0][_]
-             # don't penalize newlines
-             # you could also choose not to penalize frequent words
-             # (which incidentally are sorted in the vocab file)
-             # but I don't do that
-             # if it prints too many new lines instead of continuing generating text,
-             # you might want to comment this out
-             #if idx2word[generated_token] == '\n':
-             #    continue
-             if generated_token in penalized_so_far:
-                 continue
-             penalized_so_far.add(generated_token)
-             prompt_logits[_token][generated_token] /= penalty
-
-      # disallow some tokens
-      prompt_logits[_token][word2idx['<unk>']] = -1e8
-
-      # sometimes, when generating from reddit,
-      # it tries to generate the Score (reddit Karma) immediately after generating the Title:
-      # to disallow this, we can just prevent it from generating Score
-      prompt_logits[_token][word2idx['Sco@@']] = -1e8
-
-
-      # compute probabilities from logits
-      prompt_probs = np.exp(prompt_logits[_token])
-      prompt_probs = prompt_probs / sum(prompt_probs)
-      pruned_list = np.argsort(prompt_probs)[::-1]
-      # if you are using nucleus prob, then compute the nucleus probability size
-      if nucleusprob > 0.:
-        minimum_topk = 1
-        nucleus = max(np.where(np.cumsum(np.sort(prompt_probs)[::-1])>nucleusprob)[0][0], minimum_topk)
-      elif topk > 0:
-        # we are over-loading notation here
-        # if you choose to specify a topk instead of a nucleus,
-        # we will hardcode the nucleus to be just that
-        nucleus = topk
-      else:
-        # if you specify neither nucleus or topk,
-        # then we will use the whole list
-        nucleus = len(pruned_list)
-
-      pruned_list = pruned_list[:nucleus]  
-      # if you want to disallow more complex tokens, you can do so here
-      # for instance, if you want to disallow anything with the phrase `http`,
-      # you can delete theme from the pruned_list
-      # you can comment this out, I'm keeping it in for demonstration purpose
-      tokens_to_disallow = []
-      for _ in range(len(pruned_list)):
-          if 'http' in idx2word[pruned_list[_]]:
-              tokens_to_disallow.append(_)
-      pruned_list = np.delete(pruned_list, tokens_to_disallow)
-
-      if args.topn > 0 :
-        print('TOPN :: top-n alternatives:', [idx2word[_] for _ in pruned_list[:args.topn]])
-
-      # if temperature is 0
-      # just pick the first (most probable) token
-      if temperature==0:
-          idx = pruned_list[0]
-      else:
-        # else,
-        # sample from the pruned_list with the logits
-        chosen_idx = torch.distributions.categorical.Categorical(logits=torch.tensor(np.expand_dims(prompt_logits[_token][pruned_list],0))).sample().numpy()[0]
-        idx = pruned_list[chosen_idx]
-
-      if args.topn > 0 :
-        print('TOPN :: chosen word:', idx2word[idx])
-
-      # assign the token for generation
-      tokens_generated[0][token+1] = idx
-
-      # clear screen if you want to
-      # os.system("clear")
-
-
-      tokens_generated_so_far = ' '.join([idx2word[c] for c in tokens_generated[0].squeeze()[:token+2]])
-      tokens_generated_so_far = re.sub('(@@ )', '', string=tokens_generated_so_far)
-      tokens_generated_so_far = re.sub('(@@ ?$)', '', string=tokens_generated_so_far)              
-
+    code, text = catalog.encode(prompt)
+  except ValueError as e:
+    print('ERROR ::', e)
+    continue
+  if len(text) >= args.generate_num:
+    print('ERROR :: the prompt has {} tokens, --generate_num allows less than {}'.format(len(text), args.generate_num))
+    continue
+  if code is None:
+    suggestions = catalog.suggest(prompt)
+    print('NOTE! You will only get good results if you are starting from a pre-defined control code, e.g. "{}". '
+          'Learned control codes can be found in the control_codes.jsonl in the training data.'.format(
+            '", "'.join(suggestions) if suggestions else 'nuclear energy CON waste'))
+
+  if draft is not None:
+    # speculative decoding produces several tokens per step, so the completion is printed once at the end
+    generated, stats = engine.generate_speculative(text, draft, num_draft_tokens=args.draft_tokens,
+                                                   max_new_tokens=args.generate_num - len(text), **sampling, **stopping)
+    print('---------------------------------------')
+    print(detokenize(text + generated))
+    print()
+    print('SPECULATIVE :: {accepted} of {proposed} draft tokens accepted ({acceptance_rate:.2f}), '
+          '{tokens_per_step:.2f} tokens per step of the full model'.format(**stats))
+    continue
+
+  # the engine decodes the completion token by token (see GenerationEngine.stream_tokens) and the text pieces
+  # the tokens finalise are printed as they come (see detokenization.stream_text)
+  tokens = engine.stream_tokens(text, args.generate_num - len(text), inspect=show_topn if args.topn > 0 else None,
+                                **sampling, **stopping)
+  if args.topn > 0:
+    tokens = show_chosen(tokens)
+  tokens_generated_so_far = detokenize(text)
+  if not args.print_once:
+    print('---------------------------------------')
+    sys.stdout.write(tokens_generated_so_far)
+    sys.stdout.flush()
+  try:
+    for new_text in detokenization.stream_text(tokens, idx2word, previous=text[-1]):
+      tokens_generated_so_far += new_text
       if not args.print_once:
-        print('---------------------------------------')
-        print(tokens_generated_so_far)
-        print()
+        sys.stdout.write(new_text)
+        sys.stdout.flush()
+    if not args.print_once:
+      print()
     print('---------------------------------------')            
     print(tokens_generated_so_far)
     print()
     
   except KeyboardInterrupt: #Exception as e:
     print('Continuing')
-
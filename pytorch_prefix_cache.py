@@ -0,0 +1,107 @@
+from __future__ import print_function
+import collections
+
+# every prompt starts with a control code such as `nuclear energy CON waste`, and many share its topic and stance
+# the keys/values of such prefixes are kept here, so the encoder only runs over the part of a prompt it has not seen
+
+
+class PrefixCache(object):
+  # keys/values of already encoded token prefixes of batch size 1, keyed by the model and the token ids
+  # bounded by the bytes of the cached tensors, the least recently used prefixes are evicted first
+  def __init__(self, max_bytes=1 << 30):
+    self.max_bytes = max_bytes
+    self.bytes = 0
+    self.entries = collections.OrderedDict()
+    self.hits = 0
+    self.misses = 0
+
+  def longest(self, model, tokens):
+    # the longest cached prefix of tokens: its length and its per-layer keys and values (0, None, None if none)
+    tokens = tuple(tokens)
+    for length in range(len(tokens), 0, -1):
+      key = (model, tokens[:length])
+      if key in self.entries:
+        self.entries.move_to_end(key)
+        self.hits += 1
+        keys, values, _ = self.entries[key]
+        return length, keys, values
+    self.misses += 1
+    return 0, None, None
+
+  def put(self, model, tokens, keys, values):
+    key = (model, tuple(tokens))
+    size = sum(k.numel() * k.element_size() + v.numel() * v.element_size() for k, v in zip(keys, values))
+    if key in self.entries or size > self.max_bytes:
+      return
+    self.entries[key] = (list(keys), list(values), size)
+    self.bytes += size
+    while self.bytes > self.max_bytes:
+      _, (_, _, evicted) = self.entries.popitem(last=False)
+      self.bytes -= evicted
+
+  def __len__(self):
+    return len(self.entries)
+
+
+class PrefixTrie(object):
+  # trie over the token ids of a set of prompts, to schedule prompts that share a prefix into the same batch
+  def __init__(self):
+    self.children = {}
+    # indices of the prompts ending at this node and the number of prompts below it
+    self.indices = []
+    self.size = 0
+
+  def insert(self, tokens, index):
+    node = self
+    node.size += 1
+    for token in tokens:
+      node = node.children.setdefault(token, PrefixTrie())
+      node.size += 1
+    node.indices.append(index)
+
+  def prompts(self):
+    # indices of all prompts below this node, depth first
+    indices = list(self.indices)
+    for token in sorted(self.children):
+      indices += self.children[token].prompts()
+    return indices
+
+  def batches(self, batch_size):
+    # the prompts in depth-first order, cut into batches of at most batch_size
+    # a subtree that fits into a batch is never split, so the prompts of a batch share as long a prefix as possible
+    batches = [[]]
+
+    def add(indices):
+      if len(batches[-1]) + len(indices) > batch_size:
+        batches.append([])
+      batches[-1].extend(indices)
+
+    def walk(node):
+      if node.size <= batch_size:
+        add(node.prompts())
+        return
+      for index in node.indices:
+        add([index])
+      for token in sorted(node.children):
+        walk(node.children[token])
+
+    walk(self)
+    return [batch for batch in batches if batch]
+
+
+def prefix_batches(prompts, batch_size):
+  # groups a list of prompts (token id lists) into batches of prompt indices along their prefix trie
+  trie = PrefixTrie()
+  for index, prompt in enumerate(prompts):
+    trie.insert(prompt, index)
+  return trie.batches(batch_size)
+
+
+def common_prefix(prompts):
+  # the longest token prefix shared by all prompts
+  prefix = []
+  for tokens in zip(*prompts):
+    if any(token != tokens[0] for token in tokens):
+      break
+    prefix.append(tokens[0])
+  return prefix
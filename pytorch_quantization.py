@@ -0,0 +1,167 @@
+from __future__ import print_function
+import torch
+import pytorch_checkpoint
+
+# int8 inference on cpu: the linear layers of the encoder and the tied embedding/softmax keep their weights
+# as int8 with one fp32 scale per output row (symmetric, no zero point), a quarter of the fp32 size
+# the matmuls run on the fbgemm int8 kernels with dynamically quantised activations,
+# the embedding lookup only dequantises the rows it gathers
+
+
+def quantize_rows(weight):
+  # symmetric per-row int8 quantisation, returns the int8 weight and the fp32 scale of every row
+  scale = weight.abs().amax(dim=1).clamp(min=1e-8) / 127.
+  return torch.round(weight / scale.unsqueeze(1)).clamp(-127, 127).to(torch.int8), scale
+
+
+def prepack(weight, scale, bias):
+  # packed weight of the int8 matmul kernel, built from the int8 rows and their scales
+  qweight = torch._make_per_channel_quantized_tensor(weight, scale.double(),
+                                                     torch.zeros_like(scale, dtype=torch.long), 0)
+  return torch.ops.quantized.linear_prepack(qweight, bias)
+
+
+class QuantizedLinear(torch.nn.Module):
+  # drop-in replacement for torch.nn.Linear with int8 weights
+  # the int8 weight, its scales and the bias are buffers, so they go into (and come from) a flat checkpoint;
+  # the packed weight of the kernel is rebuilt from them by pack()
+
+  def __init__(self, in_features, out_features):
+    super(QuantizedLinear, self).__init__()
+    self.in_features = in_features
+    self.out_features = out_features
+    self.register_buffer('weight', torch.zeros(out_features, in_features, dtype=torch.int8))
+    self.register_buffer('weight_scale', torch.ones(out_features))
+    self.register_buffer('bias', torch.zeros(out_features))
+    self.packed = None
+
+  @classmethod
+  def from_float(cls, linear):
+    quantized = cls(linear.in_features, linear.out_features)
+    weight, scale = quantize_rows(linear.weight.detach())
+    quantized.weight, quantized.weight_scale, quantized.bias = weight, scale, linear.bias.detach()
+    return quantized.pack()
+
+  def pack(self):
+    self.packed = prepack(self.weight, self.weight_scale, self.bias)
+    return self
+
+  def forward(self, inputs):
+    # reduce_range keeps the int8 products of the x86 kernels from saturating
+    return torch.ops.quantized.linear_dynamic(inputs, self.packed, True)
+
+
+class QuantizedTiedEmbeddingSoftmax(torch.nn.Module):
+  # pytorch_transformer.TiedEmbeddingSoftmax with the tied matrix stored as int8
+  # w keeps its name and shape, so code looking at softmax.w.shape or softmax.w.device is unaffected
+
+  def __init__(self, vocab_size=246534, embedding_size=1280):
+    super(QuantizedTiedEmbeddingSoftmax, self).__init__()
+    self.register_buffer('w', torch.zeros(vocab_size, embedding_size, dtype=torch.int8))
+    self.register_buffer('w_scale', torch.ones(vocab_size))
+    self.register_buffer('b', torch.zeros(vocab_size))
+    self.packed = None
+
+  @classmethod
+  def from_float(cls, softmax):
+    quantized = cls(*softmax.w.shape)
+    weight, scale = quantize_rows(softmax.w.detach())
+    quantized.w, quantized.w_scale, quantized.b = weight, scale, softmax.b.detach()
+    return quantized.pack()
+
+  def pack(self):
+    self.packed = prepack(self.w, self.w_scale, self.b)
+    return self
+
+  def forward(self, inputs, embed=True, positions=None):
+    if embed:
+      return self.w[inputs].float() * self.w_scale[inputs].unsqueeze(-1)
+    else:
+      if positions is not None:
+        inputs = inputs[:, positions]
+      return torch.ops.quantized.linear_dynamic(inputs, self.packed, True)
+
+
+def replace_linear_layers(encoder, make):
+  # swaps every torch.nn.Linear of the encoder (Wq, Wk, Wv, dense and the ffn) in place for make(linear)
+  for module in list(encoder.modules()):
+    for name, child in list(module.named_children()):
+      if isinstance(child, torch.nn.Linear):
+        setattr(module, name, make(child))
+  return encoder
+
+
+def quantize_model(encoder, softmax):
+  # int8 versions of an fp32 encoder (modified in place) and tied softmax
+  encoder = replace_linear_layers(encoder, QuantizedLinear.from_float)
+  return encoder, QuantizedTiedEmbeddingSoftmax.from_float(softmax)
+
+
+def save_quantized_model(path, encoder, softmax):
+  tensors = [('softmax.' + name, tensor) for name, tensor in softmax.state_dict().items()]
+  tensors += [('encoder.' + name, tensor) for name, tensor in encoder.state_dict().items()]
+  config = pytorch_checkpoint.model_config(encoder, softmax)
+  config['quantization'] = 'int8'
+  pytorch_checkpoint.save_flat(path, dict(tensors), config)
+
+
+def load_quantized_model(path):
+  # counterpart of pytorch_checkpoint.load_model for a checkpoint written by save_quantized_model
+  # the int8 weights are memory-mapped like the fp32 ones, only the packed kernel weights are copies
+  config, tensors = pytorch_checkpoint.load_flat(path)
+  if config.get('quantization') != 'int8':
+    raise ValueError('%s is not an int8 checkpoint' % path)
+  encoder, _ = pytorch_checkpoint.empty_model(config)
+  with torch.device('meta'):
+    encoder = replace_linear_layers(encoder, lambda linear: QuantizedLinear(linear.in_features, linear.out_features))
+    softmax = QuantizedTiedEmbeddingSoftmax(config['vocab_size'], config['d_model_size'])
+  softmax.load_state_dict({name[len('softmax.'):]: tensor for name, tensor in tensors.items()
+                           if name.startswith('softmax.')}, assign=True)
+  encoder.load_state_dict({name[len('encoder.'):]: tensor for name, tensor in tensors.items()
+                           if name.startswith('encoder.')}, assign=True)
+  for module in [softmax] + list(encoder.modules()):
+    if isinstance(module, (QuantizedLinear, QuantizedTiedEmbeddingSoftmax)):
+      module.pack()
+  return encoder, softmax
+
+
+def load_any_model(path, device='cpu'):
+  # the encoder and tied softmax of a flat checkpoint, whether it holds fp32 or int8 weights
+  if pytorch_checkpoint.read_header(path)[1]['config'].get('quantization') == 'int8':
+    return load_quantized_model(path)
+  return pytorch_checkpoint.load_model(path, device)
+
+
+def sequence_statistics(encoder, softmax, tokens):
+  # log-probabilities of every next token of a (1, seq_len) sequence, and the log-softmax they come from
+  with torch.no_grad():
+    logits = softmax(encoder(softmax(tokens, embed=True)), embed=False)[0, :-1]
+  log_probs = torch.log_softmax(logits, dim=-1)
+  return log_probs.gather(1, tokens[0, 1:].unsqueeze(1)).squeeze(1), log_probs
+
+
+def perplexity_drift(reference, quantized, sequences):
+  # compares two (encoder, softmax) pairs on a list of token id lists
+  # returns the perplexity of both, the relative drift, how often their most probable next token agrees
+  # and the mean KL divergence of the quantised from the reference next-token distribution
+  nll = [[], []]
+  agree, kl = [], []
+  for sequence in sequences:
+    tokens = torch.tensor([sequence], dtype=torch.long)
+    reference_nll, reference_log_probs = sequence_statistics(reference[0], reference[1], tokens)
+    quantized_nll, quantized_log_probs = sequence_statistics(quantized[0], quantized[1], tokens)
+    nll[0].append(-reference_nll)
+    nll[1].append(-quantized_nll)
+    agree.append(reference_log_probs.argmax(dim=-1) == quantized_log_probs.argmax(dim=-1))
+    kl.append((reference_log_probs.exp() * (reference_log_probs - quantized_log_probs)).sum(dim=-1))
+
+  reference_ppl, quantized_ppl = [float(torch.cat(n).mean().exp()) for n in nll]
+  return {
+    'sequences': len(sequences),
+    'tokens': int(sum(len(n) for n in nll[0])),
+    'reference_perplexity': reference_ppl,
+    'quantized_perplexity': quantized_ppl,
+    'drift': quantized_ppl / reference_ppl - 1,
+    'top1_agreement': float(torch.cat(agree).float().mean()),
+    'mean_kl': float(torch.cat(kl).mean()),
+  }
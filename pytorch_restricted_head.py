@@ -0,0 +1,149 @@
+from __future__ import print_function
+import io
+import os
+import re
+import glob
+import argparse
+import collections
+import numpy as np
+import torch
+import tqdm
+import fastBPE
+import vocabulary
+import pytorch_sampling
+import pytorch_quantization
+
+# argument generation only ever uses a small part of the 246534 tokens of CTRL's vocabulary
+# with a restricted head, the newest position is only projected onto the rows of the tied softmax of a set of token ids
+# (by default the ones of the training documents in the final/ folders, see main), the largest matmul of a decoding
+# step; the logits are scattered back to the full vocabulary, every other token gets -inf, so the logits processors,
+# stop ids and generated tokens stay in the ids of the vocabulary and nothing else has to know about the head
+
+# the training documents of all sources and topics (see training_utils/pipeline)
+DOCUMENT_FILES = 'training_data/*/*/final/*.txt'
+
+
+class RestrictedSoftmax(torch.nn.Module):
+  # drop-in replacement for the tied embedding/softmax (fp32 or int8) of a GenerationEngine: the embedding is that
+  # of the full vocabulary, the softmax only covers the given ids
+  # w is the full matrix, so code looking at softmax.w.shape or softmax.w.device is unaffected
+
+  def __init__(self, softmax, ids):
+    super(RestrictedSoftmax, self).__init__()
+    self.softmax = softmax
+    ids = torch.as_tensor(np.unique(ids), dtype=torch.long, device=softmax.w.device)
+    self.register_buffer('ids', ids)
+    if softmax.w.dtype == torch.int8:
+      # the gathered int8 rows get a packed weight of their own
+      self.packed = pytorch_quantization.prepack(softmax.w[ids], softmax.w_scale[ids], softmax.b[ids])
+      self.head_w, self.head_b = None, None
+    else:
+      self.packed = None
+      self.register_buffer('head_w', softmax.w.detach()[ids])
+      self.register_buffer('head_b', softmax.b.detach()[ids])
+
+  @property
+  def w(self):
+    return self.softmax.w
+
+  def forward(self, inputs, embed=True, positions=None):
+    if embed:
+      return self.softmax(inputs, embed=True)
+    if positions is not None:
+      inputs = inputs[:, positions]
+    if self.packed is not None:
+      logits = torch.ops.quantized.linear_dynamic(inputs, self.packed, True)
+    else:
+      logits = torch.nn.functional.linear(inputs, self.head_w, self.head_b)
+    full = logits.new_full(logits.shape[:-1] + (self.w.shape[0],), -float('inf'))
+    return full.index_copy_(-1, self.ids, logits)
+
+
+def load_head_ids(path):
+  # the token ids of a restricted head, as written by main
+  return np.load(path)
+
+
+def document_words(path, bpe):
+  # the BPE pieces of a training document like make_tf_records_multitag.py reads them,
+  # after the control code of its file name
+  with io.open(path, encoding='utf-8') as f:
+    text = f.read()
+  words = [word for word in re.findall(r'\S+|\n', bpe.apply([text])[0]) if word != u'@@']
+  return os.path.basename(path).split('.txt')[0].split('_') + words
+
+
+def count_token_ids(paths, bpe, word2idx):
+  # occurrences of every token id in the documents, per folder, and the number of pieces not in the vocabulary
+  counts = collections.defaultdict(collections.Counter)
+  unknown = 0
+  for path in tqdm.tqdm(paths):
+    folder = counts[os.path.dirname(path)]
+    for word in document_words(path, bpe):
+      i = word2idx.get(word)
+      if i is None:
+        unknown += 1
+      else:
+        folder[i] += 1
+  return counts, unknown
+
+
+def head_ids(counts, min_count=1, extra_ids=(), excluded_mask=None):
+  # the ids occurring at least min_count times (counts is a Counter), plus the extra ids, but none of the excluded
+  ids = set(i for i, count in counts.items() if count >= min_count) | set(extra_ids)
+  if excluded_mask is not None:
+    ids -= set(np.nonzero(excluded_mask.numpy())[0].tolist())
+  return np.array(sorted(ids), dtype=np.int64)
+
+
+def coverage(counts, ids):
+  # share of the token occurrences (counts is a Counter) the ids cover
+  ids = set(ids.tolist())
+  total = sum(counts.values())
+  return sum(count for i, count in counts.items() if i in ids) / float(max(total, 1))
+
+
+def main():
+  parser = argparse.ArgumentParser(description='Builds the token ids of a restricted output head from the training documents')
+  parser.add_argument('--documents', type=str, nargs='+', default=[DOCUMENT_FILES],
+                      help='training documents (paths or glob patterns) whose tokens the head covers')
+  parser.add_argument('--output', type=str, default='head_vocab.npy',
+                      help='location of the token ids of the head, for --restricted_head of the generation scripts')
+  parser.add_argument('--min_count', type=int, default=1,
+                      help='only cover tokens occurring at least this often in the documents')
+  parser.add_argument('--extra_words', type=str, nargs='*', default=['\n'],
+                      help='tokens to cover besides the ones of the documents')
+  parser.add_argument('--exclude_words', type=str, nargs='*', default=['<unk>', 'Sco@@'],
+                      help='tokens never to cover, by default the ones the generation scripts disallow')
+  parser.add_argument('--exclude_substrings', type=str, nargs='*', default=['http'],
+                      help='never cover tokens containing one of these')
+  args = parser.parse_args()
+
+  paths = sorted(set(path for pattern in args.documents for path in glob.glob(pattern)))
+  if not paths:
+    raise ValueError('no document matches %s' % ' '.join(args.documents))
+  # the memory-mapped vocabulary (see vocabulary.py)
+  idx2word = vocabulary.load_vocabulary('vocab')
+  bpe = fastBPE.fastBPE('codes', 'vocab')
+
+  counts, unknown = count_token_ids(paths, bpe, idx2word.ids)
+  total = sum(counts.values(), collections.Counter())
+  excluded = pytorch_sampling.vocab_mask(idx2word, args.exclude_words, args.exclude_substrings)
+  ids = head_ids(total, args.min_count, [idx2word.ids[word] for word in args.extra_words if word in idx2word.ids],
+                 excluded)
+  np.save(args.output, ids)
+
+  print('{} of {} token ids ({:.2%} of the vocabulary) written to {}'.format(
+    len(ids), len(idx2word), len(ids) / float(len(idx2word)), args.output))
+  print('{} documents, {} tokens, {} distinct ids, {} pieces not in the vocabulary'.format(
+    len(paths), sum(total.values()), len(total), unknown))
+  print('coverage of the document tokens: {:.4%}'.format(coverage(total, ids)))
+  # how well the tokens of all other folders cover a folder, as a hint at the coverage for unseen topics
+  for folder in sorted(counts):
+    others = total - counts[folder]
+    print('{}: {:.4%} ({:.4%} with the tokens of the other folders only)'.format(
+      folder, coverage(counts[folder], ids), coverage(counts[folder], head_ids(others, args.min_count, excluded_mask=excluded))))
+
+
+if __name__ == '__main__':
+  main()
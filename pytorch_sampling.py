@@ -0,0 +1,161 @@
+from __future__ import print_function
+import torch
+import numpy as np
+import vocabulary
+
+# the sampling rules of the generation loop as a chain of processors over the (batch, vocab) logits
+# of the newest position; everything stays on the logits' device, no per-step copies to numpy
+
+
+def vocab_mask(idx2word, words=(), substrings=()):
+  # bool mask over the vocabulary of the given tokens and of every token containing one of the substrings
+  # computed once, so that banning e.g. everything with `http` costs nothing per step
+  # idx2word is an array of the words or a vocabulary.Vocabulary, which is searched without decoding its words
+  if isinstance(idx2word, vocabulary.Vocabulary):
+    mask = np.zeros(len(idx2word), dtype=bool)
+    mask[[idx2word.ids[word] for word in words if word in idx2word.ids]] = True
+    for substring in substrings:
+      mask[idx2word.ids_containing(substring)] = True
+    return torch.tensor(mask, dtype=torch.bool)
+  idx2word = np.asarray(idx2word)
+  mask = np.isin(idx2word, list(words))
+  for substring in substrings:
+    mask |= np.char.find(idx2word, substring) >= 0
+  return torch.tensor(mask, dtype=torch.bool)
+
+
+class LogitsProcessor(object):
+
+  def reset(self, tokens, padding_mask=None):
+    # called with the (batch, prompt length) prompt tokens before the first step
+    pass
+
+  def update(self, tokens):
+    # called with the (batch,) tokens chosen at every step
+    pass
+
+  def select(self, rows):
+    # called with the (1-d index tensor of the) rows that stay in the batch
+    pass
+
+  def __call__(self, logits):
+    raise NotImplementedError
+
+
+class Temperature(LogitsProcessor):
+
+  def __init__(self, temperature):
+    self.temperature = temperature
+
+  def __call__(self, logits):
+    return logits / self.temperature
+
+
+class RepetitionPenalty(LogitsProcessor):
+  # discount the logits of every token already in the sequence
+  # the tokens are counted as they come in, instead of rescanning the whole history every step
+  def __init__(self, penalty, vocab_size):
+    self.penalty = penalty
+    self.vocab_size = vocab_size
+    self.counts = None
+
+  def reset(self, tokens, padding_mask=None):
+    real = torch.ones_like(tokens, dtype=torch.int32) if padding_mask is None else (~padding_mask).int()
+    self.counts = torch.zeros(tokens.shape[0], self.vocab_size, dtype=torch.int32, device=tokens.device)
+    self.counts.scatter_add_(1, tokens, real)
+
+  def update(self, tokens):
+    self.counts.scatter_add_(1, tokens.unsqueeze(1), torch.ones_like(tokens, dtype=torch.int32).unsqueeze(1))
+
+  def select(self, rows):
+    self.counts = self.counts.index_select(0, rows)
+
+  def __call__(self, logits):
+    return torch.where(self.counts > 0, logits / self.penalty, logits)
+
+
+class BannedTokens(LogitsProcessor):
+  # disallow the tokens of a precomputed vocabulary mask (see vocab_mask)
+  def __init__(self, mask):
+    self.mask = mask
+
+  def __call__(self, logits):
+    return logits.masked_fill(self.mask, -1e8)
+
+
+class TopK(LogitsProcessor):
+
+  def __init__(self, k):
+    self.k = k
+
+  def __call__(self, logits):
+    # partial selection, the vocabulary is never fully sorted
+    top_logits, top_idx = torch.topk(logits, min(self.k, logits.shape[-1]), dim=-1)
+    return torch.full_like(logits, -float('inf')).scatter_(1, top_idx, top_logits)
+
+
+class TopP(LogitsProcessor):
+  # nucleus: keep the most probable tokens before their cumulative probability passes p, but at least one
+  # only the `candidates` most probable tokens are selected and sorted; the whole vocabulary is
+  # only sorted in the rare case that they do not reach p
+  def __init__(self, p, candidates=1024):
+    self.p = p
+    self.candidates = candidates
+
+  def __call__(self, logits):
+    probs = torch.softmax(logits, dim=-1)
+    top_probs, top_idx = torch.topk(probs, min(self.candidates, probs.shape[-1]), dim=-1)
+    cumulative = torch.cumsum(top_probs, dim=-1)
+    if top_idx.shape[-1] < probs.shape[-1] and bool((cumulative[:, -1] <= self.p).any()):
+      top_probs, top_idx = torch.sort(probs, dim=-1, descending=True)
+      cumulative = torch.cumsum(top_probs, dim=-1)
+
+    keep = torch.clamp((cumulative <= self.p).sum(dim=-1, keepdim=True), min=1)
+    kept = torch.arange(top_idx.shape[-1], device=logits.device).unsqueeze(0) < keep
+    top_logits = logits.gather(1, top_idx).masked_fill(~kept, -float('inf'))
+    return torch.full_like(logits, -float('inf')).scatter_(1, top_idx, top_logits)
+
+
+class LogitsProcessorChain(list):
+
+  def reset(self, tokens, padding_mask=None):
+    for processor in self:
+      processor.reset(tokens, padding_mask)
+
+  def update(self, tokens):
+    for processor in self:
+      processor.update(tokens)
+
+  def select(self, rows):
+    for processor in self:
+      processor.select(rows)
+
+  def __call__(self, logits):
+    for processor in self:
+      logits = processor(logits)
+    return logits
+
+
+def build_processors(vocab_size, temperature=0., nucleus=0., topk=0, penalty=1.2, banned_mask=None):
+  # same order and flags as the generation scripts: temperature, repetition penalty, banned tokens,
+  # then either the nucleus or the top-k (a nucleus takes precedence)
+  processors = LogitsProcessorChain()
+  if temperature > 0:
+    processors.append(Temperature(temperature))
+  if penalty > 0:
+    processors.append(RepetitionPenalty(penalty, vocab_size))
+  if banned_mask is not None:
+    processors.append(BannedTokens(banned_mask))
+  # pruning does not change the most probable token, so it is skipped when decoding greedily
+  if temperature > 0 and nucleus > 0.:
+    processors.append(TopP(nucleus))
+  elif temperature > 0 and topk > 0:
+    processors.append(TopK(topk))
+  return processors
+
+
+def choose(logits, temperature=0.):
+  # greedy with a temperature of 0, else sample from the processed logits
+  if temperature == 0:
+    return logits.argmax(dim=-1)
+  return torch.multinomial(torch.softmax(logits, dim=-1), 1).squeeze(1)
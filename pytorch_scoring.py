@@ -0,0 +1,203 @@
+from __future__ import print_function
+import io
+import os
+import json
+import argparse
+import itertools
+import numpy as np
+import torch
+import torch.utils.checkpoint
+import tqdm
+import fastBPE
+import vocabulary
+import pytorch_engine
+import pytorch_quantization
+from control_codes import load_catalog
+
+# perplexity of texts behind their control codes, e.g. to filter generated arguments by how likely the model finds them
+# the input is a JSONL file with one (control code, text) record per line, such as the output of the bulk mode of
+# pytorch_generation.py; it is read buffer_size records at a time, so files of any size stream through:
+# the records of a buffer are sorted by their number of tokens and cut into batches of similar lengths
+# (little padding), every batch is scored in one forward pass and the buffer is written out in input order,
+# each record with the negative log-likelihood (nll) of its text, its number of tokens and its perplexity
+
+
+def token_nll(softmax, hidden, targets, vocab_chunk_size=16384):
+  # -log p(target) for (n, d) hidden states and (n,) targets, without the (n, vocab) logits: the log-sum-exp over
+  # the vocabulary is accumulated vocab_chunk_size rows of the tied softmax at a time, and the target logits come
+  # from the gathered rows of the targets; works with the int8 softmax of pytorch_quantization as well (its rows
+  # are dequantised chunk by chunk)
+  # with autograd (e.g. as a fine-tuning loss), the logits of a chunk are recomputed in the backward pass
+  # instead of being kept for it, so the memory stays that of one chunk
+  def rows(index):
+    # the (dequantised) softmax rows and biases of a slice or tensor of token ids
+    weight = softmax.w[index]
+    if weight.dtype == torch.int8:
+      weight = weight.float() * softmax.w_scale[index].unsqueeze(1)
+    return weight, softmax.b[index]
+
+  def chunk_logsumexp(hidden, start):
+    weight, bias = rows(slice(start, start + vocab_chunk_size))
+    return torch.logsumexp(torch.nn.functional.linear(hidden, weight, bias).float(), dim=-1)
+
+  logsumexp = None
+  for start in range(0, softmax.w.shape[0], vocab_chunk_size):
+    if torch.is_grad_enabled() and hidden.requires_grad:
+      chunk = torch.utils.checkpoint.checkpoint(chunk_logsumexp, hidden, start, use_reentrant=False)
+    else:
+      chunk = chunk_logsumexp(hidden, start)
+    logsumexp = chunk if logsumexp is None else torch.logaddexp(logsumexp, chunk)
+  weight, bias = rows(targets)
+  return logsumexp - ((hidden * weight).sum(-1) + bias).float()
+
+
+def sequence_nll(engine, sequences, starts, vocab_chunk_size=16384):
+  # the summed negative log-likelihood of the tokens of every sequence (token id lists) from starts[i] on,
+  # e.g. the text behind a control code of starts[i] tokens; starts[i] has to be at least 1
+  # the sequences are right-padded: with the causal mask the padding never affects the tokens before it
+  device = engine.device()
+  max_len = max(len(sequence) for sequence in sequences)
+  tokens = torch.tensor([list(sequence) + [engine.pad_id] * (max_len - len(sequence)) for sequence in sequences],
+                        dtype=torch.long, device=device)
+  # only the hidden states predicting a scored token are projected onto the vocabulary, a chunk of it at a time
+  rows = [row for row, (sequence, start) in enumerate(zip(sequences, starts)) for _ in range(start, len(sequence))]
+  positions = [position for sequence, start in zip(sequences, starts) for position in range(start - 1, len(sequence) - 1)]
+  targets = [sequence[position] for sequence, start in zip(sequences, starts) for position in range(start, len(sequence))]
+  rows = torch.tensor(rows, dtype=torch.long, device=device)
+  with pytorch_engine.inference_mode():
+    hidden = engine.encoder(engine.softmax(tokens, embed=True))
+    hidden = hidden[rows, torch.tensor(positions, dtype=torch.long, device=device)]
+    nll = token_nll(engine.softmax, hidden, torch.tensor(targets, dtype=torch.long, device=device), vocab_chunk_size)
+    return torch.zeros(len(sequences), device=device).index_add_(0, rows, nll).tolist()
+
+
+def length_batches(lengths, max_tokens=4096, batch_size=64):
+  # the indices of the sequences ordered by length, cut into batches of at most batch_size sequences
+  # and max_tokens tokens with padding (a longer sequence is a batch of its own)
+  batches = [[]]
+  for i in sorted(range(len(lengths)), key=lambda i: lengths[i]):
+    batch = batches[-1]
+    if batch and (len(batch) == batch_size or (len(batch) + 1) * lengths[i] > max_tokens):
+      batches.append([])
+    batches[-1].append(i)
+  return [batch for batch in batches if batch]
+
+
+def finished_records(output):
+  # number of records already written to the output file
+  # a last line cut off by an interruption is dropped from the file, so the run can append behind it
+  if not os.path.exists(output):
+    return 0
+  with io.open(output, 'rb+') as f:
+    data = f.read()
+    end = data.rfind(b'\n') + 1
+    if end < len(data):
+      f.truncate(end)
+  return data[:end].count(b'\n')
+
+
+def score_records(engine, encode, records, f, buffer_size=4096, max_tokens=4096, batch_size=64, progress=None,
+                  vocab_chunk_size=16384):
+  # scores an iterable of records and writes them to the file object f as JSON lines, buffer by buffer
+  # encode maps a record to its token ids and the index of the first scored token, or raises ValueError;
+  # such a record is written with the error instead of the scores
+  records = iter(records)
+  count = 0
+  for buffer in iter(lambda: list(itertools.islice(records, buffer_size)), []):
+    encoded, errors = {}, {}
+    for i, record in enumerate(buffer):
+      try:
+        encoded[i] = encode(record)
+      except ValueError as e:
+        errors[i] = str(e)
+    indices = sorted(encoded)
+    scores = {}
+    for batch in length_batches([len(encoded[i][0]) for i in indices], max_tokens, batch_size):
+      batch = [indices[j] for j in batch]
+      nlls = sequence_nll(engine, [encoded[i][0] for i in batch], [encoded[i][1] for i in batch], vocab_chunk_size)
+      scores.update(zip(batch, nlls))
+      if progress is not None:
+        progress.update(len(batch))
+    for i, record in enumerate(buffer):
+      if i in errors:
+        record = dict(record, error=errors[i])
+      else:
+        num_tokens = len(encoded[i][0]) - encoded[i][1]
+        record = dict(record, nll=scores[i], num_scored_tokens=num_tokens, ppl=float(np.exp(scores[i] / num_tokens)))
+      f.write(json.dumps(record, ensure_ascii=False) + u'\n')
+    if progress is not None:
+      progress.update(len(errors))
+    # written out buffer by buffer, an interruption loses at most the running buffer
+    f.flush()
+    count += len(buffer)
+  return count
+
+
+def main():
+  parser = argparse.ArgumentParser(description='Scores the perplexity of texts behind their control codes')
+  parser.add_argument('--pytorch_checkpoint', type=str, required=True,
+                      help='location of the flat PyTorch checkpoint, fp32 or int8 (see convert_tf_to_pytorch.py and quantize_pytorch.py)')
+  parser.add_argument('--input', type=str, required=True,
+                      help='JSONL file with one record per line, e.g. the output of the bulk mode of pytorch_generation.py')
+  parser.add_argument('--output', type=str, required=True,
+                      help='JSONL file the records are written to with their scores; an existing file is resumed')
+  parser.add_argument('--prompt_field', type=str, default='prompt',
+                      help='field of a record holding the control code')
+  parser.add_argument('--text_field', type=str, default='text',
+                      help='field of a record holding the text to score')
+  parser.add_argument('--buffer_size', type=int, default=4096,
+                      help='number of records read, sorted by length and written out together')
+  parser.add_argument('--batch_size', type=int, default=64,
+                      help='maximum number of sequences scored in one forward pass')
+  parser.add_argument('--max_tokens', type=int, default=4096,
+                      help='maximum number of tokens (with padding) scored in one forward pass')
+  parser.add_argument('--vocab_chunk_size', type=int, default=16384,
+                      help='number of vocabulary entries the scored tokens are projected onto at a time')
+  parser.add_argument('--seq_length', type=int, default=256,
+                      help='context of the model, longer sequences are not scored')
+  parser.add_argument('--device', type=str, default=None,
+                      help='device to run the model on; defaults to cuda if available, else cpu')
+  parser.add_argument('--threads', type=int, default=0,
+                      help='number of intra-op threads on cpu; defaults to 0 which is one per physical core')
+  args = parser.parse_args()
+
+  device = pytorch_engine.setup_device(args.device, args.threads)
+  # the memory-mapped vocabulary (see vocabulary.py)
+  idx2word = vocabulary.load_vocabulary('vocab')
+  bpe = fastBPE.fastBPE('codes', 'vocab')
+
+  def tokenize(prompt):
+    return [idx2word.ids[token] for token in ' \n '.join(bpe.apply(prompt.split('\\n'))).split(' ')]
+
+  catalog = load_catalog(tokenize)
+
+  def encode(record):
+    prompt, text = record.get(args.prompt_field), record.get(args.text_field)
+    if not prompt or not text:
+      raise ValueError('no %s or %s' % (args.prompt_field, args.text_field))
+    # the control code comes from the catalog if it is a known one, newlines of the text are the newline token
+    code = catalog.tokenize(prompt)
+    try:
+      tokens = code + tokenize(text.replace('\n', '\\n'))
+    except KeyError as e:
+      raise ValueError('unknown token %s in the text' % e)
+    if len(tokens) > args.seq_length:
+      raise ValueError('%i tokens do not fit into a window of %i' % (len(tokens), args.seq_length))
+    return tokens, len(code)
+
+  encoder, softmax = pytorch_quantization.load_any_model(args.pytorch_checkpoint, device)
+  encoder.eval()
+  softmax.eval()
+  engine = pytorch_engine.GenerationEngine(encoder, softmax, args.seq_length)
+
+  done = finished_records(args.output)
+  with io.open(args.input, encoding='utf-8') as f:
+    records = (json.loads(line) for line in f if line.strip())
+    with io.open(args.output, 'a', encoding='utf-8') as out, tqdm.tqdm(unit='seq', initial=done) as progress:
+      count = score_records(engine, encode, itertools.islice(records, done, None), out, args.buffer_size,
+                            args.max_tokens, args.batch_size, progress, args.vocab_chunk_size)
+  print('{} records scored, {} already done'.format(count, done))
+
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,243 @@
+from __future__ import print_function
+import json
+import asyncio
+import argparse
+import threading
+import urllib.parse
+import fastBPE
+import vocabulary
+import pytorch_engine
+import pytorch_batching
+import pytorch_sampling
+import pytorch_stopping
+import pytorch_quantization
+import pytorch_prefix_cache
+import pytorch_restricted_head
+import pytorch_export
+import detokenization
+from control_codes import load_catalog
+
+# HTTP server around the PyTorch generation engine
+# requests are decoded together in the slots of a pytorch_batching.ContinuousBatcher, which runs in a worker thread;
+# a request joins the running batch as soon as a slot is free, the event loop only parses requests and writes responses
+#
+#   POST /generate {"prompt": "nuclear energy CON waste", "max_new_tokens": 64, "temperature": 0.7, "topk": 40}
+#
+# answers {"prompt": ..., "text": ..., "tokens": [...]}, or with "stream": true a chunked response with one
+# JSON line per token ({"token": id, "text": piece}) and a final {"done": true, "text": ...}; a piece is the text
+# the token finalised (see detokenization.IncrementalDetokenizer), empty for the leading pieces of a BPE-split word
+# a request can stop early with "stop_at_sentence_end": true, "stop_at_newline": true, "stop_ids": [...]
+# and abort loops with "repeat_ngram": n (see pytorch_stopping.NgramRepetition, "max_ngram_repeats" defaults to 3)
+# a prompt has to start with a control code the model was trained with (see control_codes.ControlCodeCatalog),
+# else it is rejected with the closest known codes unless the request sets "allow_unknown_code": true
+# a request that fails while it is generated is answered with status 500 and {"error": ...}, or when streaming
+# with a final {"done": true, "error": ...}
+# GET /metrics answers the slot utilisation and queue depth of the batcher,
+# GET /control_codes?prefix=nuclear%20energy%20CON the known control codes starting with the prefix
+
+SAMPLING_DEFAULTS = {'temperature': 0., 'nucleus': 0., 'topk': 0, 'penalty': 1.2}
+STOPPING_DEFAULTS = {'repeat_ngram': 0, 'max_ngram_repeats': 3}
+# the logits are divided by the temperature and the penalty, smaller (non-zero) values can overflow them
+MIN_DIVISOR = 1e-2
+
+
+class GenerationServer(object):
+
+  def __init__(self, batcher, catalog, idx2word, max_new_tokens=256):
+    self.batcher = batcher
+    self.catalog = catalog
+    self.idx2word = idx2word
+    self.max_new_tokens = max_new_tokens
+    self.sentence_end_ids = pytorch_stopping.stop_token_ids(idx2word, sentence_end=True)
+    self.newline_ids = pytorch_stopping.stop_token_ids(idx2word, newline=True)
+
+  def parse(self, body, loop):
+    # the request for a JSON body, raises ValueError for anything invalid
+    # its tokens (then None) are put into the returned queue as they are generated, if it fails only None
+    # with the reason in request.error
+    data = json.loads(body.decode('utf-8'))
+    if not isinstance(data, dict) or not isinstance(data.get('prompt'), str) or not data['prompt'].strip():
+      raise ValueError('expected a JSON object with a non-empty "prompt"')
+    try:
+      sampling = {name: type(default)(data.get(name, default)) for name, default in SAMPLING_DEFAULTS.items()}
+      stopping = {name: type(default)(data.get(name, default)) for name, default in STOPPING_DEFAULTS.items()}
+      max_new_tokens = min(int(data.get('max_new_tokens', self.max_new_tokens)), self.max_new_tokens)
+      stop_ids = [int(token) for token in data.get('stop_ids', [])]
+    except TypeError:
+      raise ValueError('sampling parameters, stop conditions and max_new_tokens must be numbers')
+    if min(sampling.values()) < 0 or max_new_tokens < 1:
+      raise ValueError('sampling parameters must not be negative and max_new_tokens must be positive')
+    if 0 < sampling['temperature'] < MIN_DIVISOR or 0 < sampling['penalty'] < MIN_DIVISOR:
+      raise ValueError('temperature and penalty must be 0 or at least %g' % MIN_DIVISOR)
+    if stopping['repeat_ngram'] < 0 or stopping['max_ngram_repeats'] < 2:
+      raise ValueError('repeat_ngram must not be negative and max_ngram_repeats must be at least 2')
+    if data.get('stop_at_sentence_end', False):
+      stop_ids += self.sentence_end_ids
+    if data.get('stop_at_newline', False):
+      stop_ids += self.newline_ids
+    if not data.get('allow_unknown_code', False):
+      self.catalog.validate(data['prompt'])
+    tokens = self.catalog.tokenize(data['prompt'])
+    if len(tokens) >= self.batcher.engine.seq_length:
+      raise ValueError('the prompt is longer than the context of the model')
+    queue = asyncio.Queue()
+    request = pytorch_batching.SequenceRequest(
+      tokens, max_new_tokens, stop_ids=stop_ids, on_token=lambda token: loop.call_soon_threadsafe(queue.put_nowait, token),
+      on_done=lambda tokens: loop.call_soon_threadsafe(queue.put_nowait, None), **sampling, **stopping)
+    return request, queue, bool(data.get('stream', False)), data['prompt']
+
+  async def handle(self, reader, writer):
+    try:
+      request_line = (await reader.readline()).decode('latin-1').split()
+      headers = {}
+      while True:
+        line = (await reader.readline()).decode('latin-1').strip()
+        if not line:
+          break
+        name, _, value = line.partition(':')
+        headers[name.strip().lower()] = value.strip()
+      try:
+        length = int(headers.get('content-length', 0))
+        if length < 0:
+          raise ValueError()
+      except ValueError:
+        await self.respond(writer, 400, {'error': 'invalid Content-Length header'})
+        return
+      body = await reader.readexactly(length)
+
+      path, _, query = request_line[1].partition('?') if len(request_line) >= 2 else ('', '', '')
+      if path == '/metrics':
+        await self.respond(writer, 200, self.batcher.metrics())
+      elif path == '/control_codes':
+        prefix = urllib.parse.parse_qs(query).get('prefix', [''])[0]
+        await self.respond(writer, 200, {'prefix': prefix, 'codes': self.catalog.complete(prefix, limit=50)})
+      elif path != '/generate':
+        await self.respond(writer, 404, {'error': 'not found'})
+      elif request_line[0] != 'POST':
+        await self.respond(writer, 405, {'error': 'use POST'})
+      else:
+        try:
+          request, queue, stream, prompt = self.parse(body, asyncio.get_event_loop())
+        except ValueError as e:
+          await self.respond(writer, 400, {'error': str(e)})
+        else:
+          self.batcher.submit(request)
+          if stream:
+            await self.stream(writer, queue, request)
+          else:
+            tokens = []
+            while True:
+              token = await queue.get()
+              if token is None:
+                break
+              tokens.append(token)
+            if request.error is not None:
+              await self.respond(writer, 500, {'error': request.error})
+            else:
+              await self.respond(writer, 200, {'prompt': prompt, 'text': self.detokenize(tokens), 'tokens': tokens})
+    except (asyncio.IncompleteReadError, ConnectionError):
+      pass
+    finally:
+      writer.close()
+
+  def detokenize(self, tokens):
+    return detokenization.detokenize(self.idx2word, tokens)
+
+  async def respond(self, writer, status, data):
+    body = json.dumps(data).encode('utf-8')
+    writer.write(('HTTP/1.1 %i %s\r\nContent-Type: application/json\r\nContent-Length: %i\r\nConnection: close\r\n\r\n'
+                  % (status, STATUS[status], len(body))).encode('latin-1') + body)
+    await writer.drain()
+
+  async def stream(self, writer, queue, request):
+    writer.write(b'HTTP/1.1 200 OK\r\nContent-Type: application/x-ndjson\r\nTransfer-Encoding: chunked\r\n'
+                 b'Connection: close\r\n\r\n')
+    detokenizer = detokenization.IncrementalDetokenizer(self.idx2word)
+    text = ''
+    while True:
+      token = await queue.get()
+      if token is None:
+        data = {'done': True, 'text': text + detokenizer.flush()}
+        if request.error is not None:
+          data['error'] = request.error
+      else:
+        data = {'token': token, 'text': detokenizer.push(token)}
+        text += data['text']
+      chunk = (json.dumps(data) + '\n').encode('utf-8')
+      writer.write(b'%x\r\n%s\r\n' % (len(chunk), chunk))
+      await writer.drain()
+      if token is None:
+        break
+    writer.write(b'0\r\n\r\n')
+    await writer.drain()
+
+
+STATUS = {200: 'OK', 400: 'Bad Request', 404: 'Not Found', 405: 'Method Not Allowed', 500: 'Internal Server Error'}
+
+
+def main():
+  parser = argparse.ArgumentParser(description='HTTP server generating from a flat PyTorch checkpoint')
+  parser.add_argument('--pytorch_checkpoint', type=str, required=True,
+                      help='location of the flat PyTorch checkpoint, fp32 or int8 (see convert_tf_to_pytorch.py and quantize_pytorch.py)')
+  parser.add_argument('--host', type=str, default='127.0.0.1',
+                      help='address to listen on')
+  parser.add_argument('--port', type=int, default=8080,
+                      help='port to listen on')
+  parser.add_argument('--slots', type=int, default=8,
+                      help='number of requests generated together; every slot holds the keys/values of a whole window')
+  parser.add_argument('--max_new_tokens', type=int, default=256,
+                      help='upper limit of the tokens generated per request')
+  parser.add_argument('--seq_length', type=int, default=256,
+                      help='context of the model; generation past it uses a sliding window, an approximation of re-encoding the window for every token (see --sliding_window of pytorch_generation.py)')
+  parser.add_argument('--device', type=str, default=None,
+                      help='device to run the model on; defaults to cuda if available, else cpu')
+  parser.add_argument('--threads', type=int, default=0,
+                      help='number of intra-op threads on cpu; defaults to 0 which is one per physical core')
+  parser.add_argument('--prefix_cache_mb', type=int, default=1024,
+                      help='memory for the keys/values of already seen prompt prefixes; 0 disables the cache')
+  parser.add_argument('--restricted_head', type=str, default=None,
+                      help='token ids (see pytorch_restricted_head.py) the softmax is restricted to; all other tokens are never generated')
+  parser.add_argument('--exported_encoder', type=str, default=None,
+                      help='run the encoder exported from the same checkpoint (see export_pytorch.py) instead of the eager one')
+  args = parser.parse_args()
+
+  device = pytorch_engine.setup_device(args.device, args.threads)
+  # the memory-mapped vocabulary (see vocabulary.py)
+  idx2word = vocabulary.load_vocabulary('vocab')
+  bpe = fastBPE.fastBPE('codes', 'vocab')
+
+  def tokenize(prompt):
+    return [idx2word.ids[token] for token in ' \n '.join(bpe.apply(prompt.split('\\n'))).split(' ')]
+
+  # the control codes the model was trained with, tokenised once
+  catalog = load_catalog(tokenize)
+
+  encoder, softmax = pytorch_quantization.load_any_model(args.pytorch_checkpoint, device)
+  encoder.eval()
+  softmax.eval()
+  if args.exported_encoder:
+    # prefill and the decode steps of the slots run the exported module, on the weights of the eager encoder
+    encoder = pytorch_export.load_exported(args.exported_encoder, encoder, softmax.w.device)
+  if args.restricted_head:
+    softmax = pytorch_restricted_head.RestrictedSoftmax(softmax, pytorch_restricted_head.load_head_ids(args.restricted_head))
+  prefix_cache = pytorch_prefix_cache.PrefixCache(args.prefix_cache_mb << 20) if args.prefix_cache_mb > 0 else None
+  engine = pytorch_engine.GenerationEngine(encoder, softmax, args.seq_length, prefix_cache=prefix_cache,
+                                           model_key=args.pytorch_checkpoint)
+  # the same tokens as in pytorch_generation.py are disallowed
+  banned_mask = pytorch_sampling.vocab_mask(idx2word, words=['<unk>', 'Sco@@'], substrings=['http'])
+
+  batcher = pytorch_batching.ContinuousBatcher(engine, args.slots, banned_mask)
+  threading.Thread(target=batcher.serve_forever, daemon=True).start()
+
+  async def serve():
+    server = GenerationServer(batcher, catalog, idx2word, args.max_new_tokens)
+    listener = await asyncio.start_server(server.handle, args.host, args.port)
+    print('Serving on http://%s:%i/generate' % (args.host, args.port))
+    async with listener:
+      await listener.serve_forever()
+
+  asyncio.run(serve())
+
+
+if __name__ == '__main__':
+  main()
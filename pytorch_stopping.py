@@ -0,0 +1,51 @@
+from __future__ import print_function
+import collections
+import numpy as np
+import vocabulary
+
+# per-sequence stop conditions of the generation loops, besides the maximum number of new tokens:
+# stop tokens (sentence ends, the newline, any other ids) and the abort of degenerate repetitions
+
+SENTENCE_END = ('.', '!', '?')
+
+
+def stop_token_ids(idx2word, sentence_end=False, newline=False, ids=()):
+  # the ids of the tokens that end a sequence: every complete word ending with sentence-final punctuation,
+  # the newline token and the given ids; computed once over the vocabulary (an array of the words or a
+  # vocabulary.Vocabulary)
+  stop = set(ids)
+  if isinstance(idx2word, vocabulary.Vocabulary):
+    if sentence_end:
+      ends = np.concatenate([idx2word.ids_ending_with(mark) for mark in SENTENCE_END])
+      stop.update(np.setdiff1d(ends, idx2word.ids_containing('@@')).tolist())
+    if newline and '\n' in idx2word.ids:
+      stop.add(idx2word.ids['\n'])
+    return sorted(stop)
+  idx2word = np.asarray(idx2word)
+  if sentence_end:
+    complete = np.char.find(idx2word, '@@') < 0
+    ends = np.zeros(len(idx2word), dtype=bool)
+    for mark in SENTENCE_END:
+      ends |= np.char.endswith(idx2word, mark)
+    stop.update(np.nonzero(complete & ends)[0].tolist())
+  if newline:
+    stop.update(np.nonzero(idx2word == '\n')[0].tolist())
+  return sorted(stop)
+
+
+class NgramRepetition(object):
+  # detects a sequence stuck in a loop: it counts the n-grams of the generated tokens as they come in
+  # and reports the sequence once its newest n-gram has occurred max_repeats times
+  def __init__(self, n=4, max_repeats=3):
+    self.n = n
+    self.max_repeats = max_repeats
+    self.counts = collections.Counter()
+    self.tail = collections.deque(maxlen=n)
+
+  def update(self, token):
+    self.tail.append(token)
+    if len(self.tail) < self.n:
+      return False
+    ngram = tuple(self.tail)
+    self.counts[ngram] += 1
+    return self.counts[ngram] >= self.max_repeats
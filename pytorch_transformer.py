@@ -7,25 +7,37 @@ import numpy as np
 import platform
 import re
 import argparse
-import tensorflow as tf
-from tensorflow.python import pywrap_tensorflow
 
 
 def angle_defn(pos, i, d_model_size):
   angle_rates = 1 / np.power(10000, (2 * (i//2)) / np.float32(d_model_size))
   return pos * angle_rates
 
+# positional encodings computed so far in this process, shared by all encoders of the same size
+pos_encodings = {}
+
 def positional_encoding(position, d_model_size):
+  # the table for the first `position` positions, a view into the largest table computed so far
+  if d_model_size in pos_encodings and pos_encodings[d_model_size].shape[1] >= position:
+    return pos_encodings[d_model_size][:, :position]
+
   # create the sinusoidal pattern for the positional encoding
   angle_rads = angle_defn(np.arange(position)[:, np.newaxis], np.arange(d_model_size)[np.newaxis, :], d_model_size)
   
   sines = np.sin(angle_rads[:, 0::2])
   cosines = np.cos(angle_rads[:, 1::2])
   
-  pos_encoding = torch.tensor(np.concatenate([sines, cosines], axis=-1)[np.newaxis, ...], dtype=torch.float)
+  # always a real cpu tensor, also when the model is built on the meta device (see pytorch_checkpoint)
+  pos_encoding = torch.tensor(np.concatenate([sines, cosines], axis=-1)[np.newaxis, ...], dtype=torch.float, device='cpu')
+  pos_encodings[d_model_size] = pos_encoding
   return pos_encoding
 
-def scaled_dot_product_attention(q, k, v, mask):
+def padded_positions(padding_mask, offset):
+  # positions of left-padded tokens: padding does not advance the position of a row
+  real = (~padding_mask).long()
+  return offset.unsqueeze(1) + torch.cumsum(real, dim=1) - real
+
+def scaled_dot_product_attention(q, k, v, mask, padding_mask=None):
   # calculate attention
   matmul_qk = torch.matmul(q, k.permute(0,1,3,2))
   
@@ -34,6 +46,10 @@ def scaled_dot_product_attention(q, k, v, mask):
 
   if mask is not None:
     scaled_attention_logits += (mask * -1e9)
+
+  # (batch, keys) mask of padded positions, combined with the causal mask for every head and query
+  if padding_mask is not None:
+    scaled_attention_logits += (padding_mask[:, None, None, :] * -1e9)
     
   attention_weights = torch.softmax(scaled_attention_logits, dim=-1) 
   output = torch.matmul(attention_weights, v)
@@ -59,7 +75,7 @@ class MultiHeadAttention(torch.nn.Module):
     x = x.reshape(batch_size, -1, self.num_heads, self.depth)
     return x.permute([0, 2, 1, 3])
     
-  def forward(self, v, k, q, mask):
+  def forward(self, v, k, q, mask, past=None, layer=0, padding_mask=None):
     batch_size = q.shape[0]
     
     q = self.Wq(q)
@@ -69,8 +85,12 @@ class MultiHeadAttention(torch.nn.Module):
     q = self.split_into_heads(q, batch_size)
     k = self.split_into_heads(k, batch_size)
     v = self.split_into_heads(v, batch_size)
+
+    # attend over the cached keys/values of the earlier positions as well
+    if past is not None:
+      k, v = past.update(layer, k, v)
     
-    scaled_attention = scaled_dot_product_attention(q, k, v, mask).permute([0, 2, 1, 3])
+    scaled_attention = scaled_dot_product_attention(q, k, v, mask, padding_mask).permute([0, 2, 1, 3])
     original_size_attention = scaled_attention.reshape(batch_size, -1, self.d_model_size)
     output = self.dense(original_size_attention)
         
@@ -95,9 +115,9 @@ class EncoderLayer(torch.nn.Module):
     self.dropout1 = torch.nn.Dropout(rate)
     self.dropout2 = torch.nn.Dropout(rate)
     
-  def forward(self, x, mask):
+  def forward(self, x, mask, past=None, layer=0, padding_mask=None):
     normed = self.layernorm1(x)
-    attn_output  = self.multi_head_attention(normed, normed, normed, mask)
+    attn_output  = self.multi_head_attention(normed, normed, normed, mask, past, layer, padding_mask)
     attn_output = self.dropout1(attn_output)
     out1 = x + attn_output
 
@@ -113,13 +133,16 @@ class EncoderLayer(torch.nn.Module):
 
 class Encoder(torch.nn.Module):
   def __init__(self, num_layers=48, d_model_size=1280, num_heads=16, dff=8192, input_vocab_size=50000,
-               rate=0.1, **kwargs):
+               rate=0.1, max_position=512, **kwargs):
     super(Encoder, self).__init__()
 
     self.d_model_size = d_model_size
     self.num_layers = num_layers
     
-    self.pos_encoding = positional_encoding(input_vocab_size, self.d_model_size).to('cuda')
+    # only built for the context the model was trained on (256 or 512), not for input_vocab_size positions;
+    # it grows if a longer context is requested. a buffer, so that it follows the model to its device,
+    # but not part of the checkpoint
+    self.register_buffer('pos_encoding', positional_encoding(max_position, self.d_model_size), persistent=False)
 
     for i in range(num_layers):
       setattr(self, "layer%i" % i, EncoderLayer(d_model_size, num_heads, dff, rate))
@@ -127,17 +150,342 @@ class Encoder(torch.nn.Module):
     self.layernorm = torch.nn.LayerNorm(d_model_size, eps=1e-6)  
     self.dropout = torch.nn.Dropout(rate)
 
-  def forward(self, x):
+  def forward(self, x, past=None, padding_mask=None):
+    # padding_mask is an optional (batch, seq_len) bool tensor marking the left-padding of the new tokens
 
     seq_len = x.shape[1]
+    # number of positions already held in the cache, the new tokens attend to all of them
+    past_len = 0 if past is None else len(past)
     
-    mask = torch.triu(torch.ones(seq_len, seq_len), 1).to('cuda')
+    mask = torch.triu(torch.ones(seq_len, past_len + seq_len, device=x.device), past_len + 1)
+
+    needed = seq_len if past is None else past.max_positions(seq_len)
+    if needed > self.pos_encoding.shape[1]:
+      self.pos_encoding = positional_encoding(needed, self.d_model_size).to(self.pos_encoding.device)
+
+    # positions of the new tokens and the padding of every key they attend to
+    if past is not None:
+      positions, padding_mask = past.begin(seq_len, padding_mask, x.device)
+    elif padding_mask is not None:
+      positions = padded_positions(padding_mask, torch.zeros(x.shape[0], dtype=torch.long, device=x.device))
+    else:
+      positions = torch.arange(seq_len, device=x.device).unsqueeze(0)
     
     x *= np.sqrt(self.d_model_size)
-    x += self.pos_encoding[:, :seq_len, :]
+    x += self.pos_encoding[0, positions]
 
     x = self.dropout(x)
     
     for i in range(self.num_layers):
-      x = getattr(self, "layer%i" % i)(x, mask)
+      x = getattr(self, "layer%i" % i)(x, mask, past, i, padding_mask)
     return self.layernorm(x)
+
+
+class TiedEmbeddingSoftmax(torch.nn.Module):
+  # ties the softmax weights to the input embeddings
+  # the default vocabulary size is that of the CTRL vocab file plus <unk> and the newline
+
+  def __init__(self, vocab_size=246534, embedding_size=1280, **kwargs):
+    super(TiedEmbeddingSoftmax, self).__init__()
+    self.w = torch.nn.Parameter(torch.zeros(vocab_size, embedding_size))
+    self.b = torch.nn.Parameter(torch.zeros(vocab_size))
+
+  def forward(self, inputs, embed=True, positions=None):
+    if embed:
+      return torch.nn.functional.embedding(inputs, self.w)
+    else:
+      # only project the hidden states at the given positions (e.g. -1 for the newest token of every row),
+      # the logits of all other positions would be thrown away anyway
+      if positions is not None:
+        inputs = inputs[:, positions]
+      return torch.nn.functional.linear(inputs, self.w, self.b)
+
+
+class KVCache(object):
+  # keys and values of every position already fed through the encoder, one entry per layer
+  # the encoder appends to it in place, so that the next call only needs the newest tokens
+  def __init__(self, num_layers):
+    self.keys = [None] * num_layers
+    self.values = [None] * num_layers
+    # number of tokens fed so far
+    self.seen = 0
+    # left-padding of the cached positions and the number of real tokens per row, only kept for padded batches
+    self.padding_mask = None
+    self.lengths = None
+
+  def __len__(self):
+    return 0 if self.keys[0] is None else self.keys[0].shape[2]
+
+  def max_positions(self, seq_len):
+    # upper bound of the positions the next seq_len tokens can take
+    return self.seen + seq_len
+
+  def begin(self, seq_len, padding_mask, device):
+    # bookkeeping for the next seq_len tokens, called by the encoder before the layers update the cache
+    # returns the positions of the new tokens and the padding mask of all keys they attend to
+    if padding_mask is None and self.padding_mask is None:
+      positions = torch.arange(self.seen, self.seen + seq_len, device=device).unsqueeze(0)
+      self.seen += seq_len
+      return positions, None
+
+    if padding_mask is None:
+      padding_mask = torch.zeros(self.padding_mask.shape[0], seq_len, dtype=torch.bool, device=device)
+    if self.padding_mask is None:
+      cached = 0 if self.keys[0] is None else self.keys[0].shape[2]
+      self.padding_mask = torch.zeros(padding_mask.shape[0], cached, dtype=torch.bool, device=device)
+      self.lengths = torch.full((padding_mask.shape[0],), self.seen, dtype=torch.long, device=device)
+
+    positions = padded_positions(padding_mask, self.lengths)
+    self.lengths = self.lengths + (~padding_mask).sum(1)
+    self.padding_mask = self.extend_padding(padding_mask)
+    self.seen += seq_len
+    return positions, self.padding_mask
+
+  def extend_padding(self, padding_mask):
+    return torch.cat((self.padding_mask, padding_mask), dim=1)
+
+  def update(self, layer, k, v):
+    if self.keys[layer] is not None:
+      k = torch.cat((self.keys[layer], k), dim=2)
+      v = torch.cat((self.values[layer], v), dim=2)
+    self.keys[layer] = k
+    self.values[layer] = v
+    return k, v
+
+  def truncate(self, length):
+    # forget every position from `length` on, e.g. the rejected draft tokens of speculative decoding
+    if length > self.seen:
+      raise ValueError('cannot truncate %i cached positions to %i' % (self.seen, length))
+    for layer in range(len(self.keys)):
+      if self.keys[layer] is not None:
+        self.keys[layer] = self.keys[layer][:, :, :length]
+        self.values[layer] = self.values[layer][:, :, :length]
+    if self.padding_mask is not None:
+      self.padding_mask = self.padding_mask[:, :length]
+      self.lengths = (~self.padding_mask).sum(1)
+    self.seen = length
+
+  def select(self, rows):
+    # keep only the given rows (a 1-d index tensor) of a batch, e.g. to drop the sequences that are done
+    for layer in range(len(self.keys)):
+      if self.keys[layer] is not None:
+        self.keys[layer] = self.keys[layer].index_select(0, rows)
+        self.values[layer] = self.values[layer].index_select(0, rows)
+    if self.padding_mask is not None:
+      self.padding_mask = self.padding_mask.index_select(0, rows)
+      self.lengths = self.lengths.index_select(0, rows)
+
+
+class SlidingWindowKVCache(KVCache):
+  # bounded cache for generating past the context size of the model
+  # the first `pinned` tokens of every row (the control code) are never evicted; once `window` positions are cached,
+  # every new token overwrites the slot of the oldest position of its row, its left-padding first and then the
+  # oldest generated token, so memory and per-token cost stay constant
+  # the keys carry their positions, so their order in the buffer does not matter to the attention
+  def __init__(self, num_layers, window, pinned=1):
+    super(SlidingWindowKVCache, self).__init__(num_layers)
+    if pinned >= window:
+      raise ValueError('cannot pin %i positions of a window of %i' % (pinned, window))
+    self.window = window
+    self.pinned = pinned
+    # the column of the first token of every row, once the window is full
+    self.first = None
+
+  def __len__(self):
+    # once the window is full, the slot that is about to be overwritten does not count
+    return min(super(SlidingWindowKVCache, self).__len__(), self.window - 1)
+
+  def max_positions(self, seq_len):
+    return min(self.seen + seq_len, self.window)
+
+  def begin(self, seq_len, padding_mask, device):
+    if self.seen < self.window and self.seen + seq_len > self.window:
+      raise ValueError('cannot cache %i positions in a window of %i' % (self.seen + seq_len, self.window))
+    if self.seen >= self.window and seq_len != 1:
+      raise ValueError('a full sliding window can only be extended one token at a time')
+    if self.seen >= self.window:
+      if self.first is None:
+        self.first = torch.zeros(self.keys[0].shape[0], dtype=torch.long, device=device) if self.padding_mask is None \
+          else (~self.padding_mask).int().argmax(1)
+      # slot of every row that the new token overwrites: the columns of a row but its pinned ones, oldest first
+      evicted = (self.seen - self.window) % (self.window - self.pinned)
+      self.slot = evicted + (evicted >= self.first).long() * self.pinned
+
+    positions, padding_mask = super(SlidingWindowKVCache, self).begin(seq_len, padding_mask, device)
+    # the model never saw positions past its window, so tokens beyond it all take the last one
+    # (this is also the position the newest token had in the old re-encoded window)
+    return positions.clamp(max=self.window - 1), padding_mask
+
+  def extend_padding(self, padding_mask):
+    if self.padding_mask.shape[1] < self.window:
+      return super(SlidingWindowKVCache, self).extend_padding(padding_mask)
+    rows = torch.arange(self.padding_mask.shape[0], device=self.padding_mask.device)
+    self.padding_mask[rows, self.slot] = padding_mask[:, 0]
+    return self.padding_mask
+
+  def update(self, layer, k, v):
+    if self.keys[layer] is None or self.keys[layer].shape[2] < self.window:
+      return super(SlidingWindowKVCache, self).update(layer, k, v)
+    rows = torch.arange(k.shape[0], device=k.device)
+    self.keys[layer][rows, :, self.slot] = k[:, :, 0]
+    self.values[layer][rows, :, self.slot] = v[:, :, 0]
+    return self.keys[layer], self.values[layer]
+
+  def select(self, rows):
+    super(SlidingWindowKVCache, self).select(rows)
+    if self.first is not None:
+      self.first = self.first.index_select(0, rows)
+
+  def truncate(self, length):
+    # the evicted positions are gone, so only a window that never overflowed can be rolled back
+    if self.seen > self.window and length < self.seen:
+      raise ValueError('cannot truncate a sliding window that already evicted positions')
+    super(SlidingWindowKVCache, self).truncate(length)
+
+
+class ReencodedWindowKVCache(KVCache):
+  # exact generation past the context size of the model, like the window the original generation loop re-encoded:
+  # while the tokens fit into `window` positions it is a KVCache, after that every new token re-encodes the first
+  # token of every row (the start of the control code) and its newest window - 1 tokens at the positions 0 to
+  # window - 1 the model was trained on; that costs a whole window per token, SlidingWindowKVCache is the
+  # constant-cost approximation
+  # the tokens have to come through inputs() (see GenerationEngine.forward), seen counts all of them
+  def __init__(self, num_layers, window):
+    super(ReencodedWindowKVCache, self).__init__(num_layers)
+    self.window = window
+    # every token fed so far and its left-padding
+    self.tokens = None
+    self.token_padding = None
+    self.reencoding = False
+
+  def max_positions(self, seq_len):
+    return min(self.seen + seq_len, self.window)
+
+  def record(self, tokens, padding_mask=None):
+    # adds (batch, seq_len) tokens to the ones the window is re-encoded from
+    if padding_mask is None:
+      padding_mask = torch.zeros_like(tokens, dtype=torch.bool)
+    if self.tokens is None:
+      self.tokens, self.token_padding = tokens, padding_mask
+    else:
+      self.tokens = torch.cat((self.tokens, tokens), dim=1)
+      self.token_padding = torch.cat((self.token_padding, padding_mask), dim=1)
+
+  def inputs(self, tokens, padding_mask=None):
+    # the tokens the encoder has to see for the new ones, and their padding: the new tokens themselves while they
+    # fit into the window, else the re-encoded window ending with them, which replaces the cached keys/values
+    self.record(tokens, padding_mask)
+    if self.tokens.shape[1] <= self.window:
+      return tokens, padding_mask
+    start = self.tokens.shape[1] - self.window + 1
+    first = (~self.token_padding).int().argmax(1, keepdim=True)
+    tokens = torch.cat((self.tokens.gather(1, first), self.tokens[:, start:]), dim=1)
+    # a (left-padded) row whose tokens all fit into the newest positions does not need its first one twice
+    padding_mask = torch.cat((first >= start, self.token_padding[:, start:]), dim=1)
+    self.keys = [None] * len(self.keys)
+    self.values = [None] * len(self.values)
+    self.reencoding = True
+    return tokens, padding_mask if bool(padding_mask.any()) else None
+
+  def begin(self, seq_len, padding_mask, device):
+    if not self.reencoding:
+      return super(ReencodedWindowKVCache, self).begin(seq_len, padding_mask, device)
+    # the re-encoded window starts over at position 0
+    self.reencoding = False
+    self.seen, self.padding_mask, self.lengths = 0, None, None
+    positions, padding_mask = super(ReencodedWindowKVCache, self).begin(seq_len, padding_mask, device)
+    self.seen = self.tokens.shape[1]
+    return positions, padding_mask
+
+  def truncate(self, length):
+    # only a window that was never re-encoded can be rolled back
+    if self.seen > self.window:
+      if length != self.seen:
+        raise ValueError('cannot truncate a re-encoded window')
+      return
+    super(ReencodedWindowKVCache, self).truncate(length)
+    if self.tokens is not None:
+      self.tokens = self.tokens[:, :length]
+      self.token_padding = self.token_padding[:, :length]
+
+  def select(self, rows):
+    super(ReencodedWindowKVCache, self).select(rows)
+    if self.tokens is not None:
+      self.tokens = self.tokens.index_select(0, rows)
+      self.token_padding = self.token_padding.index_select(0, rows)
+
+
+class SlotKVCache(object):
+  # keys and values of a fixed number of independent sequences (slots), for continuous batching
+  # every slot caches up to `window` positions of its sequence and slides like SlidingWindowKVCache past that
+  # the active slots are always the first rows, so a decode step of all of them works on views of the buffers;
+  # a sequence is admitted with the keys/values of its prefilled prompt and evicted once it is done
+  def __init__(self, num_layers, slots, window, pinned=1):
+    self.keys = [None] * num_layers
+    self.values = [None] * num_layers
+    self.slots = slots
+    self.window = window
+    self.pinned = pinned
+    # number of tokens fed so far, per active slot
+    self.seen = []
+
+  def __len__(self):
+    # the keys of the next step span the longest cached slot (plus the new token), shorter slots are masked
+    return min(max(self.seen), self.window - 1) if self.seen else 0
+
+  def max_positions(self, seq_len):
+    return min(max(self.seen) + seq_len, self.window)
+
+  def allocate(self, layer, like):
+    if self.keys[layer] is None:
+      shape = (self.slots, like.shape[1], self.window, like.shape[3])
+      self.keys[layer] = torch.zeros(shape, dtype=like.dtype, device=like.device)
+      self.values[layer] = torch.zeros(shape, dtype=like.dtype, device=like.device)
+
+  def admit(self, keys=None, values=None):
+    # takes a sequence into the next free slot, with the (1, heads, length, depth) keys/values of its first tokens
+    # (None if there are none yet); returns its row
+    if len(self.seen) == self.slots:
+      raise ValueError('all %i slots are taken' % self.slots)
+    row = len(self.seen)
+    length = 0 if keys is None else keys[0].shape[2]
+    if length >= self.window:
+      raise ValueError('cannot admit %i positions into a window of %i' % (length, self.window))
+    for layer in range(len(self.keys)):
+      if keys is not None:
+        self.allocate(layer, keys[layer])
+        self.keys[layer][row, :, :length] = keys[layer][0]
+        self.values[layer][row, :, :length] = values[layer][0]
+    self.seen.append(length)
+    return row
+
+  def evict(self, row):
+    # frees the slot of a row, the last active row moves into it
+    last = len(self.seen) - 1
+    if row != last:
+      length = min(self.seen[last], self.window)
+      for layer in range(len(self.keys)):
+        self.keys[layer][row, :, :length] = self.keys[layer][last, :, :length]
+        self.values[layer][row, :, :length] = self.values[layer][last, :, :length]
+      self.seen[row] = self.seen[last]
+    self.seen.pop()
+
+  def begin(self, seq_len, padding_mask, device):
+    if seq_len != 1 or padding_mask is not None:
+      raise ValueError('slots are extended by one unpadded token at a time')
+    seen = torch.tensor(self.seen, dtype=torch.long, device=device)
+    # column every slot writes its new token to, the oldest generated one of a full window
+    self.columns = torch.where(seen < self.window, seen,
+                               self.pinned + (seen - self.window) % (self.window - self.pinned))
+    filled = torch.clamp(seen + 1, max=self.window)
+    self.width = min(max(self.seen) + 1, self.window)
+    self.seen = [length + 1 for length in self.seen]
+    padding_mask = torch.arange(self.width, device=device).unsqueeze(0) >= filled.unsqueeze(1)
+    return seen.clamp(max=self.window - 1).unsqueeze(1), padding_mask
+
+  def update(self, layer, k, v):
+    self.allocate(layer, k)
+    rows = torch.arange(len(self.seen), device=k.device)
+    self.keys[layer][rows, :, self.columns] = k[:, :, 0]
+    self.values[layer][rows, :, self.columns] = v[:, :, 0]
+    return self.keys[layer][:len(self.seen), :, :self.width], self.values[layer][:len(self.seen), :, :self.width]
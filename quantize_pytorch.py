@@ -0,0 +1,58 @@
+from __future__ import print_function
+import os
+import sys
+import json
+import argparse
+import fastBPE
+import vocabulary
+import pytorch_engine
+import pytorch_checkpoint
+import pytorch_quantization
+from control_codes import control_code_prompt, read_control_codes
+
+parser = argparse.ArgumentParser(description='Code for quantising a flat PyTorch checkpoint to int8 and reporting the perplexity drift against fp32')
+parser.add_argument('--pytorch_checkpoint', type=str, required=True,
+                    help='location of the fp32 flat PyTorch checkpoint (see convert_tf_to_pytorch.py)')
+parser.add_argument('--quantized_checkpoint', type=str, required=True,
+                    help='location of the int8 checkpoint; it is written if it does not exist yet')
+parser.add_argument('--control_codes', type=str, default='training_data/common-crawl-en/abortion/generation_data/control_codes.jsonl',
+                    help='control_codes.jsonl with the control codes to compare the models on')
+parser.add_argument('--num_codes', type=int, default=32,
+                    help='number of control codes (the first ones of the file) to compare the models on')
+parser.add_argument('--generate_num', type=int, default=64,
+                    help='number of tokens the fp32 model generates greedily after every control code')
+parser.add_argument('--threads', type=int, default=0,
+                    help='number of intra-op threads; defaults to 0 which is one per physical core')
+
+args = parser.parse_args()
+pytorch_engine.setup_device('cpu', args.threads)
+
+if not os.path.isfile(args.pytorch_checkpoint):
+  print('INFO :: PyTorch checkpoint not found. Please verify location of the flat checkpoint.')
+  sys.exit(1)
+
+word2idx = vocabulary.load_vocabulary('vocab').ids
+bpe = fastBPE.fastBPE('codes', 'vocab')
+
+reference = pytorch_checkpoint.load_model(args.pytorch_checkpoint)
+if not os.path.isfile(args.quantized_checkpoint):
+  print('INFO :: Quantising', args.pytorch_checkpoint, 'to', args.quantized_checkpoint)
+  encoder, softmax = pytorch_quantization.quantize_model(*pytorch_checkpoint.load_model(args.pytorch_checkpoint))
+  pytorch_quantization.save_quantized_model(args.quantized_checkpoint, encoder, softmax)
+  del encoder, softmax
+quantized = pytorch_quantization.load_quantized_model(args.quantized_checkpoint)
+for module in reference + quantized:
+  module.eval()
+
+# the fixed set: the first control codes of the file, each followed by the greedy fp32 continuation
+codes = read_control_codes(args.control_codes)[:args.num_codes]
+prompts = [control_code_prompt(code) for code in codes]
+prompts = [[word2idx[token] for token in ' \n '.join(bpe.apply([prompt])).split(' ')] for prompt in prompts]
+engine = pytorch_engine.GenerationEngine(reference[0], reference[1])
+continuations = engine.generate_batch(prompts, max_new_tokens=args.generate_num)
+sequences = [prompt + continuation for prompt, continuation in zip(prompts, continuations)]
+
+report = pytorch_quantization.perplexity_drift(reference, quantized, sequences)
+report['fp32_bytes'] = os.path.getsize(args.pytorch_checkpoint)
+report['int8_bytes'] = os.path.getsize(args.quantized_checkpoint)
+print(json.dumps(report, indent=2))
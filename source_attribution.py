@@ -5,6 +5,7 @@ import os
 import numpy as np
 tf.enable_eager_execution()
 import transformer
+import vocabulary
 import argparse
 import pdb
 import sys
@@ -23,6 +24,12 @@ parser.add_argument('--model_dir', type=str, required=True,
                                         help='location of model checkpoint')
 parser.add_argument('--seed', type=int, default=1337,
                                         help='random seed for TensorFlow, numpy and PythonHash')
+parser.add_argument('--batch_size', type=int, default=64,
+                                        help='maximum number of domains scored in one forward pass')
+parser.add_argument('--max_tokens', type=int, default=1024,
+                                        help='maximum number of tokens (with padding) scored in one forward pass; the logits of a pass take about 1 MB per token')
+parser.add_argument('--prior', action='store_true',
+                                        help='also rank the domains by their posterior: the likelihood of the prompt combined with the domain prior of control_codes.txt')
 
 args = parser.parse_args()
 tf.random.set_random_seed(args.seed)
@@ -30,24 +37,24 @@ os.environ['PYTHONHASHSEED'] = str(args.seed)
 np.random.seed(args.seed)
 
 # load the vocabulary from file
-vocab = open('vocab').read().decode(encoding='utf-8').split('\n') if not use_py3 else open('vocab', encoding='utf-8').read().split('\n')
-vocab = list(map(lambda x: x.split(' ')[0], vocab)) + ['<unk>'] + ['\n']
-print ('{} unique words'.format(len(vocab)))
+# it is compiled once into vocab.bin, which is memory-mapped (and shared with the other processes) from then on
+idx2word = vocabulary.load_vocabulary('vocab')
+print ('{} unique words'.format(len(idx2word)))
 
 # length of the vocabulary
-vocab_size = len(vocab)
+vocab_size = len(idx2word)
 
 # define the numericalization map
 # idx2word maps the numericalized ID to the word
 # word2idx maps the word to the numericalized ID
-word2idx = {u:i for i, u in enumerate(vocab)}
-idx2word = np.array(vocab)
+word2idx = idx2word.ids
 
 
 
-# sequence length to use for the transformer
+# maximum sequence length to use for the transformer
 # the model is trained with a seq_length of 512
 # so, any value <= 512 should work
+# batches are only padded to their longest sequence
 seq_length = 256
 
 
@@ -81,8 +88,10 @@ class TiedEmbeddingSoftmax(tf.keras.layers.Layer):
     else:
       return tf.tensordot(inputs, tf.transpose(self.w), 1) + self.b
 
-# input for the keras model
-tokens = tf.keras.layers.Input(shape=(seq_length,), dtype='int32')
+# inputs for the keras model: the tokens and the tokens they predict (the tokens shifted by one)
+# of a batch of any size and length
+tokens = tf.keras.layers.Input(shape=(None,), dtype='int32', name='input_1')
+targets = tf.keras.layers.Input(shape=(None,), dtype='int32', name='input_2')
 
 # instantiates a tied softmax class
 tied_embedding_softmax = TiedEmbeddingSoftmax()
@@ -101,14 +110,20 @@ transformed = transformer.Encoder()(embedded, training=False)
 # and not a lookup
 logits = tied_embedding_softmax(transformed, embed=False)
 
+# the log-probability of every target token: the log-softmax is gathered at the targets inside the graph,
+# so the (batch, length, vocab) logits never leave it
+token_log_probs = tf.keras.layers.Lambda(
+    lambda t: -tf.nn.sparse_softmax_cross_entropy_with_logits(labels=t[1], logits=t[0]),
+    name='token_log_probs')([logits, targets])
 
-# finally, define the Keras model with inputs as tokens and outputs as the logits we just computed
-model = tf.keras.Model(inputs=tokens, outputs=logits)
 
+# finally, define the Keras model with inputs as tokens and targets and outputs as their log-probabilities
+model = tf.keras.Model(inputs=[tokens, targets], outputs=token_log_probs)
 
-# the loss function is a simple categorical crossentropy between the logits and the labels
-def loss(labels, logits):
-    return tf.keras.losses.sparse_categorical_crossentropy(labels, logits, from_logits=True)
+
+# the loss function is the negative log-likelihood of the targets
+def loss(labels, token_log_probs):
+    return -token_log_probs
 
 # the optimizer is not used since this code only supports inference
 # however, to compile the model, we still define it
@@ -138,7 +153,7 @@ estimator_model = tf.keras.estimator.model_to_estimator(keras_model=model, confi
 # we now create a serving function from this estimator
 # this enables us to load the model once and easily query it multiple times
 def serving_input_fn():
-    inputs = {'input_1': tf.placeholder(tf.int32, [2,seq_length])}
+    inputs = {'input_1': tf.placeholder(tf.int32, [None, None]), 'input_2': tf.placeholder(tf.int32, [None, None])}
     return tf.estimator.export.ServingInputReceiver(inputs, inputs)
 predict_fn = tf.contrib.predictor.from_estimator(estimator_model, serving_input_fn)
 
@@ -151,37 +166,54 @@ with open('control_codes.txt', 'r') as f:
     domains = [line.split() for line in f.readlines()]
     domains = [(t[1], float(t[0])) for t in domains]
 
-    
+
+def domain_log_likelihoods(_prompt):
+    # the summed log-probability and the number of scored tokens of the prompt after every domain tag
+    # all domain-prefixed prompts are tokenized in one call and scored in batches of similar length,
+    # right-padded to the longest prompt of the batch (the causal mask keeps the padding out of the scores)
+    # a batch holds at most --batch_size rows and --max_tokens tokens with padding, since the graph materialises
+    # (rows, length, vocab) logits (like pytorch_scoring.length_batches)
+    split_prompts = bpe.apply([domain + u' ' + _prompt for domain, _ in domains])
+    texts = [[word2idx[i] for i in split_prompt.split()] for split_prompt in split_prompts]
+    if max(len(text) for text in texts) > seq_length:
+        raise ValueError('the prompt is longer than {} tokens'.format(seq_length))
+
+    batches = [[]]
+    for i in sorted(range(len(texts)), key=lambda i: len(texts[i])):
+        if batches[-1] and (len(batches[-1]) == args.batch_size or
+                            (len(batches[-1]) + 1) * (len(texts[i]) - 1) > args.max_tokens):
+            batches.append([])
+        batches[-1].append(i)
+
+    log_likelihoods = np.zeros(len(texts), dtype=np.float64)
+    lengths = np.array([len(text) - 1 for text in texts])
+    for batch in batches:
+        length = max(lengths[batch])
+        inputs = np.array([texts[i][:-1] + [0] * (length - lengths[i]) for i in batch])
+        outputs = np.array([texts[i][1:] + [0] * (length - lengths[i]) for i in batch])
+        scores = predict_fn({'input_1': inputs, 'input_2': outputs})['token_log_probs']
+        scored = np.arange(length)[np.newaxis, :] < lengths[batch][:, np.newaxis]
+        log_likelihoods[batch] = np.where(scored, scores, 0.).sum(axis=1)
+    return log_likelihoods, lengths
+
+
 while True:
     _prompt = raw_input('ENTER PROMPT: ') if not use_py3 else input('ENTER PROMPT: ')
-
-    ppls = {}
-    # loop over all domains and compute perplexity
-    for domain, domain_prior in domains:
-       print(u'computing for domain: {}'.format(domain))
-       # tokenize data and add domain tag to it
-       prompt = domain + u' ' + _prompt
-       split_prompt = bpe.apply([prompt])[0].split()
-
-       # numericalize data and pad to the seq_len dimension
-       text = [word2idx[i] for i in split_prompt]
-       padding_text = text + [0] * (seq_length - len(text))
-       tokens_generated = np.tile(padding_text, (2,1)) 
-       output_scores = predict_fn({'input_1':tokens_generated})['tied_embedding_softmax'].squeeze()[0]
-       token_scores = output_scores[:-1]
-
-       # compute the perplexity for this sequence
-       xent = 0
-       for sequence_idx, token_idx in enumerate(text[1:]):
-           token = idx2word[token_idx]
-
-           # compute the probability of this token
-           Z = np.exp(token_scores[sequence_idx]).sum()
-           token_prob = np.exp(token_scores[sequence_idx, token_idx]) / Z 
-           xent -= np.log(token_prob) / len(text[1:])
-           
-       ppls[domain] = round(np.exp(xent), 6)
-       #print(u'{} ppl = {}'.format(domain, ppls[domain]))
+    if not _prompt.strip():
+        continue
+
+    try:
+        log_likelihoods, lengths = domain_log_likelihoods(_prompt)
+    except KeyError as e:
+        print('ERROR :: unknown token {}'.format(e))
+        continue
+    except ValueError as e:
+        print('ERROR ::', e)
+        continue
+
+    # the perplexity of the prompt for every domain
+    ppls = {domain: round(np.exp(-log_likelihood / length), 6)
+            for (domain, _), log_likelihood, length in zip(domains, log_likelihoods, lengths)}
 
     # sort the domains based on perplexities and print
     ppls = [(k, v) for k, v in ppls.items()]
@@ -190,3 +222,12 @@ while True:
     for t in ppls:
         domain, ppl = t
         print(u'{} ppl = {}'.format(domain, ppl))
+
+    if args.prior:
+        # posterior of the domains: the likelihood of the whole prompt times the domain prior, normalized
+        scores = log_likelihoods + np.log([domain_prior for _, domain_prior in domains])
+        posteriors = np.exp(scores - scores.max())
+        posteriors /= posteriors.sum()
+        print('POSTERIOR (with the domain prior of control_codes.txt):')
+        for i in np.argsort(-posteriors):
+            print(u'{} posterior = {:.6f}'.format(domains[i][0], posteriors[i]))
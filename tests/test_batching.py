@@ -0,0 +1,35 @@
+import torch
+import pytorch_batching
+import pytorch_engine
+import pytorch_transformer
+from test_kv_cache import tiny_encoder
+
+
+def tiny_engine():
+  encoder = tiny_encoder()
+  softmax = pytorch_transformer.TiedEmbeddingSoftmax(50, 32)
+  torch.nn.init.normal_(softmax.w, std=0.5)
+  return pytorch_engine.GenerationEngine(encoder, softmax.eval(), seq_length=16)
+
+
+def test_failing_request_does_not_stop_the_others():
+  engine = tiny_engine()
+  batcher = pytorch_batching.ContinuousBatcher(engine, slots=2)
+  results = {}
+
+  def request(name, **sampling):
+    return pytorch_batching.SequenceRequest([1, 2, 3], max_new_tokens=5,
+                                            on_done=lambda tokens: results.__setitem__(name, tokens), **sampling)
+
+  # the tiny temperature overflows the logits, sampling raises on the inf/nan probabilities
+  failing = request('failing', temperature=1e-40)
+  for r in [request('before'), failing, request('after')]:
+    batcher.submit(r)
+  batcher.run()
+
+  expected = engine.generate_batch([[1, 2, 3]], max_new_tokens=5)[0]
+  assert results == {'before': expected, 'failing': None, 'after': expected}
+  assert failing.error
+  assert batcher.metrics()['failed_requests'] == 1
+  assert batcher.metrics()['finished_requests'] == 2
+  assert not batcher.running
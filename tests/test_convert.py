@@ -0,0 +1,71 @@
+import numpy as np
+import torch
+import pytorch_checkpoint
+import pytorch_transformer
+
+
+class FakeReader(object):
+  # the part of a TensorFlow checkpoint reader (pywrap_tensorflow.NewCheckpointReader) the converter uses
+  def __init__(self, variables):
+    self.variables = variables
+
+  def get_variable_to_shape_map(self):
+    return {name: list(value.shape) for name, value in self.variables.items()}
+
+  def get_tensor(self, name):
+    return self.variables[name]
+
+
+def tf_variables(encoder, softmax):
+  # the variables of a TensorFlow checkpoint of the model, with its scope names and Adagrad slots
+  def suffix(i):
+    return '' if i == 0 else '_%i' % i
+
+  def numpy(parameter, transpose=False):
+    value = parameter.detach().numpy()
+    # TensorFlow stores dense kernels as (in, out)
+    return value.T.copy() if transpose else value.copy()
+
+  variables = {'w': numpy(softmax.w), 'b': numpy(softmax.b), 'global_step': np.array(5)}
+  for i in range(encoder.num_layers):
+    layer = getattr(encoder, 'layer%i' % i)
+    scope = 'encoder/encoder_layer%s/' % suffix(i)
+    for j, layernorm in enumerate([layer.layernorm1, layer.layernorm2]):
+      variables[scope + 'layer_normalization%s/beta' % suffix(2 * i + j)] = numpy(layernorm.bias)
+      variables[scope + 'layer_normalization%s/gamma' % suffix(2 * i + j)] = numpy(layernorm.weight)
+    attention = layer.multi_head_attention
+    dense = [('multi_head_attention%s/' % suffix(i), linear)
+             for linear in [attention.Wq, attention.Wk, attention.Wv, attention.dense]]
+    dense += [('sequential%s/' % suffix(i), linear) for linear in [layer.ffn[0], layer.ffn[2]]]
+    for j, (module, linear) in enumerate(dense):
+      variables[scope + module + 'dense%s/bias' % suffix(6 * i + j)] = numpy(linear.bias)
+      variables[scope + module + 'dense%s/kernel' % suffix(6 * i + j)] = numpy(linear.weight, transpose=True)
+  variables['encoder/layer_normalization_%i/gamma' % (2 * encoder.num_layers)] = numpy(encoder.layernorm.weight)
+  variables['encoder/layer_normalization_%i/beta' % (2 * encoder.num_layers)] = numpy(encoder.layernorm.bias)
+  for name in list(variables):
+    if name != 'global_step':
+      variables[name + '/Adagrad'] = np.zeros_like(variables[name])
+  return variables
+
+
+def test_converted_checkpoint_matches_the_model(tmp_path):
+  torch.manual_seed(0)
+  encoder = pytorch_transformer.Encoder(num_layers=3, d_model_size=32, num_heads=4, dff=64).eval()
+  for parameter in encoder.parameters():
+    torch.nn.init.normal_(parameter, std=0.2)
+  softmax = pytorch_transformer.TiedEmbeddingSoftmax(50, 32)
+  torch.nn.init.normal_(softmax.w)
+  torch.nn.init.normal_(softmax.b)
+
+  path = str(tmp_path / 'model.flat')
+  config = pytorch_checkpoint.convert_tf_checkpoint(FakeReader(tf_variables(encoder, softmax)), path, num_heads=4)
+  # the layer count and sizes come from the variable map
+  assert config == {'num_layers': 3, 'd_model_size': 32, 'num_heads': 4, 'dff': 64, 'vocab_size': 50}
+
+  converted_encoder, converted_softmax = pytorch_checkpoint.load_model(path)
+  converted_encoder.eval()
+  tokens = torch.randint(0, 50, (2, 7))
+  with torch.no_grad():
+    expected = softmax(encoder(softmax(tokens, embed=True)), embed=False)
+    logits = converted_softmax(converted_encoder(converted_softmax(tokens, embed=True)), embed=False)
+  assert torch.equal(logits, expected)
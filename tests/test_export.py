@@ -0,0 +1,77 @@
+import pytest
+import torch
+import pytorch_batching
+import pytorch_engine
+import pytorch_export
+import pytorch_quantization
+import pytorch_transformer
+
+pytestmark = pytest.mark.filterwarnings('ignore::FutureWarning')
+
+PROMPTS = [[1, 2, 3], [4, 5, 6, 7, 8], [9]]
+
+
+class CountingEncoder(object):
+  # the eager encoder, counting the calls the exported module left to it
+  def __init__(self, encoder):
+    self.encoder = encoder
+    self.calls = 0
+
+  def __call__(self, *args):
+    self.calls += 1
+    return self.encoder(*args)
+
+
+def tiny_model(quantize=False):
+  torch.manual_seed(0)
+  encoder = pytorch_transformer.Encoder(num_layers=3, d_model_size=64, num_heads=4, dff=128).eval()
+  softmax = pytorch_transformer.TiedEmbeddingSoftmax(100, 64)
+  torch.nn.init.normal_(softmax.w, std=0.3)
+  if quantize:
+    encoder, softmax = pytorch_quantization.quantize_model(encoder, softmax)
+  return encoder, softmax.eval()
+
+
+def export(encoder, path, freeze):
+  with torch.no_grad():
+    pytorch_export.export_encoder(encoder, path, freeze=freeze)
+  exported = pytorch_export.load_exported(path, encoder)
+  exported.encoder = CountingEncoder(encoder)
+  return exported
+
+
+@pytest.mark.parametrize('quantize', [False, True])
+@pytest.mark.parametrize('freeze', [False, True])
+def test_exported_encoder_matches_eager(tmp_path, quantize, freeze):
+  encoder, softmax = tiny_model(quantize)
+  exported = export(encoder, str(tmp_path / 'encoder.pt'), freeze)
+
+  x = softmax(torch.randint(0, 100, (2, 7)), embed=True)
+  with torch.no_grad():
+    assert torch.allclose(exported(x.clone()), encoder(x.clone()), atol=1e-5)
+
+  for sliding_window in [False, True]:
+    # a window of 16 positions, so that 30 new tokens run past it
+    eager = pytorch_engine.GenerationEngine(encoder, softmax, 16, sliding_window=sliding_window)
+    engine = pytorch_engine.GenerationEngine(exported, softmax, 16, sliding_window=sliding_window)
+    expected = eager.generate_batch(PROMPTS, 30)
+    assert engine.generate_batch(PROMPTS, 30) == expected
+    draft = pytorch_engine.draft_encoder(encoder, 1)
+    assert engine.generate_speculative(PROMPTS[1], draft, max_new_tokens=30)[0] == expected[1]
+
+  # the slots of continuous batching (which always slide)
+  results = {}
+  batcher = pytorch_batching.ContinuousBatcher(engine, slots=2)
+  for i, prompt in enumerate(PROMPTS):
+    batcher.submit(pytorch_batching.SequenceRequest(prompt, 30, on_done=lambda tokens, i=i: results.__setitem__(i, tokens)))
+  batcher.run()
+  assert [results[i] for i in range(len(PROMPTS))] == expected
+  # every step ran the exported module
+  assert exported.encoder.calls == 0
+
+
+def test_exported_encoder_shares_the_weights(tmp_path):
+  encoder, _ = tiny_model()
+  exported = export(encoder, str(tmp_path / 'encoder.pt'), freeze=False)
+  weights = {tensor.data_ptr() for tensor in encoder.parameters()}
+  assert all(tensor.data_ptr() in weights for tensor in exported.module.parameters())
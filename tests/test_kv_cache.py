@@ -0,0 +1,35 @@
+import torch
+import pytorch_transformer
+
+
+def tiny_encoder(num_layers=3):
+  torch.manual_seed(0)
+  return pytorch_transformer.Encoder(num_layers=num_layers, d_model_size=32, num_heads=4, dff=64).eval()
+
+
+def test_incremental_decoding_matches_full_window():
+  # prefill of the prompt, then one token at a time against the cache, compared with the whole window at once
+  encoder = tiny_encoder()
+  x = torch.randn(2, 10, 32)
+  with torch.no_grad():
+    full = encoder(x.clone())
+    past = pytorch_transformer.KVCache(encoder.num_layers)
+    outputs = [encoder(x[:, :6].clone(), past)]
+    for i in range(6, 10):
+      outputs.append(encoder(x[:, i:i + 1].clone(), past))
+  assert len(past) == 10
+  assert torch.allclose(torch.cat(outputs, dim=1), full, atol=1e-5)
+
+
+def test_incremental_logits_match_full_window():
+  encoder = tiny_encoder()
+  softmax = pytorch_transformer.TiedEmbeddingSoftmax(50, 32)
+  torch.nn.init.normal_(softmax.w, std=0.5)
+  tokens = torch.randint(0, 50, (1, 12))
+  with torch.no_grad():
+    full = softmax(encoder(softmax(tokens, embed=True)), embed=False)
+    past = pytorch_transformer.KVCache(encoder.num_layers)
+    incremental = [softmax(encoder(softmax(tokens[:, :4], embed=True), past), embed=False)]
+    for i in range(4, 12):
+      incremental.append(softmax(encoder(softmax(tokens[:, i:i + 1], embed=True), past), embed=False))
+  assert torch.allclose(torch.cat(incremental, dim=1), full, atol=1e-4)
@@ -0,0 +1,39 @@
+import pytest
+import torch
+import pytorch_engine
+import pytorch_transformer
+
+
+def tiny_engine(sliding_window=False):
+  torch.manual_seed(0)
+  encoder = pytorch_transformer.Encoder(num_layers=4, d_model_size=64, num_heads=4, dff=128).eval()
+  for parameter in encoder.parameters():
+    if parameter.dim() == 2:
+      torch.nn.init.normal_(parameter, std=0.4)
+  softmax = pytorch_transformer.TiedEmbeddingSoftmax(50, 64)
+  torch.nn.init.normal_(softmax.w, std=0.05)
+  # a window of 24 positions, so that 30 new tokens run past it
+  return pytorch_engine.GenerationEngine(encoder, softmax, seq_length=24, sliding_window=sliding_window)
+
+
+@pytest.mark.parametrize('sliding_window', [False, True])
+@pytest.mark.parametrize('num_layers', [1, 2, 4])
+def test_greedy_speculative_decoding_matches_generate_batch(num_layers, sliding_window):
+  engine = tiny_engine(sliding_window)
+  draft = pytorch_engine.draft_encoder(engine.encoder, num_layers)
+  for prompt in [[1, 2, 3], [7, 8, 9, 10, 11]]:
+    expected = engine.generate_batch([prompt], max_new_tokens=30)[0]
+    tokens, stats = engine.generate_speculative(prompt, draft, num_draft_tokens=4, max_new_tokens=30)
+    assert tokens == expected
+    assert stats['proposed'] > 0
+
+
+def test_greedy_speculative_decoding_stops_like_generate_batch():
+  engine = tiny_engine()
+  prompt = [7, 8, 9, 10, 11]
+  stop_id = engine.generate_batch([prompt], max_new_tokens=30)[0][5]
+  expected = engine.generate_batch([prompt], max_new_tokens=30, stop_ids=(stop_id,))[0]
+  tokens, _ = engine.generate_speculative(prompt, pytorch_engine.draft_encoder(engine.encoder, 1),
+                                          max_new_tokens=30, stop_ids=(stop_id,))
+  assert tokens == expected
+  assert tokens[-1] == stop_id
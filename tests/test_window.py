@@ -0,0 +1,62 @@
+import torch
+import pytorch_engine
+import pytorch_prefix_cache
+import pytorch_transformer
+from test_kv_cache import tiny_encoder
+
+WINDOW = 8
+PENALTY = 5.
+
+
+def tiny_model():
+  encoder = tiny_encoder()
+  softmax = pytorch_transformer.TiedEmbeddingSoftmax(50, 32)
+  torch.nn.init.normal_(softmax.w, std=0.5)
+  return encoder, softmax.eval()
+
+
+def reencoded(encoder, softmax, prompt, max_new_tokens):
+  # the original generation loop: past the window, the first token and the newest window - 1 tokens are re-encoded
+  sequence = list(prompt)
+  for _ in range(max_new_tokens):
+    window = sequence if len(sequence) <= WINDOW else sequence[:1] + sequence[len(sequence) - WINDOW + 1:]
+    with torch.no_grad():
+      logits = softmax(encoder(softmax(torch.tensor([window]), embed=True)), embed=False)[0, -1]
+    for token in set(sequence):
+      logits[token] /= PENALTY
+    sequence.append(int(logits.argmax()))
+  return sequence[len(prompt):]
+
+
+def test_generation_past_the_window_matches_reencoding():
+  encoder, softmax = tiny_model()
+  # a short prompt, a prompt longer than the window and a padded batch of both
+  prompts = [[1, 2, 3], [4, 5, 6, 7, 8, 9, 10, 11, 12, 13, 14, 3, 2]]
+  expected = [reencoded(encoder, softmax, prompt, 20) for prompt in prompts]
+  for prefix_cache in [None, pytorch_prefix_cache.PrefixCache()]:
+    engine = pytorch_engine.GenerationEngine(encoder, softmax, WINDOW, prefix_cache=prefix_cache)
+    assert engine.generate_batch(prompts, 20, penalty=PENALTY) == expected
+    for prompt, tokens in zip(prompts, expected):
+      assert engine.generate_batch([prompt], 20, penalty=PENALTY) == [tokens]
+      assert engine.generate_speculative(prompt, encoder, max_new_tokens=20, penalty=PENALTY)[0] == tokens
+
+
+def test_sliding_window_takes_long_prompts():
+  encoder, softmax = tiny_model()
+  prompt = [4, 5, 6, 7, 8, 9, 10, 11, 12, 13, 14, 3, 2]
+  for prefix_cache in [None, pytorch_prefix_cache.PrefixCache()]:
+    engine = pytorch_engine.GenerationEngine(encoder, softmax, WINDOW, prefix_cache=prefix_cache, sliding_window=True)
+    tokens = engine.generate_batch([prompt], 20, penalty=PENALTY)[0]
+    assert len(tokens) == 20
+    assert engine.generate_speculative(prompt, encoder, max_new_tokens=20, penalty=PENALTY)[0] == tokens
+
+
+def test_sliding_window_slides_every_row_of_a_padded_batch():
+  encoder, softmax = tiny_model()
+  # prompt lengths differing by up to the whole window, with the prefix cache the rows share their first token
+  prompts = [[1], [1, 2, 3, 4, 5, 6, 7, 8], [1, 9, 10, 11]]
+  for prefix_cache in [None, pytorch_prefix_cache.PrefixCache()]:
+    engine = pytorch_engine.GenerationEngine(encoder, softmax, WINDOW, prefix_cache=prefix_cache, sliding_window=True)
+    # every row slides over its own tokens, as if it was generated alone
+    expected = [engine.generate_batch([prompt], 20, penalty=PENALTY)[0] for prompt in prompts]
+    assert engine.generate_batch(prompts, 20, penalty=PENALTY) == expected
@@ -2,12 +2,15 @@
 
 import numpy as np
 import os
+import sys
+sys.path.append('../')
 import tensorflow as tf
 import tqdm
 import re
 import argparse
 import fastBPE
 import platform
+import vocabulary
 
 use_py3 = platform.python_version()[0] == '3'
 
@@ -22,7 +25,6 @@ def create_tf_records(path, file):
     domain = file.split(".txt")[0].split("_")
 
     train_text = open(path+file, 'rb').read().decode(encoding='utf-8')
-    bpe = fastBPE.fastBPE('../codes', '../vocab')
     tokenized_train_text = bpe.apply([train_text.encode('ascii', errors='ignore') if not use_py3 else train_text])[
         0]  # will NOT work for non-English texts
     # if you want to run non-english text, please tokenize separately using ./fast applybpe and then run this script on the .bpe file with utf8 encoding
@@ -30,22 +32,12 @@ def create_tf_records(path, file):
     tokenized_train_text = re.findall(r'\S+|\n', tokenized_train_text)
     tokenized_train_text = list(filter(lambda x: x != u'@@', tokenized_train_text))
 
-    # load the vocabulary from file
-    vocab = open('../vocab').read().decode(encoding='utf-8').split('\n') if not use_py3 else open('../vocab',
-                                                                                                  encoding='utf-8').read().split(
-        '\n')
-    vocab = list(map(lambda x: x.split(' ')[0], vocab)) + ['<unk>'] + ['\n']
-    print('{} unique words'.format(len(vocab)))
-
     for ctrl_code in domain:
-        if ctrl_code not in vocab:
+        if ctrl_code not in word2idx:
             print('Provided control code is not in the vocabulary')
             print('Please provide a different one; refer to the vocab file for allowable tokens')
             return 0
 
-    # Creating a mapping from unique characters to indices
-    word2idx = {u: i for i, u in enumerate(vocab)}
-
     seq_length = args.sequence_len - 1
 
     def numericalize(x):
@@ -80,6 +72,13 @@ def create_tf_records(path, file):
     return total
 
 args = parser.parse_args()
+
+# the BPE codes and the vocabulary are loaded once for all files; the vocabulary is compiled into ../vocab.bin
+# the first time and memory-mapped from then on (see vocabulary.py)
+bpe = fastBPE.fastBPE('../codes', '../vocab')
+word2idx = vocabulary.load_vocabulary('../vocab').ids
+print('{} unique words'.format(len(word2idx)))
+
 path_to_train_files = fname = args.files_folder
 train_files = os.listdir(path_to_train_files)
 
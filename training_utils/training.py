@@ -7,6 +7,7 @@ import os
 import numpy as np
 tf.enable_eager_execution()
 import transformer
+import vocabulary
 import argparse
 import pdb
 import re
@@ -32,6 +33,8 @@ parser.add_argument('--sequence_len', type=int, default=256,
                                         help='sequence len of model being fine-tuned (must match also the TFRecords)')
 parser.add_argument('--iterations', type=int, default=1000,
                                         help='Number of training steps/iterations')
+parser.add_argument('--vocab_chunk_size', type=int, default=0,
+                                        help='compute the loss over chunks of this many vocabulary entries instead of the full logits; 0 computes the full logits')
 
 args = parser.parse_args()
 tf.random.set_random_seed(args.seed)
@@ -39,18 +42,17 @@ os.environ['PYTHONHASHSEED'] = str(args.seed)
 np.random.seed(args.seed)
 
 # load the vocabulary from file
-vocab = open('../vocab').read().decode(encoding='utf-8').split('\n') if not use_py3 else open('../vocab', encoding='utf-8').read().split('\n')
-vocab = list(map(lambda x: x.split(' ')[0], vocab)) + ['<unk>'] + ['\n']
-print ('{} unique words'.format(len(vocab)))
+# it is compiled once into ../vocab.bin, which is memory-mapped (and shared with the other processes) from then on
+idx2word = vocabulary.load_vocabulary('../vocab')
+print ('{} unique words'.format(len(idx2word)))
 
 # length of the vocabulary
-vocab_size = len(vocab)
+vocab_size = len(idx2word)
 
 # define the numericalization map
 # idx2word maps the numericalized ID to the word
 # word2idx maps the word to the numericalized ID
-word2idx = {u:i for i, u in enumerate(vocab)}
-idx2word = np.array(vocab)
+word2idx = idx2word.ids
 
 
 
@@ -70,6 +72,9 @@ def input_fn(params=None):
 
     def _parse_text_function(example_proto):
         blah = tf.io.parse_single_example(example_proto, myfeatures)
+        if args.vocab_chunk_size > 0:
+            # the chunked loss is computed inside the model, which takes the targets as its second input
+            return {'input_1': blah['input'], 'input_2': blah['output']}, blah['output']
         return blah['input'], blah['output']
     
     train_data = tf_data.map(_parse_text_function).batch(params['batch_size'], drop_remainder=True).repeat().shuffle(10000)#.prefetch(tf.contrib.data.AUTOTUNE)
@@ -80,6 +85,47 @@ def input_fn(params=None):
 embedding_dim = 1280
 
 
+# the negative log-likelihood of the targets without the (batch, seq_len, vocab_size) logits:
+# the log-sum-exp over the vocabulary is accumulated vocab_chunk_size rows of w at a time,
+# and the target logits come from the gathered rows of the targets
+# the gradient recomputes the logits of a chunk instead of keeping them from the forward pass,
+# so training only ever holds the logits of one chunk
+def chunked_nll(hidden, targets, w, b, vocab_chunk_size):
+  flat = tf.reshape(hidden, [-1, tf.shape(hidden)[-1]])
+  flat_targets = tf.reshape(tf.cast(targets, tf.int32), [-1])
+  starts = list(range(0, int(w.shape[0]), vocab_chunk_size))
+
+  def chunk_logits(flat, w, b, start, after):
+    # the chunks are chained with control dependencies, so they run (and take memory) one after the other
+    with tf.control_dependencies(after):
+      return tf.matmul(flat, w[start:start + vocab_chunk_size], transpose_b=True) + b[start:start + vocab_chunk_size]
+
+  @tf.custom_gradient
+  def logsumexp(flat, w, b):
+    lse = None
+    for start in starts:
+      chunk = tf.reduce_logsumexp(chunk_logits(flat, w, b, start, [] if lse is None else [lse]), axis=-1)
+      lse = chunk if lse is None else tf.reduce_logsumexp(tf.stack([lse, chunk]), axis=0)
+
+    def grad(dy):
+      dflat, dw, db = None, [], []
+      for start in starts:
+        logits = chunk_logits(flat, w, b, start, [] if dflat is None else [dflat])
+        probs = tf.exp(logits - lse[:, tf.newaxis]) * dy[:, tf.newaxis]
+        chunk_dflat = tf.matmul(probs, w[start:start + vocab_chunk_size])
+        dflat = chunk_dflat if dflat is None else dflat + chunk_dflat
+        dw.append(tf.matmul(probs, flat, transpose_a=True))
+        db.append(tf.reduce_sum(probs, axis=0))
+      return dflat, tf.concat(dw, axis=0), tf.concat(db, axis=0)
+
+    return lse, grad
+
+  target_logits = tf.reduce_sum(flat * tf.gather(w, flat_targets), axis=-1) + tf.gather(b, flat_targets)
+  nll = tf.reshape(logsumexp(flat, w, b) - target_logits, tf.shape(targets))
+  nll.set_shape(targets.shape)
+  return nll
+
+
 # Now, we begin defining the model
 # we defer the transformer definition to transformer.py
 # here, we only define the tied softmax layer
@@ -95,17 +141,21 @@ class TiedEmbeddingSoftmax(tf.keras.layers.Layer):
                              initializer='zeros',
                              trainable=True)
 
-  def call(self, inputs, embed=True):
+  def call(self, inputs, embed=True, vocab_chunk_size=0):
     if embed:
       dtype = tf.keras.backend.dtype(inputs)
       if dtype != 'int32' and dtype != 'int64':
         inputs = math_ops.cast(inputs, 'int32')
       return embedding_ops.embedding_lookup(self.w, inputs)
+    elif vocab_chunk_size > 0:
+      # inputs are the activations and the targets, the output is the negative log-likelihood of every target
+      transformed, targets = inputs
+      return chunked_nll(transformed, targets, self.w, self.b, vocab_chunk_size)
     else:
       return tf.tensordot(inputs, tf.transpose(self.w), 1) + self.b
 
 # input for the keras model
-tokens = tf.keras.layers.Input(shape=(seq_length,), dtype='int32')
+tokens = tf.keras.layers.Input(shape=(seq_length,), dtype='int32', name='input_1')
 
 # instantiates a tied softmax class
 tied_embedding_softmax = TiedEmbeddingSoftmax()
@@ -120,19 +170,31 @@ transformed = transformer.Encoder()(embedded, training=False)
 #transformed = transformer.Encoder(d_model_size=embedding_dim)(embedded, training=False)
 
 
-# pass the activations from our tiedsoftmax class
-# this time with embed=False denoting that we are doing the softmax operation
-# and not a lookup
-logits = tied_embedding_softmax(transformed, embed=False)
+if args.vocab_chunk_size > 0:
+    # the targets are an input of the model, which outputs their negative log-likelihood
+    # computed over chunks of the vocabulary, so the full logits never exist
+    targets = tf.keras.layers.Input(shape=(seq_length,), dtype='int32', name='input_2')
+    token_nll = tied_embedding_softmax([transformed, targets], embed=False, vocab_chunk_size=args.vocab_chunk_size)
+    model = tf.keras.Model(inputs=[tokens, targets], outputs=token_nll)
+
+    # the model already outputs the loss of every token
+    def loss(labels, token_nll):
+        return token_nll
+
+else:
+    # pass the activations from our tiedsoftmax class
+    # this time with embed=False denoting that we are doing the softmax operation
+    # and not a lookup
+    logits = tied_embedding_softmax(transformed, embed=False)
 
 
-# finally, define the Keras model with inputs as tokens and outputs as the logits we just computed
-model = tf.keras.Model(inputs=tokens, outputs=logits)
+    # finally, define the Keras model with inputs as tokens and outputs as the logits we just computed
+    model = tf.keras.Model(inputs=tokens, outputs=logits)
 
 
-# the loss function is a simple categorical crossentropy between the logits and the labels
-def loss(labels, logits):
-    return tf.keras.losses.sparse_categorical_crossentropy(labels, logits, from_logits=True)
+    # the loss function is a simple categorical crossentropy between the logits and the labels
+    def loss(labels, logits):
+        return tf.keras.losses.sparse_categorical_crossentropy(labels, logits, from_logits=True)
 
 # the optimizer is not used since this code only supports inference
 # however, to compile the model, we still define it
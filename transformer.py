@@ -5,14 +5,20 @@ def angle_defn(pos, i, d_model_size):
   angle_rates = 1 / np.power(10000, (2 * (i//2)) / np.float32(d_model_size))
   return pos * angle_rates
 
+# sinusoidal tables computed so far in this process, shared by all encoders of the same size
+pos_encodings = {}
+
 def positional_encoding(position, d_model_size):
-  # create the sinusoidal pattern for the positional encoding
-  angle_rads = angle_defn(np.arange(position)[:, np.newaxis], np.arange(d_model_size)[np.newaxis, :], d_model_size)
-  
-  sines = np.sin(angle_rads[:, 0::2])
-  cosines = np.cos(angle_rads[:, 1::2])
-  
-  pos_encoding = tf.cast(np.concatenate([sines, cosines], axis=-1)[np.newaxis, ...], dtype=tf.float32)
+  if d_model_size not in pos_encodings or pos_encodings[d_model_size].shape[1] < position:
+    # create the sinusoidal pattern for the positional encoding
+    angle_rads = angle_defn(np.arange(position)[:, np.newaxis], np.arange(d_model_size)[np.newaxis, :], d_model_size)
+    
+    sines = np.sin(angle_rads[:, 0::2])
+    cosines = np.cos(angle_rads[:, 1::2])
+    
+    pos_encodings[d_model_size] = np.concatenate([sines, cosines], axis=-1)[np.newaxis, ...]
+
+  pos_encoding = tf.cast(pos_encodings[d_model_size][:, :position], dtype=tf.float32)
   return pos_encoding 
 
 
@@ -104,13 +110,14 @@ class EncoderLayer(tf.keras.layers.Layer):
 
 class Encoder(tf.keras.layers.Layer):
   def __init__(self, num_layers=48, d_model_size=1280, num_heads=16, dff=8192, input_vocab_size=50000,
-               rate=0.1, **kwargs):
+               rate=0.1, max_position=512, **kwargs):
     super(Encoder, self).__init__()
 
     self.d_model_size = d_model_size
     self.num_layers = num_layers
     
-    self.pos_encoding = positional_encoding(input_vocab_size, self.d_model_size)
+    # only built for the context the model was trained on (256 or 512), not for input_vocab_size positions
+    self.pos_encoding = positional_encoding(max_position, self.d_model_size)
 
     for i in range(num_layers):
       setattr(self, "layer%i" % i, EncoderLayer(d_model_size, num_heads, dff, rate))
@@ -0,0 +1,170 @@
+from __future__ import print_function
+import io
+import os
+import mmap
+import zlib
+import struct
+import argparse
+import numpy as np
+
+# the vocabulary of the model as a precompiled binary artifact (vocab.bin next to the vocab file), memory-mapped
+# instead of parsing the 246k lines of the vocab file into a dict and an array of strings in every process;
+# the pages are shared by all processes on the machine and only the ones touched are read
+#
+# layout: header, the (words + 1,) int64 offsets of the words in the string table, the int32 hash index
+# (open addressing over the crc32 of the words, -1 marks a free slot) and the string table (the utf-8 words back to back)
+# the header records the size and modification time of the vocab file, a changed vocab file is compiled again
+
+MAGIC = b'CTRLVOC1'
+# magic, size and mtime of the vocab file, number of words, bytes of the string table, slots of the hash index
+HEADER = struct.Struct('<8sqdqqq')
+
+
+def read_words(vocab_path):
+  # the words in the order of their ids, like the generation and training scripts always built them:
+  # the first column of every line of the vocab file, then <unk> and the newline
+  with io.open(vocab_path, encoding='utf-8') as f:
+    vocab = f.read().split('\n')
+  return [line.split(' ')[0] for line in vocab] + ['<unk>'] + ['\n']
+
+
+def compile_vocabulary(vocab_path, path):
+  words = [word.encode('utf-8') for word in read_words(vocab_path)]
+  offsets = np.zeros(len(words) + 1, dtype=np.int64)
+  offsets[1:] = np.cumsum([len(word) for word in words])
+  # at most half of the slots are taken, so probe sequences stay short
+  slots = 1 << (2 * len(words) - 1).bit_length()
+  index = [-1] * slots
+  for i, word in enumerate(words):
+    slot = zlib.crc32(word) & (slots - 1)
+    while index[slot] >= 0 and words[index[slot]] != word:
+      slot = (slot + 1) & (slots - 1)
+    # a repeated word maps to its last id, like the word2idx dict did
+    index[slot] = i
+
+  stat = os.stat(vocab_path)
+  # written under a temporary name and renamed, so that processes starting at the same time never see half a file
+  tmp_path = '%s.%i.tmp' % (path, os.getpid())
+  with io.open(tmp_path, 'wb') as f:
+    f.write(HEADER.pack(MAGIC, stat.st_size, stat.st_mtime, len(words), int(offsets[-1]), slots))
+    f.write(offsets.tobytes())
+    f.write(np.array(index, dtype=np.int32).tobytes())
+    f.write(b''.join(words))
+  os.replace(tmp_path, path)
+
+
+class WordIds(object):
+  # word -> id view of a Vocabulary, used like the word2idx dict (KeyError for unknown words)
+  def __init__(self, vocabulary):
+    self.vocabulary = vocabulary
+
+  def __getitem__(self, word):
+    i = self.vocabulary.find(word)
+    if i < 0:
+      raise KeyError(word)
+    return i
+
+  def get(self, word, default=None):
+    i = self.vocabulary.find(word)
+    return default if i < 0 else i
+
+  def __contains__(self, word):
+    return self.vocabulary.find(word) >= 0
+
+  def __len__(self):
+    return len(self.vocabulary)
+
+
+class Vocabulary(object):
+  # id -> word sequence over a compiled vocabulary file, used like the idx2word array;
+  # `ids` is the word -> id mapping
+  def __init__(self, path):
+    with io.open(path, 'rb') as f:
+      self.buffer = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    magic, self.source_size, self.source_mtime, num_words, table_bytes, slots = HEADER.unpack_from(self.buffer)
+    if magic != MAGIC:
+      raise ValueError('%s is not a compiled vocabulary' % path)
+    self.offsets = np.frombuffer(self.buffer, dtype=np.int64, count=num_words + 1, offset=HEADER.size)
+    self.index = np.frombuffer(self.buffer, dtype=np.int32, count=slots, offset=HEADER.size + self.offsets.nbytes)
+    self.table_start = HEADER.size + self.offsets.nbytes + self.index.nbytes
+    self.table = np.frombuffer(self.buffer, dtype=np.uint8, count=table_bytes, offset=self.table_start)
+    self.ids = WordIds(self)
+    # ids of the words looked up so far: a text repeats its words, so most lookups are a dict hit, while the
+    # dict only ever holds the words a process actually uses
+    self.found = {}
+
+  def __len__(self):
+    return len(self.offsets) - 1
+
+  def word_bytes(self, i):
+    return self.buffer[self.table_start + int(self.offsets[i]):self.table_start + int(self.offsets[i + 1])]
+
+  def __getitem__(self, i):
+    if not -len(self) <= i < len(self):
+      raise IndexError('word id %i out of range' % i)
+    return self.word_bytes(i % len(self)).decode('utf-8')
+
+  def find(self, word):
+    # the id of the word, -1 if it is not in the vocabulary
+    i = self.found.get(word)
+    if i is not None:
+      return i
+    key = word.encode('utf-8')
+    mask = len(self.index) - 1
+    slot = zlib.crc32(key) & mask
+    while True:
+      i = int(self.index[slot])
+      if i < 0 or self.word_bytes(i) == key:
+        self.found[word] = i
+        return i
+      slot = (slot + 1) & mask
+
+  def ids_containing(self, substring):
+    # the ids of all words containing the substring, from one vectorised scan of the string table
+    key = np.frombuffer(substring.encode('utf-8'), dtype=np.uint8)
+    if len(key) == 0 or len(key) > len(self.table):
+      return np.arange(len(self)) if len(key) == 0 else np.zeros(0, dtype=np.int64)
+    match = np.ones(len(self.table) - len(key) + 1, dtype=bool)
+    for k in range(len(key)):
+      match &= self.table[k:len(self.table) - len(key) + 1 + k] == key[k]
+    positions = np.nonzero(match)[0]
+    ids = np.searchsorted(self.offsets, positions, side='right') - 1
+    # the words are stored back to back, a match may run into the next word
+    return np.unique(ids[positions + len(key) <= self.offsets[ids + 1]])
+
+  def ids_ending_with(self, suffix):
+    # the ids of all words ending with the suffix, compared on the string table at once
+    key = np.frombuffer(suffix.encode('utf-8'), dtype=np.uint8)
+    ends = self.offsets[1:]
+    match = ends - self.offsets[:-1] >= len(key)
+    for k in range(len(key)):
+      match &= self.table[np.clip(ends - len(key) + k, 0, max(len(self.table) - 1, 0))] == key[k]
+    return np.nonzero(match)[0]
+
+
+def load_vocabulary(vocab_path='vocab', path=None):
+  # the compiled vocabulary of the vocab file (by default at vocab_path + '.bin'), compiled first if missing or stale
+  path = vocab_path + '.bin' if path is None else path
+  if os.path.exists(path):
+    vocabulary = Vocabulary(path)
+    stat = os.stat(vocab_path)
+    if (vocabulary.source_size, vocabulary.source_mtime) == (stat.st_size, stat.st_mtime):
+      return vocabulary
+  compile_vocabulary(vocab_path, path)
+  return Vocabulary(path)
+
+
+def main():
+  parser = argparse.ArgumentParser(description='Code for compiling the vocab file into a memory-mapped vocabulary')
+  parser.add_argument('--vocab', type=str, default='vocab',
+                      help='location of the vocab file')
+  parser.add_argument('--output', type=str, default=None,
+                      help='location of the compiled vocabulary; defaults to the vocab file with .bin appended')
+  args = parser.parse_args()
+  path = args.vocab + '.bin' if args.output is None else args.output
+  compile_vocabulary(args.vocab, path)
+  print('{} words compiled to {}'.format(len(Vocabulary(path)), path))
+
+
+if __name__ == '__main__':
+  main()